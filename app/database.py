@@ -22,6 +22,8 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
 logger.info(f"Database URL configured: {'PostgreSQL' if 'postgresql' in DATABASE_URL else 'SQLite'}")
 
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}, isolation_level="AUTOCOMMIT")
+# 引擎預設為 AUTOCOMMIT；多個語句需一起提交時，以此隔離等級開啟交易
+TRANSACTION_ISOLATION_LEVEL = "READ COMMITTED" if engine.dialect.name == "postgresql" else "SERIALIZABLE"
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -34,11 +36,55 @@ def get_db():
 
 def create_tables():
     # 在這裡導入所有模型，避免循環導入
-    from app.models import user, hobby, user_status, commute_route, room, chat, gps_route
+    from app.models import user, hobby, user_status, commute_route, room, chat, gps_route, gps_rollup, gps_trip
+    from app.services.gps_partition_service import gps_partition_manager
     logger.info("Creating database tables...")
+    if gps_partition_manager.enabled:
+        # gps_locations 依賴 users，先建立其他資料表，再建立分割資料表
+        other_tables = [t for t in Base.metadata.sorted_tables if t.name != "gps_locations"]
+        Base.metadata.create_all(bind=engine, tables=other_tables)
+        gps_partition_manager.create_partitioned_table()
     Base.metadata.create_all(bind=engine)
+    ensure_gps_columns()
+    ensure_commute_route_columns()
+    ensure_gps_indexes()
     logger.info("Database tables created successfully")
 
+def _add_missing_columns(table_name, required_columns):
+    from sqlalchemy import inspect, text
+    existing_columns = {column['name'] for column in inspect(engine).get_columns(table_name)}
+    with engine.connect() as conn:
+        for column_name, column_type in required_columns.items():
+            if column_name not in existing_columns:
+                conn.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}'))
+                logger.info(f'Added column {column_name} to {table_name} table')
+
+def ensure_gps_columns():
+    """補上既有 gps_locations 缺少的欄位（新增欄位的資料需另外以 backfill 腳本補齊）"""
+    _add_missing_columns('gps_locations', {
+        'geohash': 'VARCHAR(12)'
+    })
+
+def ensure_commute_route_columns():
+    """補上既有 commute_routes 缺少的欄位（舊版 JSON 定位點需以 backfill_commute_route_points.py 轉換）"""
+    _add_missing_columns('commute_routes', {
+        'departure_minute': 'INTEGER',
+        'trip_count': 'INTEGER',
+        'source': "VARCHAR(20) DEFAULT 'manual'",
+        'packed_points': 'BYTEA' if engine.dialect.name == 'postgresql' else 'BLOB',
+        'point_count': 'INTEGER'
+    })
+
+def ensure_gps_indexes():
+    """
+    補建 gps_locations 缺少的索引
+
+    create_all 只會替新建立的資料表建立索引，既有資料表（或手動建立的分割資料表）需要另外補建
+    """
+    from app.models.gps_route import GPSLocation
+    for index in GPSLocation.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
 def update_database_schema():
     """
     檢查並更新資料庫結構，確保所有欄位都存在
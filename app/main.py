@@ -1,11 +1,28 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.routes import user_routes, chat_routes, friend_routes, hobby_routes, gps_routes
+from app.routes import user_routes, chat_routes, friend_routes, hobby_routes, gps_routes, commute_routes
 from app.database import create_tables, initialize_hobbies
+from app.services.gps_ingest_buffer import gps_ingest_buffer
+from app.services.gps_filter import gps_ingest_filter
+from app.services.gps_partition_service import gps_partition_manager
+from app.services.gps_retention import gps_retention_service
+from app.services.gps_archive import gps_archive
+from app.services.gps_latest import latest_location_cache
+from app.services.gps_nearby import nearby_user_index
+from app.services.gps_trips import trip_segmentation_service
+from app.services.gps_rollup import gps_rollup_service
+from app.services.commute_derivation import commute_derivation_service
+from app.services.commute_matching import commute_match_index
+from app.services.commute_similarity import commute_similarity_index
+from app.services.commute_corridor import commute_corridor_index
+from app.services.gps_similar_users import similar_user_index
+import asyncio
 import app.models.chat  # ← 加這行才會建立 chat_messages 表
 import app.models.user_status  # ← 加這行才會建立 user_status 表
 import app.models.hobby  # ← 加這行才會建立 hobbies 表
 import app.models.commute_route  # ← 加這行才會建立 commute_routes 表
+import app.models.gps_rollup  # ← 加這行才會建立 GPS 彙總表
+import app.models.gps_trip  # ← 加這行才會建立 stay_points、trips 表
 import logging
 
 # 設定 logging
@@ -40,11 +57,50 @@ def startup():
     initialize_hobbies()
     logger.info("API startup completed successfully")
 
+@app.on_event("startup")
+async def start_background_services():
+    logger.info("Starting GPS ingest buffer...")
+    await gps_ingest_buffer.start()
+    await gps_ingest_filter.start()
+    logger.info("Loading latest GPS locations...")
+    await asyncio.get_running_loop().run_in_executor(None, latest_location_cache.warm)
+    await nearby_user_index.start()
+    await trip_segmentation_service.start()
+    await gps_rollup_service.start()
+    await commute_derivation_service.start()
+    await commute_match_index.start()
+    await commute_similarity_index.start()
+    await commute_corridor_index.start()
+    await similar_user_index.start()
+    await gps_partition_manager.start()
+    await gps_retention_service.start()
+    await gps_archive.start()
+
+# 關閉時寫入緩衝區中尚未寫入的資料
+@app.on_event("shutdown")
+async def shutdown():
+    logger.info("Flushing GPS ingest buffer...")
+    await gps_ingest_buffer.stop()
+    await gps_ingest_filter.stop()
+    await gps_partition_manager.stop()
+    await gps_retention_service.stop()
+    await gps_archive.stop()
+    await nearby_user_index.stop()
+    await trip_segmentation_service.stop()
+    await gps_rollup_service.stop()
+    await commute_derivation_service.stop()
+    await commute_match_index.stop()
+    await commute_similarity_index.stop()
+    await commute_corridor_index.stop()
+    await similar_user_index.stop()
+    logger.info("API shutdown completed")
+
 app.include_router(user_routes.router, prefix="/users")
 app.include_router(chat_routes.router)
 app.include_router(friend_routes.router, prefix="/friends")
 app.include_router(hobby_routes.router)
 app.include_router(gps_routes.router)
+app.include_router(commute_routes.router)
 
 @app.get("/")
 def read_root():
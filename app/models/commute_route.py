@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Text, ForeignKey, func
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Float, DateTime, Text, LargeBinary, ForeignKey, func
+from sqlalchemy.orm import relationship, deferred
 from app.database import Base
 
 class CommuteRoute(Base):
@@ -20,10 +20,15 @@ class CommuteRoute(Base):
     end_address = Column(Text, nullable=True)    # 終點地址描述
     
     # 路線資訊
-    gps_points = Column(Text, nullable=True)     # GPS 定位點串列（JSON 格式儲存）
+    gps_points = deferred(Column(Text, nullable=True))  # GPS 定位點串列（舊版 JSON 格式，新資料改存 packed_points）
+    packed_points = deferred(Column(LargeBinary, nullable=True))  # GPS 定位點串列（int32 微度 + 差分秒數，格式見 gps_encoding），列表查詢不載入
+    point_count = Column(Integer, nullable=True)  # 定位點數量
     travel_time = Column(Integer, nullable=True) # 通勤時間（分鐘）
     distance = Column(Float, nullable=True)      # 距離（公里）
     transport_mode = Column(String, nullable=True) # 交通工具（如：開車、捷運、公車）
+    departure_minute = Column(Integer, nullable=True)  # 典型出發時間（UTC 當日第幾分鐘）
+    trip_count = Column(Integer, nullable=True)        # 由定位歷史偵測時，期間內的行程次數
+    source = Column(String, default="manual")          # 路線來源（manual：用戶建立、derived：由定位歷史偵測）
     
     # 時間資訊
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,45 @@
+from sqlalchemy import Column, Integer, Float, DateTime, Date, ForeignKey
+from app.database import Base
+from datetime import datetime
+
+class GPSHourlyRollup(Base):
+    __tablename__ = "gps_hourly_rollups"
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    hour = Column(DateTime, primary_key=True)  # 整點時間（UTC）
+    point_count = Column(Integer, nullable=False, default=0)  # 定位點數量
+    distance_m = Column(Float, nullable=False, default=0.0)   # 移動距離（公尺）
+    active_seconds = Column(Float, nullable=False, default=0.0)  # 活動時間（秒）
+
+    # 範圍框
+    min_latitude = Column(Float, nullable=False)
+    max_latitude = Column(Float, nullable=False)
+    min_longitude = Column(Float, nullable=False)
+    max_longitude = Column(Float, nullable=False)
+
+    # 第一個與最後一個定位點（增量更新時接續計算距離）
+    first_timestamp = Column(DateTime, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    last_latitude = Column(Float, nullable=False)
+    last_longitude = Column(Float, nullable=False)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+class GPSDailyRollup(Base):
+    __tablename__ = "gps_daily_rollups"
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    day = Column(Date, primary_key=True)  # 日期（UTC）
+    point_count = Column(Integer, nullable=False, default=0)
+    distance_m = Column(Float, nullable=False, default=0.0)
+    active_seconds = Column(Float, nullable=False, default=0.0)
+
+    min_latitude = Column(Float, nullable=False)
+    max_latitude = Column(Float, nullable=False)
+    min_longitude = Column(Float, nullable=False)
+    max_longitude = Column(Float, nullable=False)
+
+    first_timestamp = Column(DateTime, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    last_latitude = Column(Float, nullable=False)
+    last_longitude = Column(Float, nullable=False)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
@@ -1,17 +1,62 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Date, Text
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, Date, Text, Index
 from sqlalchemy.orm import relationship
 from app.database import Base
 from datetime import datetime
 
 class GPSLocation(Base):
     __tablename__ = "gps_locations"
+    __table_args__ = (
+        # 歷史、日期與分頁查詢皆為「某用戶在某段時間」，user_id 單欄查詢也可使用此索引
+        Index('ix_gps_locations_user_timestamp', 'user_id', 'timestamp'),
+        # 範圍框查詢：geohash 前綴區間 + 時間
+        Index('ix_gps_locations_geohash_timestamp', 'geohash', 'timestamp'),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     latitude = Column(Float, nullable=False)  # 緯度
     longitude = Column(Float, nullable=False)  # 經度
     timestamp = Column(DateTime, nullable=False, index=True)  # 定位時間
+    geohash = Column(String(12), nullable=True)  # 寫入時計算的 geohash（9 碼）
     created_at = Column(DateTime, default=datetime.now)
     
     # 關聯關係
     user = relationship("User", back_populates="gps_locations")
+
+
+class GPSJournalCommit(Base):
+    """已寫入資料庫的 GPS 寫入日誌位置區間（與定位點同一交易寫入，重播時據此略過）"""
+    __tablename__ = "gps_journal_commits"
+
+    journal_id = Column(Integer, primary_key=True, autoincrement=False)  # 日誌目錄編號（每個程序一個，各自的日誌位置）
+    first_offset = Column(BigInteger, primary_key=True, autoincrement=False)
+    last_offset = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class GPSFilterSettings(Base):
+    """個別用戶的寫入過濾門檻（未設定的欄位沿用部署預設值）"""
+    __tablename__ = "gps_filter_settings"
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    min_distance_m = Column(Float, nullable=True)
+    min_interval_s = Column(Float, nullable=True)
+    keepalive_s = Column(Float, nullable=True)
+    max_speed_mps = Column(Float, nullable=True)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+
+class GPSDeleteJob(Base):
+    """用戶定位刪除工作（任一程序皆可查詢；執行中的程序停止後由其他程序接手）"""
+    __tablename__ = "gps_delete_jobs"
+
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    start = Column(DateTime, nullable=True)  # 刪除範圍（皆為空表示全部）
+    end = Column(DateTime, nullable=True)
+    status = Column(String(20), nullable=False, default="pending", index=True)  # pending、running、completed、failed
+    deleted_count = Column(BigInteger, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)  # 執行中的程序定期更新，逾時視為中斷
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
@@ -0,0 +1,46 @@
+from sqlalchemy import Column, Integer, Float, DateTime, ForeignKey, Index
+from app.database import Base
+from datetime import datetime
+
+class StayPoint(Base):
+    __tablename__ = "stay_points"
+    __table_args__ = (
+        Index('ix_stay_points_user_arrival', 'user_id', 'arrival_time'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    arrival_time = Column(DateTime, nullable=False)    # 抵達時間（停留範圍內第一個定位點）
+    departure_time = Column(DateTime, nullable=False)  # 離開時間（停留範圍內最後一個定位點）
+    latitude = Column(Float, nullable=False)   # 停留範圍內定位點的平均緯度
+    longitude = Column(Float, nullable=False)  # 停留範圍內定位點的平均經度
+    point_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+
+class Trip(Base):
+    __tablename__ = "trips"
+    __table_args__ = (
+        Index('ix_trips_user_start', 'user_id', 'start_time'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    origin_stay_id = Column(Integer, ForeignKey('stay_points.id'), nullable=True)       # 出發的停留點（訊號中斷後開始的行程為空）
+    destination_stay_id = Column(Integer, ForeignKey('stay_points.id'), nullable=True)  # 抵達的停留點（因訊號中斷結束的行程為空）
+    start_time = Column(DateTime, nullable=False)
+    end_time = Column(DateTime, nullable=False)
+    start_latitude = Column(Float, nullable=False)
+    start_longitude = Column(Float, nullable=False)
+    end_latitude = Column(Float, nullable=False)
+    end_longitude = Column(Float, nullable=False)
+    distance_m = Column(Float, nullable=False, default=0.0)  # 沿途距離（公尺）
+    point_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+
+class TripSegmentationState(Base):
+    __tablename__ = "trip_segmentation_state"
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    processed_until = Column(DateTime, nullable=True)  # 已確定分段的最後一個定位點時間，之後的定位點下次重新分段
+    origin_stay_id = Column(Integer, ForeignKey('stay_points.id'), nullable=True)  # 尚未結束的行程由此停留點出發
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
@@ -9,6 +9,9 @@ from app.models.chat import ChatMessage
 from app.models.room import ChatRoom
 from app.models.user import User
 from app.services.connection_manager import connection_manager
+from app.services.gps_service import GPS_BATCH_MAX_POINTS, validate_gps_points
+from app.services.gps_ingest_buffer import gps_ingest_buffer
+from app.services.gps_filter import gps_ingest_filter
 
 # 設定 logger
 logger = logging.getLogger(__name__)
@@ -240,6 +243,49 @@ async def chat_gateway(websocket: WebSocket, db: Session = Depends(get_db)):
                         # 廣播訊息給房間內所有用戶
                         await connection_manager.broadcast_to_room(room_id, response_message)
 
+                elif msg_type == "gps":
+                    # 透過既有連線串流上傳定位點，用戶已在註冊時驗證
+                    if not current_user_id:
+                        await websocket.send_text(json.dumps({
+                            "type": "error",
+                            "message": "Please register user first before sending GPS points"
+                        }))
+                        continue
+
+                    points = data.get("points")
+                    batch_id = data.get("batchId")
+                    if not isinstance(points, list) or len(points) > GPS_BATCH_MAX_POINTS:
+                        await websocket.send_text(json.dumps({
+                            "type": "error",
+                            "message": f"points must be a list of at most {GPS_BATCH_MAX_POINTS} GPS points",
+                            "batchId": batch_id
+                        }))
+                        continue
+
+                    rows, errors = validate_gps_points(int(current_user_id), points)
+                    rows, dropped, flagged = gps_ingest_filter.apply(rows)
+                    try:
+                        await gps_ingest_buffer.submit_many(rows)
+                        gps_ingest_filter.commit(rows)
+                    except Exception as e:
+                        logger.error(f"[Connection {connection_id}] Failed to save GPS points: {e}")
+                        await websocket.send_text(json.dumps({
+                            "type": "error",
+                            "message": "Failed to save GPS points",
+                            "batchId": batch_id
+                        }))
+                        continue
+
+                    # 精簡回應：只在有錯誤時附上錯誤明細
+                    ack = {"type": "gps_ack", "batchId": batch_id, "accepted": len(rows)}
+                    if dropped:
+                        ack["dropped"] = dropped
+                    if flagged:
+                        ack["flagged"] = flagged
+                    if errors:
+                        ack["errors"] = errors
+                    await websocket.send_text(json.dumps(ack))
+
                 elif msg_type == "connect_request":
                     if not current_user_id:
                         logger.warning(f"[Connection {connection_id}] Connect request without user registration")
@@ -0,0 +1,414 @@
+from fastapi import APIRouter, Depends, HTTPException, Response
+from sqlalchemy.orm import Session
+from app.models import user
+from app.models.commute_route import CommuteRoute
+from app.database import get_db
+from app.services.commute_route_service import commute_route_service, parse_route_points, decode_route_points, encode_route_points, COMMUTE_ROUTE_MAX_POINTS
+from app.services.commute_corridor import commute_corridor_index
+from app.services.commute_matching import commute_match_index
+from app.services.commute_similarity import commute_similarity_index
+from app.services.gps_encoding import encode_polyline, decode_polyline, encode_varints
+from pydantic import BaseModel, validator
+from typing import Any, Dict, List, Optional
+from datetime import datetime, timezone
+import numpy as np
+import logging
+import os
+
+# 設定 logger
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+ROUTE_POINT_FORMATS = ("json", "polyline", "binary")
+ROUTE_STATUSES = ("active", "inactive")
+
+# 單次配對最多回傳的路線數
+COMMUTE_MATCH_MAX_LIMIT = int(os.getenv('COMMUTE_MATCH_MAX_LIMIT', '100'))
+
+class CommuteRoutePoint(BaseModel):
+    lat: float
+    lng: float
+    ts: Optional[str] = None  # ISO 8601 格式時間戳記（選填，全部提供時以頭尾時間計算通勤時間）
+
+class CommuteRouteData(BaseModel):
+    # 提供定位點時未明確提供的起訖點取第一個與最後一個定位點；修改時只更新有提供的欄位
+    route_name: Optional[str] = None
+    start_latitude: Optional[float] = None
+    start_longitude: Optional[float] = None
+    start_address: Optional[str] = None
+    end_latitude: Optional[float] = None
+    end_longitude: Optional[float] = None
+    end_address: Optional[str] = None
+    travel_time: Optional[int] = None  # 通勤時間（分鐘），定位點帶有時間時以定位點計算
+    transport_mode: Optional[str] = None
+    departure_minute: Optional[int] = None  # 典型出發時間（UTC 當日第幾分鐘）
+    is_active: Optional[str] = None
+    points: Optional[List[CommuteRoutePoint]] = None
+
+    @validator('start_latitude', 'end_latitude')
+    def validate_latitude(cls, v):
+        if v is not None and not (-90 <= v <= 90):
+            raise ValueError('緯度必須在 -90 到 90 之間')
+        return v
+
+    @validator('start_longitude', 'end_longitude')
+    def validate_longitude(cls, v):
+        if v is not None and not (-180 <= v <= 180):
+            raise ValueError('經度必須在 -180 到 180 之間')
+        return v
+
+    @validator('departure_minute')
+    def validate_departure_minute(cls, v):
+        if v is not None and not (0 <= v < 1440):
+            raise ValueError('出發時間必須在 0 到 1439 分鐘之間')
+        return v
+
+    @validator('is_active')
+    def validate_is_active(cls, v):
+        if v is not None and v not in ROUTE_STATUSES:
+            raise ValueError('is_active 必須是 active 或 inactive')
+        return v
+
+    def route_fields(self) -> Dict[str, Any]:
+        return self.dict(exclude_unset=True, exclude={"points"})
+
+    def route_points(self):
+        if self.points is None:
+            return None
+        return parse_route_points([point.dict() for point in self.points])
+
+def serialize_commute_route(route: CommuteRoute) -> Dict[str, Any]:
+    """將路線資料列轉為回應格式（不含定位點）"""
+    return {
+        "id": route.id,
+        "user_id": route.user_id,
+        "route_name": route.route_name,
+        "start_latitude": route.start_latitude,
+        "start_longitude": route.start_longitude,
+        "start_address": route.start_address,
+        "end_latitude": route.end_latitude,
+        "end_longitude": route.end_longitude,
+        "end_address": route.end_address,
+        "travel_time": route.travel_time,
+        "distance": route.distance,
+        "point_count": route.point_count,
+        "transport_mode": route.transport_mode,
+        "departure_minute": route.departure_minute,
+        "trip_count": route.trip_count,
+        "source": route.source,
+        "is_active": route.is_active,
+        "created_at": route.created_at.isoformat() if route.created_at else None,
+        "updated_at": route.updated_at.isoformat() if route.updated_at else None
+    }
+
+def get_route_or_404(db: Session, route_id: int) -> CommuteRoute:
+    route = db.query(CommuteRoute).filter(CommuteRoute.id == route_id).first()
+    if not route:
+        logger.warning(f"Commute route {route_id} not found")
+        raise HTTPException(status_code=404, detail="通勤路線不存在")
+    return route
+
+@router.post("/commute-routes")
+def create_commute_route(route_data: CommuteRouteData, user_id: int, db: Session = Depends(get_db)):
+    """建立通勤路線（定位點以二進位封裝儲存，距離與通勤時間由定位點計算）"""
+    try:
+        logger.info(f"Creating commute route for user {user_id}")
+
+        # 驗證用戶是否存在
+        db_user = db.query(user.User).filter(user.User.id == user_id).first()
+        if not db_user:
+            logger.warning(f"Commute route creation failed: User {user_id} not found")
+            raise HTTPException(status_code=404, detail="用戶不存在")
+
+        points = route_data.route_points()
+        fields = route_data.route_fields()
+        if points is not None and len(points[0]) == 0:
+            raise HTTPException(status_code=400, detail="定位點不可為空")
+        if points is None and None in (fields.get("start_latitude"), fields.get("start_longitude"), fields.get("end_latitude"), fields.get("end_longitude")):
+            raise HTTPException(status_code=400, detail="未提供定位點時必須提供起點與終點座標")
+
+        route = commute_route_service.create(db, user_id, fields, points)
+
+        logger.info(f"Created commute route {route.id} for user {user_id} ({route.point_count or 0} points)")
+
+        return {"message": "通勤路線建立成功", "route": serialize_commute_route(route)}
+
+    except ValueError as e:
+        logger.warning(f"Invalid commute route data for user {user_id}: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Commute route creation failed: {e}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail="通勤路線建立失敗")
+
+@router.get("/commute-routes")
+def list_commute_routes(user_id: int, include_inactive: bool = False, db: Session = Depends(get_db)):
+    """獲取用戶的通勤路線列表（不載入定位點）"""
+    try:
+        logger.info(f"Listing commute routes for user {user_id}")
+
+        # 驗證用戶是否存在
+        db_user = db.query(user.User).filter(user.User.id == user_id).first()
+        if not db_user:
+            logger.warning(f"Commute route list failed: User {user_id} not found")
+            raise HTTPException(status_code=404, detail="用戶不存在")
+
+        query = db.query(CommuteRoute).filter(CommuteRoute.user_id == user_id)
+        if not include_inactive:
+            query = query.filter(CommuteRoute.is_active == "active")
+        routes = query.order_by(CommuteRoute.id).all()
+
+        return {"user_id": user_id, "count": len(routes), "routes": [serialize_commute_route(r) for r in routes]}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Commute route list failed: {e}")
+        raise HTTPException(status_code=500, detail="通勤路線查詢失敗")
+
+def validate_corridor_params(radius_m: float, limit: int):
+    if not (0 < radius_m <= commute_corridor_index.max_radius_m):
+        raise HTTPException(status_code=400, detail=f"radius_m 必須介於 0 到 {commute_corridor_index.max_radius_m:g} 公尺")
+    if limit <= 0 or limit > COMMUTE_MATCH_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit 必須介於 1 到 {COMMUTE_MATCH_MAX_LIMIT}")
+
+# 以下路徑需宣告在 /commute-routes/{route_id} 之前，否則 near、similar 會被當成 route_id
+@router.get("/commute-routes/near")
+def get_commute_routes_near_point(
+    lat: float, lng: float, radius_m: float = 200, limit: int = 50, exclude_user_id: Optional[int] = None
+):
+    """路徑經過指定位置附近的通勤路線（依最短距離排序）"""
+    if not (-90 <= lat <= 90) or not (-180 <= lng <= 180):
+        raise HTTPException(status_code=400, detail="經緯度超出範圍")
+    validate_corridor_params(radius_m, limit)
+
+    try:
+        routes = commute_corridor_index.query_point(lat, lng, radius_m, limit, exclude_user_id)
+
+        logger.info(f"Found {len(routes)} commute routes within {radius_m:g}m of ({lat}, {lng})")
+
+        return {"count": len(routes), "routes": routes}
+
+    except Exception as e:
+        logger.error(f"Commute corridor query failed: {e}")
+        raise HTTPException(status_code=500, detail="通勤路線查詢失敗")
+
+@router.get("/commute-routes/near-path")
+def get_commute_routes_near_path(
+    polyline: str, radius_m: float = 200, limit: int = 50, exclude_user_id: Optional[int] = None
+):
+    """
+    路徑與指定路徑相近的通勤路線（依兩條路徑的最短距離排序）
+
+    - polyline：Google polyline 編碼的路徑（至少兩個點）
+    """
+    validate_corridor_params(radius_m, limit)
+    try:
+        coords = np.array(decode_polyline(polyline), dtype=np.float64).reshape(-1, 2)
+    except (ValueError, IndexError):
+        raise HTTPException(status_code=400, detail="polyline 格式錯誤")
+    if not (2 <= len(coords) <= COMMUTE_ROUTE_MAX_POINTS):
+        raise HTTPException(status_code=400, detail=f"polyline 必須包含 2 到 {COMMUTE_ROUTE_MAX_POINTS} 個點")
+    if np.any(np.abs(coords[:, 0]) > 90) or np.any(np.abs(coords[:, 1]) > 180):
+        raise HTTPException(status_code=400, detail="經緯度超出範圍")
+
+    try:
+        routes = commute_corridor_index.query_path(coords[:, 0], coords[:, 1], radius_m, limit, exclude_user_id)
+
+        logger.info(f"Found {len(routes)} commute routes within {radius_m:g}m of a {len(coords)}-point path")
+
+        return {"count": len(routes), "routes": routes}
+
+    except Exception as e:
+        logger.error(f"Commute corridor path query failed: {e}")
+        raise HTTPException(status_code=500, detail="通勤路線查詢失敗")
+
+@router.get("/commute-routes/similar")
+def get_similar_commute_routes(user_id: int, max_distance_m: float = 500, limit: int = 20, db: Session = Depends(get_db)):
+    """
+    找出與用戶通勤路線形狀相近的其他用戶路線（依離散 Fréchet 距離排序）
+
+    - max_distance_m：Fréchet 距離門檻（公尺），路線任一處偏離超過此距離即不列入
+    """
+    if not (0 < max_distance_m <= commute_similarity_index.max_distance_m):
+        raise HTTPException(status_code=400, detail=f"max_distance_m 必須介於 0 到 {commute_similarity_index.max_distance_m:g} 公尺")
+    if limit <= 0 or limit > COMMUTE_MATCH_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit 必須介於 1 到 {COMMUTE_MATCH_MAX_LIMIT}")
+
+    try:
+        # 驗證用戶是否存在
+        db_user = db.query(user.User).filter(user.User.id == user_id).first()
+        if not db_user:
+            logger.warning(f"Similar commute query failed: User {user_id} not found")
+            raise HTTPException(status_code=404, detail="用戶不存在")
+
+        routes = commute_similarity_index.similar_for_user(user_id, max_distance_m, limit)
+
+        logger.info(f"Found {len(routes)} similar commute routes for user {user_id}")
+
+        return {"user_id": user_id, "count": len(routes), "routes": routes}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Similar commute query failed: {e}")
+        raise HTTPException(status_code=500, detail="相似路線查詢失敗")
+
+@router.get("/commute-routes/{route_id}")
+def get_commute_route(route_id: int, format: str = "json", db: Session = Depends(get_db)):
+    """
+    獲取單一通勤路線與定位點
+
+    - format：json、polyline、binary（binary 直接回傳儲存的二進位封裝，不需解開）
+    """
+    if format not in ROUTE_POINT_FORMATS:
+        raise HTTPException(status_code=400, detail="format 必須是 json、polyline 或 binary")
+
+    try:
+        route = get_route_or_404(db, route_id)
+
+        if format == "binary":
+            if route.packed_points is not None:
+                content = route.packed_points
+            else:
+                # 舊版 JSON 定位點轉為相同格式
+                lat, lng, epoch = decode_route_points(route)
+                content = encode_route_points(lat, lng, epoch)
+            return Response(
+                content=content,
+                media_type="application/octet-stream",
+                headers={"X-Total-Locations": str(route.point_count or 0)}
+            )
+
+        response = serialize_commute_route(route)
+        lat, lng, epoch = decode_route_points(route)
+
+        if format == "polyline":
+            response["format"] = "polyline"
+            response["polyline"] = encode_polyline(lat, lng)
+            if epoch is not None:
+                response["start_ts"] = int(epoch[0])
+                response["ts_deltas"] = encode_varints(np.diff(epoch, prepend=epoch[:1]))
+            return response
+
+        response["points"] = [
+            {
+                "latitude": float(lat[i]),
+                "longitude": float(lng[i]),
+                "timestamp": datetime.fromtimestamp(int(epoch[i]), tz=timezone.utc).replace(tzinfo=None).isoformat() if epoch is not None else None
+            }
+            for i in range(len(lat))
+        ]
+        return response
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Commute route query failed: {e}")
+        raise HTTPException(status_code=500, detail="通勤路線查詢失敗")
+
+@router.put("/commute-routes/{route_id}")
+def update_commute_route(route_id: int, route_data: CommuteRouteData, db: Session = Depends(get_db)):
+    """修改通勤路線（只更新有提供的欄位；提供定位點時重新計算距離與通勤時間）"""
+    try:
+        logger.info(f"Updating commute route {route_id}")
+
+        route = get_route_or_404(db, route_id)
+        route = commute_route_service.update(db, route, route_data.route_fields(), route_data.route_points())
+
+        logger.info(f"Updated commute route {route_id}")
+
+        return {"message": "通勤路線更新成功", "route": serialize_commute_route(route)}
+
+    except ValueError as e:
+        logger.warning(f"Invalid commute route data for route {route_id}: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Commute route update failed: {e}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail="通勤路線更新失敗")
+
+@router.delete("/commute-routes/{route_id}")
+def delete_commute_route(route_id: int, db: Session = Depends(get_db)):
+    """刪除通勤路線"""
+    try:
+        logger.info(f"Deleting commute route {route_id}")
+
+        route = get_route_or_404(db, route_id)
+        commute_route_service.delete(db, route)
+
+        logger.info(f"Deleted commute route {route_id}")
+
+        return {"message": "通勤路線刪除成功", "id": route_id}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Commute route deletion failed: {e}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail="通勤路線刪除失敗")
+
+@router.get("/commute-routes/{route_id}/matches")
+def get_commute_route_matches(
+    route_id: int,
+    start_radius_m: float = 1000,
+    end_radius_m: float = 1000,
+    window_min: int = 20,
+    limit: int = 20,
+    db: Session = Depends(get_db)
+):
+    """
+    找出與指定路線相近的其他用戶路線（依相似度排序）
+
+    - start_radius_m、end_radius_m：起點、終點的搜尋半徑（公尺）
+    - window_min：出發時間相差的上限（±分鐘），路線沒有出發時間時不限時間
+    """
+    if not (0 < start_radius_m <= commute_match_index.max_radius_m and 0 < end_radius_m <= commute_match_index.max_radius_m):
+        raise HTTPException(status_code=400, detail=f"搜尋半徑必須介於 0 到 {commute_match_index.max_radius_m:g} 公尺")
+    if not (0 <= window_min <= commute_match_index.max_window_min):
+        raise HTTPException(status_code=400, detail=f"window_min 必須介於 0 到 {commute_match_index.max_window_min}")
+    if limit <= 0 or limit > COMMUTE_MATCH_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit 必須介於 1 到 {COMMUTE_MATCH_MAX_LIMIT}")
+
+    try:
+        route = get_route_or_404(db, route_id)
+        if None in (route.start_latitude, route.start_longitude, route.end_latitude, route.end_longitude):
+            raise HTTPException(status_code=400, detail="路線缺少起點或終點座標")
+
+        matches = commute_match_index.query(
+            (route.start_latitude, route.start_longitude),
+            (route.end_latitude, route.end_longitude),
+            route.departure_minute,
+            start_radius_m, end_radius_m, window_min, limit,
+            exclude_user_id=route.user_id
+        )
+
+        logger.info(f"Found {len(matches)} commute matches for route {route_id}")
+
+        return {"route_id": route_id, "count": len(matches), "matches": matches}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Commute match query failed: {e}")
+        raise HTTPException(status_code=500, detail="通勤配對查詢失敗")
+
+@router.get("/commute-match/stats")
+def get_commute_match_stats():
+    """通勤配對索引統計"""
+    return commute_match_index.get_stats()
+
+@router.get("/commute-similarity/stats")
+def get_commute_similarity_stats():
+    """通勤路線相似度索引統計"""
+    return commute_similarity_index.get_stats()
+
+@router.get("/commute-corridor/stats")
+def get_commute_corridor_stats():
+    """通勤路線走廊索引統計"""
+    return commute_corridor_index.get_stats()
@@ -1,18 +1,64 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from app.models import user
 from app.models.gps_route import GPSLocation
+from app.models.gps_rollup import GPSDailyRollup, GPSHourlyRollup
+from app.models.gps_trip import StayPoint, Trip
 from app.database import get_db
+from app.services.gps_service import GPS_BATCH_MAX_POINTS, check_gps_timestamp, parse_gps_timestamp, validate_gps_points, validate_gps_columns, insert_gps_rows
+from app.services.gps_ingest_buffer import gps_ingest_buffer
+from app.services.gps_filter import gps_ingest_filter
+from app.services.gps_track_service import query_track, query_area, stream_track, simplify_track, simplified_track_cache, encode_cursor, decode_cursor
+from app.services.gps_retention import gps_retention_service
+from app.services.gps_rollup import gps_rollup_service, summarize
+from app.services.gps_latest import latest_location_cache
+from app.services.gps_nearby import nearby_user_index
+from app.services.gps_similar_users import similar_user_index
+from app.services.gps_stats import trip_stats_calculator, trip_stats_cache
+from app.services.gps_trips import trip_segmentation_service
+from app.services.commute_derivation import commute_derivation_service
+from app.services.gps_encoding import encode_polyline, encode_varints, pack_points, to_epoch_seconds
 from pydantic import BaseModel, validator
-from typing import List, Optional
-from datetime import datetime, date
+from typing import Any, Dict, List, Optional
+from datetime import datetime, date, timedelta, timezone
+import numpy as np
+import hmac
 import logging
+import os
 
 # 設定 logger
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# 定位歷史支援的回應格式
+LOCATION_FORMATS = ("json", "polyline", "binary")
+
+# 匯出時每次從資料庫讀取的筆數
+GPS_EXPORT_CHUNK_SIZE = int(os.getenv('GPS_EXPORT_CHUNK_SIZE', '5000'))
+
+# 批次查詢最新定位時單次最多的用戶數
+GPS_LATEST_MAX_IDS = int(os.getenv('GPS_LATEST_MAX_IDS', '1000'))
+
+# 附近用戶查詢單次最多回傳的用戶數
+GPS_NEARBY_MAX_LIMIT = int(os.getenv('GPS_NEARBY_MAX_LIMIT', '200'))
+
+# 範圍框查詢的時間窗上限（小時）、回傳筆數上限與 geohash 格數上限
+GPS_AREA_MAX_HOURS = float(os.getenv('GPS_AREA_MAX_HOURS', '744'))
+GPS_AREA_MAX_LIMIT = int(os.getenv('GPS_AREA_MAX_LIMIT', '10000'))
+GPS_AREA_MAX_CELLS = int(os.getenv('GPS_AREA_MAX_CELLS', '64'))
+
+# 彙總查詢的日期範圍上限（天）
+GPS_SUMMARY_MAX_DAYS = {"day": 3660, "hour": 31}
+
+# 行程與停留點列表的回傳筆數上限
+GPS_TRIPS_MAX_LIMIT = int(os.getenv('GPS_TRIPS_MAX_LIMIT', '1000'))
+
+# 修改寫入過濾門檻所需的管理權杖（X-GPS-Admin-Token 標頭），未設定時停用修改
+GPS_ADMIN_TOKEN = os.getenv('GPS_ADMIN_TOKEN', '')
+
 class GPSLocationData(BaseModel):
     lat: float
     lng: float
@@ -30,58 +76,505 @@ class GPSLocationData(BaseModel):
             raise ValueError('經度必須在 -180 到 180 之間')
         return v
 
+    @validator('ts')
+    def validate_timestamp(cls, v):
+        try:
+            timestamp = parse_gps_timestamp(v)
+        except ValueError:
+            raise ValueError(f'時間戳記格式無效: {v}')
+        check_gps_timestamp(timestamp)
+        return v
+
+class GPSLocationBatch(BaseModel):
+    # 逐點驗證，單點錯誤不影響整批寫入
+    points: List[Dict[str, Any]]
+
+class GPSColumnarBatch(BaseModel):
+    # 平行陣列，ts 為 UTC epoch 秒；整批以向量化方式驗證
+    lat: List[float]
+    lng: List[float]
+    ts: List[float]
+
+class GPSLatestRequest(BaseModel):
+    user_ids: List[int]
+
+class GPSFilterThresholds(BaseModel):
+    # 未提供的欄位沿用部署預設值
+    min_distance_m: Optional[float] = None
+    min_interval_s: Optional[float] = None
+    keepalive_s: Optional[float] = None
+    max_speed_mps: Optional[float] = None
+
+def _user_exists(db: Session, user_id: int) -> bool:
+    try:
+        return db.query(user.User.id).filter(user.User.id == user_id).first() is not None
+    finally:
+        # 釋放連線，等待批次寫入期間不佔用連線池
+        db.close()
+
 @router.post("/gps/location")
-def record_gps_location(location_data: GPSLocationData, user_id: int, db: Session = Depends(get_db)):
-    """記錄單個 GPS 定位點"""
+async def record_gps_location(location_data: GPSLocationData, user_id: int, db: Session = Depends(get_db)):
+    """
+    記錄單個 GPS 定位點（經由寫入緩衝區批次寫入）
+
+    啟用寫入日誌時，定位點 fsync 到日誌後即回應，此時尚未寫入資料庫，回應中的 id 為 null
+    """
     try:
         logger.info(f"Recording GPS location for user {user_id}: {location_data.lat}, {location_data.lng}")
         
-        # 驗證用戶是否存在
-        db_user = db.query(user.User).filter(user.User.id == user_id).first()
-        if not db_user:
+        # 驗證用戶是否存在（同步查詢交由執行緒池，不阻塞事件迴圈）
+        if not await run_in_threadpool(_user_exists, db, user_id):
             logger.warning(f"GPS location recording failed: User {user_id} not found")
             raise HTTPException(status_code=404, detail="用戶不存在")
         
         # 解析時間戳記
-        timestamp = datetime.fromisoformat(location_data.ts.replace('Z', '+00:00'))
-        
-        # 創建 GPS 定位記錄
-        gps_location = GPSLocation(
-            user_id=user_id,
-            latitude=location_data.lat,
-            longitude=location_data.lng,
-            timestamp=timestamp
-        )
+        timestamp = parse_gps_timestamp(location_data.ts)
+        
+        row = {
+            "user_id": user_id,
+            "latitude": location_data.lat,
+            "longitude": location_data.lng,
+            "timestamp": timestamp
+        }
+        
+        # 略過靜止重複點與瞬移異常點
+        accepted, dropped, flagged = gps_ingest_filter.apply([row])
+        if not accepted:
+            logger.info(f"GPS location for user {user_id} skipped by ingest filter")
+            return {
+                "message": "GPS 定位點已略過",
+                "id": None,
+                "user_id": user_id,
+                "latitude": location_data.lat,
+                "longitude": location_data.lng,
+                "timestamp": timestamp.isoformat(),
+                "filtered": "flagged" if flagged else "dropped"
+            }
         
-        db.add(gps_location)
-        db.commit()
-        db.refresh(gps_location)
+        # 交由寫入緩衝區與其他請求合併寫入，寫入完成後取得 ID
+        location_id = await gps_ingest_buffer.submit(row)
+        gps_ingest_filter.commit(accepted)
         
         logger.info(f"Recorded GPS location for user {user_id}: {location_data.lat}, {location_data.lng}")
         
         return {
             "message": "GPS 定位記錄成功",
-            "id": gps_location.id,
+            "id": location_id,
             "user_id": user_id,
             "latitude": location_data.lat,
             "longitude": location_data.lng,
             "timestamp": timestamp.isoformat()
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"GPS location recording failed: {e}")
-        db.rollback()
         raise HTTPException(status_code=500, detail="GPS 定位記錄失敗")
 
+@router.post("/gps/locations/batch")
+def record_gps_locations_batch(batch: GPSLocationBatch, user_id: int, db: Session = Depends(get_db)):
+    """批次記錄 GPS 定位點（單次驗證用戶、單一多列 INSERT）"""
+    if len(batch.points) > GPS_BATCH_MAX_POINTS:
+        raise HTTPException(status_code=413, detail=f"單次最多上傳 {GPS_BATCH_MAX_POINTS} 個定位點")
+
+    try:
+        logger.info(f"Recording GPS batch for user {user_id}: {len(batch.points)} points")
+        
+        # 驗證用戶是否存在（整批只查一次）
+        db_user = db.query(user.User).filter(user.User.id == user_id).first()
+        if not db_user:
+            logger.warning(f"GPS batch recording failed: User {user_id} not found")
+            raise HTTPException(status_code=404, detail="用戶不存在")
+        
+        # 逐點驗證，收集錯誤
+        rows, errors = validate_gps_points(user_id, batch.points)
+        
+        # 略過靜止重複點與瞬移異常點
+        rows, dropped, flagged = gps_ingest_filter.apply(rows)
+        
+        # 單一多列 INSERT 寫入
+        ids = insert_gps_rows(db, rows)
+        gps_ingest_filter.commit(rows)
+        
+        logger.info(f"Recorded GPS batch for user {user_id}: {len(ids)} accepted, {len(errors)} rejected")
+        
+        return {
+            "message": "GPS 批次定位記錄完成",
+            "user_id": user_id,
+            "total": len(batch.points),
+            "accepted": len(ids),
+            "rejected": len(errors),
+            "dropped": dropped,
+            "flagged": flagged,
+            "ids": ids,
+            "errors": errors
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"GPS batch recording failed: {e}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail="GPS 批次定位記錄失敗")
+
+@router.post("/gps/locations/batch/columnar")
+def record_gps_locations_columnar(batch: GPSColumnarBatch, user_id: int, db: Session = Depends(get_db)):
+    """批次記錄 GPS 定位點（欄式格式，向量化驗證）"""
+    if len(batch.ts) > GPS_BATCH_MAX_POINTS:
+        raise HTTPException(status_code=413, detail=f"單次最多上傳 {GPS_BATCH_MAX_POINTS} 個定位點")
+
+    try:
+        logger.info(f"Recording columnar GPS batch for user {user_id}: {len(batch.ts)} points")
+        
+        # 驗證用戶是否存在（整批只查一次）
+        db_user = db.query(user.User).filter(user.User.id == user_id).first()
+        if not db_user:
+            logger.warning(f"Columnar GPS batch recording failed: User {user_id} not found")
+            raise HTTPException(status_code=404, detail="用戶不存在")
+        
+        # 向量化驗證整批資料
+        rows, errors = validate_gps_columns(user_id, batch.lat, batch.lng, batch.ts)
+        
+        # 略過靜止重複點與瞬移異常點
+        rows, dropped, flagged = gps_ingest_filter.apply(rows)
+        
+        # 單一多列 INSERT 寫入
+        ids = insert_gps_rows(db, rows)
+        gps_ingest_filter.commit(rows)
+        
+        logger.info(f"Recorded columnar GPS batch for user {user_id}: {len(ids)} accepted, {len(errors)} rejected")
+        
+        return {
+            "message": "GPS 批次定位記錄完成",
+            "user_id": user_id,
+            "total": len(batch.ts),
+            "accepted": len(ids),
+            "rejected": len(errors),
+            "dropped": dropped,
+            "flagged": flagged,
+            "ids": ids,
+            "errors": errors
+        }
+        
+    except ValueError as e:
+        logger.warning(f"Invalid columnar GPS batch for user {user_id}: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Columnar GPS batch recording failed: {e}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail="GPS 批次定位記錄失敗")
+
+@router.get("/gps/filter/stats")
+def get_gps_filter_stats():
+    """獲取 GPS 寫入過濾器狀態（略過與異常點數量）"""
+    return gps_ingest_filter.get_stats()
+
+@router.put("/gps/filter/{user_id}")
+def set_gps_filter_thresholds(
+    user_id: int,
+    thresholds: GPSFilterThresholds,
+    x_gps_admin_token: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """設定個別用戶的過濾門檻（需 X-GPS-Admin-Token 標頭；未設定 GPS_ADMIN_TOKEN 時停用）"""
+    if not GPS_ADMIN_TOKEN or not x_gps_admin_token or not hmac.compare_digest(x_gps_admin_token, GPS_ADMIN_TOKEN):
+        logger.warning(f"Rejected GPS ingest filter update for user {user_id}: invalid admin token")
+        raise HTTPException(status_code=403, detail="沒有權限修改過濾門檻")
+    if not db.query(user.User.id).filter(user.User.id == user_id).first():
+        raise HTTPException(status_code=404, detail="用戶不存在")
+
+    try:
+        gps_ingest_filter.set_user_thresholds(db, user_id, thresholds.dict())
+    except Exception as e:
+        logger.error(f"Failed to save GPS ingest filter thresholds for user {user_id}: {e}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail="過濾門檻儲存失敗")
+    logger.info(f"Updated GPS ingest filter thresholds for user {user_id}")
+    return {
+        "user_id": user_id,
+        "enabled": gps_ingest_filter.enabled,
+        "thresholds": gps_ingest_filter.get_thresholds(user_id)
+    }
+
+@router.get("/gps/ingest/stats")
+def get_gps_ingest_stats():
+    """獲取 GPS 寫入緩衝區狀態（佇列深度、寫入延遲）與彙總表更新統計"""
+    return {
+        **gps_ingest_buffer.get_stats(),
+        "rollup": gps_rollup_service.get_stats(),
+        "trips": trip_segmentation_service.get_stats()
+    }
+
+def serialize_latest(user_id: int, location) -> Optional[Dict[str, Any]]:
+    """將最新定位快取的項目轉為回應格式"""
+    if location is None:
+        return None
+    return {
+        "user_id": user_id,
+        "id": location[0],
+        "latitude": location[2],
+        "longitude": location[3],
+        "timestamp": location[1].isoformat()
+    }
+
+@router.get("/gps/latest/{user_id}")
+def get_latest_location(user_id: int):
+    """獲取用戶最後一個已知定位（由記憶體快取回應，不查詢資料庫）"""
+    location = latest_location_cache.get(user_id)
+    if location is None:
+        raise HTTPException(status_code=404, detail="查無此用戶的定位資料")
+    return serialize_latest(user_id, location)
+
+@router.post("/gps/latest")
+def get_latest_locations(request: GPSLatestRequest):
+    """批次獲取多位用戶最後一個已知定位，沒有定位資料的用戶為 null"""
+    if len(request.user_ids) > GPS_LATEST_MAX_IDS:
+        raise HTTPException(status_code=413, detail=f"單次最多查詢 {GPS_LATEST_MAX_IDS} 位用戶")
+
+    locations = latest_location_cache.get_many(request.user_ids)
+    return {
+        "locations": {str(user_id): serialize_latest(user_id, location) for user_id, location in locations.items()},
+        "found": sum(1 for location in locations.values() if location is not None)
+    }
+
+@router.get("/gps/latest-cache/stats")
+def get_latest_location_stats():
+    """最新定位快取統計"""
+    return latest_location_cache.get_stats()
+
+@router.get("/gps/nearby")
+def get_nearby_users(
+    lat: float,
+    lng: float,
+    radius: float = 1000,
+    limit: int = 20,
+    user_id: Optional[int] = None
+):
+    """
+    查詢附近的線上用戶（依距離由近到遠，由記憶體索引回應）
+
+    - radius：搜尋半徑（公尺）
+    - user_id：查詢者本人，不列入結果
+    """
+    if not (-90 <= lat <= 90):
+        raise HTTPException(status_code=400, detail="緯度必須在 -90 到 90 之間")
+    if not (-180 <= lng <= 180):
+        raise HTTPException(status_code=400, detail="經度必須在 -180 到 180 之間")
+    if not (0 < radius <= nearby_user_index.max_radius_m):
+        raise HTTPException(status_code=400, detail=f"radius 必須介於 0 到 {nearby_user_index.max_radius_m:g} 公尺之間")
+    if not (0 < limit <= GPS_NEARBY_MAX_LIMIT):
+        raise HTTPException(status_code=400, detail=f"limit 必須介於 1 到 {GPS_NEARBY_MAX_LIMIT} 之間")
+
+    users = nearby_user_index.query(lat, lng, radius, limit, exclude_user_id=user_id)
+    return {
+        "center": {"latitude": lat, "longitude": lng},
+        "radius_m": radius,
+        "count": len(users),
+        "users": users
+    }
+
+@router.get("/gps/nearby/stats")
+def get_nearby_index_stats():
+    """附近用戶索引統計"""
+    return nearby_user_index.get_stats()
+
+@router.get("/gps/similar-users")
+def get_similar_users(user_id: int, limit: int = 20, min_similarity: float = 0.1, db: Session = Depends(get_db)):
+    """
+    移動範圍相似的用戶（近期行程與通勤路線經過的網格，依估計的 Jaccard 相似度排序）
+
+    - min_similarity：相似度下限（0 到 1）
+    """
+    if not (0 < limit <= GPS_NEARBY_MAX_LIMIT):
+        raise HTTPException(status_code=400, detail=f"limit 必須介於 1 到 {GPS_NEARBY_MAX_LIMIT} 之間")
+    if not (0 <= min_similarity <= 1):
+        raise HTTPException(status_code=400, detail="min_similarity 必須介於 0 到 1 之間")
+
+    try:
+        # 驗證用戶是否存在
+        db_user = db.query(user.User).filter(user.User.id == user_id).first()
+        if not db_user:
+            logger.warning(f"Similar user query failed: User {user_id} not found")
+            raise HTTPException(status_code=404, detail="用戶不存在")
+
+        # 尚未計算簽章的用戶由背景工作計算，不在請求中計算；計算完成前回傳空列表
+        status = similar_user_index.status(user_id) if similar_user_index.enabled else "disabled"
+        users = similar_user_index.query(user_id, limit, min_similarity) if status == "ready" else []
+
+        logger.info(f"Found {len(users)} similar users for user {user_id} (status={status})")
+
+        return {
+            "user_id": user_id,
+            "status": status,
+            "indexed": status == "ready",
+            "count": len(users),
+            "users": users
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Similar user query failed: {e}")
+        raise HTTPException(status_code=500, detail="相似用戶查詢失敗")
+
+@router.get("/gps/similar-users/stats")
+def get_similar_user_stats():
+    """相似用戶索引統計"""
+    return similar_user_index.get_stats()
+
+@router.get("/gps/area")
+def get_locations_in_area(
+    min_lat: float,
+    min_lng: float,
+    max_lat: float,
+    max_lng: float,
+    start: str,
+    end: str,
+    limit: int = 1000,
+    db: Session = Depends(get_db)
+):
+    """
+    查詢範圍框與時間窗內所有用戶的定位（分析與客服用，只查詢資料庫中的熱資料）
+
+    - start、end：ISO 8601 時間（UTC）
+    """
+    if not (-90 <= min_lat <= max_lat <= 90):
+        raise HTTPException(status_code=400, detail="緯度範圍無效")
+    if not (-180 <= min_lng <= max_lng <= 180):
+        raise HTTPException(status_code=400, detail="經度範圍無效（不支援跨越 180 度經線）")
+    if not (0 < limit <= GPS_AREA_MAX_LIMIT):
+        raise HTTPException(status_code=400, detail=f"limit 必須介於 1 到 {GPS_AREA_MAX_LIMIT} 之間")
+
+    try:
+        start_datetime = parse_gps_timestamp(start)
+        end_datetime = parse_gps_timestamp(end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="時間格式無效，請使用 ISO 8601 格式")
+    if start_datetime.tzinfo is not None:
+        start_datetime = start_datetime.astimezone(timezone.utc).replace(tzinfo=None)
+    if end_datetime.tzinfo is not None:
+        end_datetime = end_datetime.astimezone(timezone.utc).replace(tzinfo=None)
+    if start_datetime > end_datetime:
+        raise HTTPException(status_code=400, detail="start 不可晚於 end")
+    if (end_datetime - start_datetime).total_seconds() > GPS_AREA_MAX_HOURS * 3600:
+        raise HTTPException(status_code=400, detail=f"時間窗不可超過 {GPS_AREA_MAX_HOURS:g} 小時")
+
+    try:
+        logger.info(f"Querying GPS locations in area ({min_lat}, {min_lng}) - ({max_lat}, {max_lng}) from {start} to {end}")
+        
+        precision, range_count, rows = query_area(
+            db, min_lat, min_lng, max_lat, max_lng, start_datetime, end_datetime, limit, GPS_AREA_MAX_CELLS
+        )
+        
+        logger.info(f"Retrieved {len(rows)} GPS locations in area using {range_count} geohash ranges")
+        
+        return {
+            "bbox": {"min_lat": min_lat, "min_lng": min_lng, "max_lat": max_lat, "max_lng": max_lng},
+            "start": start_datetime.isoformat(),
+            "end": end_datetime.isoformat(),
+            "geohash_precision": precision,
+            "cell_ranges": range_count,
+            "count": len(rows),
+            "truncated": len(rows) == limit,
+            "locations": [
+                {
+                    "id": row[0],
+                    "user_id": row[1],
+                    "latitude": row[3],
+                    "longitude": row[4],
+                    "timestamp": row[2].isoformat()
+                }
+                for row in rows
+            ]
+        }
+        
+    except Exception as e:
+        logger.error(f"GPS area query failed: {e}")
+        raise HTTPException(status_code=500, detail="GPS 範圍查詢失敗")
+
+def serialize_locations(locations) -> List[Dict[str, Any]]:
+    """將 (id, timestamp, latitude, longitude) 資料列轉為回應格式"""
+    return [
+        {
+            "id": location_id,
+            "latitude": latitude,
+            "longitude": longitude,
+            "timestamp": timestamp.isoformat()
+        }
+        for location_id, timestamp, latitude, longitude in locations
+    ]
+
+def build_locations_response(response: Dict[str, Any], locations, format: str):
+    """
+    依 format 產生定位歷史回應
+
+    - json：逐點物件
+    - polyline：座標以 Google polyline 編碼，時間以相同演算法編碼與第一點相差的秒數
+    - binary：int32 微度 + 差分秒數的二進位封裝（格式見 gps_encoding）
+    """
+    if format == "json":
+        result = serialize_locations(locations)
+        response["total_locations"] = len(result)
+        response["locations"] = result
+        return response
+
+    lat = np.fromiter((row[2] for row in locations), dtype=np.float64, count=len(locations))
+    lng = np.fromiter((row[3] for row in locations), dtype=np.float64, count=len(locations))
+    epoch_seconds = to_epoch_seconds([row[1] for row in locations])
+
+    if format == "binary":
+        headers = {"X-Total-Locations": str(len(locations))}
+        if response.get("next_cursor"):
+            headers["X-Next-Cursor"] = response["next_cursor"]
+        return Response(
+            content=pack_points(lat, lng, epoch_seconds),
+            media_type="application/octet-stream",
+            headers=headers
+        )
+
+    response["format"] = "polyline"
+    response["total_locations"] = len(locations)
+    response["start_ts"] = int(epoch_seconds[0]) if len(locations) else None
+    response["polyline"] = encode_polyline(lat, lng)
+    response["ts_deltas"] = encode_varints(np.diff(epoch_seconds, prepend=epoch_seconds[:1]))
+    return response
+
 @router.get("/gps/locations/{user_id}")
 def get_user_locations(
     user_id: int, 
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     limit: int = 1000,
+    simplify: Optional[float] = None,
+    format: str = "json",
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
-    """獲取用戶的 GPS 定位歷史"""
+    """
+    獲取用戶的 GPS 定位歷史（新到舊）
+
+    - simplify：軌跡簡化容許誤差，單位公尺
+    - format：json、polyline、binary
+    - cursor：上一頁回傳的 next_cursor，以 (timestamp, id) 做 keyset 分頁
+    """
+    if simplify is not None and simplify <= 0:
+        raise HTTPException(status_code=400, detail="simplify 必須大於 0")
+    if format not in LOCATION_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format 必須是 {', '.join(LOCATION_FORMATS)} 之一")
+    if limit <= 0:
+        raise HTTPException(status_code=400, detail="limit 必須大於 0")
+
+    after = None
+    if cursor:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError:
+            logger.warning(f"Invalid pagination cursor in GPS query for user {user_id}")
+            raise HTTPException(status_code=400, detail="cursor 無效")
+
     try:
         logger.info(f"Getting GPS locations for user {user_id}, limit: {limit}")
         
@@ -91,37 +584,30 @@ def get_user_locations(
             logger.warning(f"GPS locations request failed: User {user_id} not found")
             raise HTTPException(status_code=404, detail="用戶不存在")
         
-        # 基本查詢
-        query = db.query(GPSLocation).filter(GPSLocation.user_id == user_id)
-        
         # 日期篩選
+        start_datetime = None
+        end_datetime = None
         if start_date:
             start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
-            query = query.filter(GPSLocation.timestamp >= start_datetime)
         
         if end_date:
             end_datetime = datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S') if ' ' in end_date else datetime.strptime(end_date + ' 23:59:59', '%Y-%m-%d %H:%M:%S')
-            query = query.filter(GPSLocation.timestamp <= end_datetime)
         
-        # 按時間排序並限制數量
-        locations = query.order_by(GPSLocation.timestamp.desc()).limit(limit).all()
+        # 按時間排序並限制數量（只讀取需要的欄位）
+        locations = query_track(db, user_id, start_datetime, end_datetime, descending=True, limit=limit, after=after)
         
         logger.info(f"Retrieved {len(locations)} GPS locations for user {user_id}")
         
-        result = []
-        for location in locations:
-            result.append({
-                "id": location.id,
-                "latitude": location.latitude,
-                "longitude": location.longitude,
-                "timestamp": location.timestamp.isoformat()
-            })
+        # 取滿一頁才可能還有下一頁；游標以簡化前的最後一筆為準
+        response = {"user_id": user_id}
+        response["next_cursor"] = encode_cursor(locations[-1][1], locations[-1][0]) if len(locations) == limit else None
+        if simplify:
+            # 簡化需依時間正序處理，回應維持新到舊
+            response["original_locations"] = len(locations)
+            response["simplify_tolerance_m"] = simplify
+            locations = simplify_track(locations[::-1], simplify)[::-1]
         
-        return {
-            "user_id": user_id,
-            "total_locations": len(result),
-            "locations": result
-        }
+        return build_locations_response(response, locations, format)
         
     except ValueError:
         logger.warning(f"Invalid date format in GPS query for user {user_id}")
@@ -132,9 +618,156 @@ def get_user_locations(
         logger.error(f"GPS locations query failed: {e}")
         raise HTTPException(status_code=500, detail="GPS 定位查詢失敗")
 
+@router.get("/gps/locations/{user_id}/export")
+def export_user_locations(
+    user_id: int,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    format: str = "ndjson",
+    db: Session = Depends(get_db)
+):
+    """串流匯出用戶的 GPS 定位歷史（format：ndjson 或 csv）"""
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format 必須是 ndjson 或 csv")
+
+    try:
+        logger.info(f"Exporting GPS locations for user {user_id} as {format}")
+        
+        # 驗證用戶是否存在
+        db_user = db.query(user.User).filter(user.User.id == user_id).first()
+        if not db_user:
+            logger.warning(f"GPS export failed: User {user_id} not found")
+            raise HTTPException(status_code=404, detail="用戶不存在")
+        
+        # 日期篩選
+        start_datetime = None
+        end_datetime = None
+        if start_date:
+            start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
+        
+        if end_date:
+            end_datetime = datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S') if ' ' in end_date else datetime.strptime(end_date + ' 23:59:59', '%Y-%m-%d %H:%M:%S')
+        
+    except ValueError:
+        logger.warning(f"Invalid date format in GPS export for user {user_id}")
+        raise HTTPException(status_code=400, detail="日期格式無效，請使用 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS 格式")
+
+    def generate():
+        # 逐批轉換輸出，不建立中間列表
+        if format == "csv":
+            yield "id,timestamp,latitude,longitude\n"
+        for chunk in stream_track(user_id, start_datetime, end_datetime, GPS_EXPORT_CHUNK_SIZE):
+            if format == "csv":
+                yield "".join(f"{row[0]},{row[1].isoformat()},{row[2]},{row[3]}\n" for row in chunk)
+            else:
+                yield "".join(
+                    f'{{"id":{row[0]},"timestamp":"{row[1].isoformat()}","latitude":{row[2]},"longitude":{row[3]}}}\n'
+                    for row in chunk
+                )
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    extension = "csv" if format == "csv" else "ndjson"
+    return StreamingResponse(
+        generate(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="gps_locations_{user_id}.{extension}"'}
+    )
+
+@router.get("/gps/locations/{user_id}/summary")
+def get_user_location_summary(
+    user_id: int,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    granularity: str = "day",
+    db: Session = Depends(get_db)
+):
+    """
+    由彙總表查詢用戶的活動摘要（定位點數、移動距離、活動時間、範圍框）
+
+    - granularity：day（預設最近 30 天）或 hour（最多 31 天），日期以 UTC 計
+    """
+    if granularity not in GPS_SUMMARY_MAX_DAYS:
+        raise HTTPException(status_code=400, detail="granularity 必須是 day 或 hour")
+
+    try:
+        logger.info(f"Getting GPS summary for user {user_id} by {granularity}")
+        
+        # 驗證用戶是否存在
+        db_user = db.query(user.User).filter(user.User.id == user_id).first()
+        if not db_user:
+            logger.warning(f"GPS summary request failed: User {user_id} not found")
+            raise HTTPException(status_code=404, detail="用戶不存在")
+        
+        end_day = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else date.today()
+        start_day = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else end_day - timedelta(days=29)
+        if start_day > end_day:
+            raise HTTPException(status_code=400, detail="start_date 不可晚於 end_date")
+        if (end_day - start_day).days + 1 > GPS_SUMMARY_MAX_DAYS[granularity]:
+            raise HTTPException(status_code=400, detail=f"日期範圍不可超過 {GPS_SUMMARY_MAX_DAYS[granularity]} 天")
+        
+        if granularity == "day":
+            rollups = db.query(GPSDailyRollup).filter(
+                GPSDailyRollup.user_id == user_id,
+                GPSDailyRollup.day >= start_day,
+                GPSDailyRollup.day <= end_day
+            ).order_by(GPSDailyRollup.day).all()
+            buckets = [{"day": r.day.isoformat(), **serialize_rollup(r)} for r in rollups]
+        else:
+            rollups = db.query(GPSHourlyRollup).filter(
+                GPSHourlyRollup.user_id == user_id,
+                GPSHourlyRollup.hour >= datetime.combine(start_day, datetime.min.time()),
+                GPSHourlyRollup.hour < datetime.combine(end_day + timedelta(days=1), datetime.min.time())
+            ).order_by(GPSHourlyRollup.hour).all()
+            buckets = [{"hour": r.hour.isoformat(), **serialize_rollup(r)} for r in rollups]
+        
+        return {
+            "user_id": user_id,
+            "granularity": granularity,
+            "start_date": start_day.isoformat(),
+            "end_date": end_day.isoformat(),
+            "totals": {**summarize(rollups), "active_days": len({b.get("day") or b["hour"][:10] for b in buckets})},
+            "buckets": buckets
+        }
+        
+    except ValueError:
+        logger.warning(f"Invalid date format in GPS summary for user {user_id}")
+        raise HTTPException(status_code=400, detail="日期格式無效，請使用 YYYY-MM-DD 格式")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"GPS summary query failed: {e}")
+        raise HTTPException(status_code=500, detail="GPS 活動摘要查詢失敗")
+
+def serialize_rollup(rollup) -> Dict[str, Any]:
+    """將彙總資料列轉為回應格式"""
+    return {
+        "point_count": rollup.point_count,
+        "distance_m": round(rollup.distance_m, 1),
+        "active_seconds": round(rollup.active_seconds, 1),
+        "bounding_box": {
+            "min_latitude": rollup.min_latitude,
+            "max_latitude": rollup.max_latitude,
+            "min_longitude": rollup.min_longitude,
+            "max_longitude": rollup.max_longitude
+        },
+        "first_timestamp": rollup.first_timestamp.isoformat(),
+        "last_timestamp": rollup.last_timestamp.isoformat()
+    }
+
 @router.get("/gps/locations/{user_id}/date/{date}")
-def get_user_locations_by_date(user_id: int, date: str, db: Session = Depends(get_db)):
-    """獲取用戶指定日期的所有 GPS 定位"""
+def get_user_locations_by_date(
+    user_id: int,
+    date: str,
+    simplify: Optional[float] = None,
+    format: str = "json",
+    db: Session = Depends(get_db)
+):
+    """獲取用戶指定日期的所有 GPS 定位（simplify：軌跡簡化容許誤差，單位公尺；format：json、polyline、binary）"""
+    if simplify is not None and simplify <= 0:
+        raise HTTPException(status_code=400, detail="simplify 必須大於 0")
+    if format not in LOCATION_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format 必須是 {', '.join(LOCATION_FORMATS)} 之一")
+
     try:
         logger.info(f"Getting GPS locations for user {user_id} on date {date}")
         
@@ -149,30 +782,28 @@ def get_user_locations_by_date(user_id: int, date: str, db: Session = Depends(ge
         start_datetime = datetime.combine(target_date, datetime.min.time())
         end_datetime = datetime.combine(target_date, datetime.max.time())
         
-        # 查詢當天的所有定位記錄
-        locations = db.query(GPSLocation).filter(
-            GPSLocation.user_id == user_id,
-            GPSLocation.timestamp >= start_datetime,
-            GPSLocation.timestamp <= end_datetime
-        ).order_by(GPSLocation.timestamp).all()
+        response = {"user_id": user_id, "date": date}
         
-        logger.info(f"Retrieved {len(locations)} GPS locations for user {user_id} on date {date}")
+        if simplify:
+            # 過去日期的簡化軌跡不會再變動，直接使用快取
+            cached = simplified_track_cache.get(user_id, target_date, simplify)
+            if cached is not None:
+                logger.info(f"Simplified GPS track cache hit for user {user_id} on date {date}")
+                original_count, locations = cached
+            else:
+                locations = query_track(db, user_id, start_datetime, end_datetime)
+                original_count = len(locations)
+                locations = simplify_track(locations, simplify)
+                simplified_track_cache.put(user_id, target_date, simplify, (original_count, locations))
+            response["original_locations"] = original_count
+            response["simplify_tolerance_m"] = simplify
+        else:
+            # 查詢當天的所有定位記錄
+            locations = query_track(db, user_id, start_datetime, end_datetime)
         
-        result = []
-        for location in locations:
-            result.append({
-                "id": location.id,
-                "latitude": location.latitude,
-                "longitude": location.longitude,
-                "timestamp": location.timestamp.isoformat()
-            })
+        logger.info(f"Retrieved {len(locations)} GPS locations for user {user_id} on date {date}")
         
-        return {
-            "user_id": user_id,
-            "date": date,
-            "total_locations": len(result),
-            "locations": result
-        }
+        return build_locations_response(response, locations, format)
         
     except ValueError:
         logger.warning(f"Invalid date format in GPS query by date for user {user_id}: {date}")
@@ -183,14 +814,49 @@ def get_user_locations_by_date(user_id: int, date: str, db: Session = Depends(ge
         logger.error(f"GPS locations by date query failed: {e}")
         raise HTTPException(status_code=500, detail="GPS 定位查詢失敗")
 
-@router.delete("/gps/locations/{user_id}")
+@router.get("/gps/locations/{user_id}/date/{date}/stats")
+def get_user_trip_stats(user_id: int, date: str, db: Session = Depends(get_db)):
+    """計算用戶指定日期的行程統計（距離、速度、移動與停留時間、速度分布），過去日期的結果會快取"""
+    try:
+        logger.info(f"Getting GPS trip stats for user {user_id} on date {date}")
+        
+        # 驗證用戶是否存在
+        db_user = db.query(user.User).filter(user.User.id == user_id).first()
+        if not db_user:
+            logger.warning(f"GPS trip stats request failed: User {user_id} not found")
+            raise HTTPException(status_code=404, detail="用戶不存在")
+        
+        target_date = datetime.strptime(date, '%Y-%m-%d').date()
+        
+        stats = trip_stats_cache.get(user_id, target_date)
+        cached = stats is not None
+        if not cached:
+            start_datetime = datetime.combine(target_date, datetime.min.time())
+            end_datetime = datetime.combine(target_date, datetime.max.time())
+            stats = trip_stats_calculator.compute(query_track(db, user_id, start_datetime, end_datetime))
+            trip_stats_cache.put(user_id, target_date, stats)
+        
+        logger.info(f"Computed GPS trip stats for user {user_id} on date {date} ({stats['point_count']} points, cached={cached})")
+        
+        return {"user_id": user_id, "date": date, "cached": cached, **stats}
+        
+    except ValueError:
+        logger.warning(f"Invalid date format in GPS trip stats for user {user_id}: {date}")
+        raise HTTPException(status_code=400, detail="日期格式無效，請使用 YYYY-MM-DD 格式")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"GPS trip stats query failed: {e}")
+        raise HTTPException(status_code=500, detail="GPS 行程統計失敗")
+
+@router.delete("/gps/locations/{user_id}", status_code=202)
 def delete_user_locations(
     user_id: int,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
-    """刪除用戶的 GPS 定位記錄"""
+    """刪除用戶的 GPS 定位記錄（背景分批刪除，以 job_id 查詢進度）"""
     try:
         logger.info(f"Deleting GPS locations for user {user_id}")
         
@@ -200,30 +866,22 @@ def delete_user_locations(
             logger.warning(f"GPS deletion failed: User {user_id} not found")
             raise HTTPException(status_code=404, detail="用戶不存在")
         
-        # 基本查詢
-        query = db.query(GPSLocation).filter(GPSLocation.user_id == user_id)
-        
         # 日期篩選
+        start_datetime = None
+        end_datetime = None
         if start_date:
             start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
-            query = query.filter(GPSLocation.timestamp >= start_datetime)
         
         if end_date:
             end_datetime = datetime.strptime(end_date + ' 23:59:59', '%Y-%m-%d %H:%M:%S')
-            query = query.filter(GPSLocation.timestamp <= end_datetime)
         
-        # 計算要刪除的記錄數
-        delete_count = query.count()
+        job = gps_retention_service.submit_delete(user_id, start_datetime, end_datetime)
         
-        # 執行刪除
-        query.delete()
-        db.commit()
-        
-        logger.info(f"Deleted {delete_count} GPS locations for user {user_id}")
+        logger.info(f"Submitted GPS deletion job {job['job_id']} for user {user_id}")
         
         return {
-            "message": "GPS 定位記錄刪除成功",
-            "deleted_count": delete_count
+            "message": "GPS 定位記錄刪除中",
+            **job
         }
         
     except ValueError:
@@ -233,8 +891,142 @@ def delete_user_locations(
         raise
     except Exception as e:
         logger.error(f"GPS locations deletion failed: {e}")
-        db.rollback()
         raise HTTPException(status_code=500, detail="GPS 定位記錄刪除失敗")
 
+@router.get("/gps/delete-jobs/{job_id}")
+def get_delete_job(job_id: str):
+    """查詢 GPS 定位刪除工作的進度"""
+    job = gps_retention_service.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="刪除工作不存在")
+    return job
+
+def serialize_trip(trip: Trip) -> Dict[str, Any]:
+    """將行程資料列轉為回應格式"""
+    return {
+        "id": trip.id,
+        "origin_stay_id": trip.origin_stay_id,
+        "destination_stay_id": trip.destination_stay_id,
+        "start_time": trip.start_time.isoformat(),
+        "end_time": trip.end_time.isoformat(),
+        "duration_s": (trip.end_time - trip.start_time).total_seconds(),
+        "start_latitude": trip.start_latitude,
+        "start_longitude": trip.start_longitude,
+        "end_latitude": trip.end_latitude,
+        "end_longitude": trip.end_longitude,
+        "distance_m": round(trip.distance_m, 1),
+        "point_count": trip.point_count
+    }
+
+def serialize_stay(stay: StayPoint) -> Dict[str, Any]:
+    """將停留點資料列轉為回應格式"""
+    return {
+        "id": stay.id,
+        "arrival_time": stay.arrival_time.isoformat(),
+        "departure_time": stay.departure_time.isoformat(),
+        "duration_s": (stay.departure_time - stay.arrival_time).total_seconds(),
+        "latitude": stay.latitude,
+        "longitude": stay.longitude,
+        "point_count": stay.point_count
+    }
+
+def _segment_query_range(start_date: Optional[str], end_date: Optional[str], limit: int):
+    """解析行程與停留點列表的日期範圍（預設最近 30 天），回傳起訖時間"""
+    if limit <= 0 or limit > GPS_TRIPS_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit 必須介於 1 到 {GPS_TRIPS_MAX_LIMIT}")
+    end_day = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else date.today()
+    start_day = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else end_day - timedelta(days=29)
+    if start_day > end_day:
+        raise HTTPException(status_code=400, detail="start_date 不可晚於 end_date")
+    return datetime.combine(start_day, datetime.min.time()), datetime.combine(end_day + timedelta(days=1), datetime.min.time())
+
+@router.get("/gps/locations/{user_id}/trips")
+def get_user_trips(
+    user_id: int,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    limit: int = 100,
+    db: Session = Depends(get_db)
+):
+    """獲取用戶的行程列表（依出發時間由新到舊，日期以 UTC 計，預設最近 30 天）"""
+    try:
+        logger.info(f"Getting trips for user {user_id}")
+        
+        # 驗證用戶是否存在
+        db_user = db.query(user.User).filter(user.User.id == user_id).first()
+        if not db_user:
+            logger.warning(f"Trip list request failed: User {user_id} not found")
+            raise HTTPException(status_code=404, detail="用戶不存在")
+        
+        start, end = _segment_query_range(start_date, end_date, limit)
+        
+        # 分段由背景工作負責，只回傳已分段的行程
+        trips = db.query(Trip).filter(
+            Trip.user_id == user_id, Trip.start_time >= start, Trip.start_time < end
+        ).order_by(Trip.start_time.desc()).limit(limit).all()
+        
+        return {
+            "user_id": user_id,
+            "count": len(trips),
+            "segmentation_pending": trip_segmentation_service.is_pending(user_id),
+            "trips": [serialize_trip(t) for t in trips]
+        }
+        
+    except ValueError:
+        logger.warning(f"Invalid date format in trip list for user {user_id}")
+        raise HTTPException(status_code=400, detail="日期格式無效，請使用 YYYY-MM-DD 格式")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Trip list query failed: {e}")
+        raise HTTPException(status_code=500, detail="行程查詢失敗")
+
+@router.get("/gps/locations/{user_id}/stays")
+def get_user_stays(
+    user_id: int,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    limit: int = 100,
+    db: Session = Depends(get_db)
+):
+    """獲取用戶的停留點列表（依抵達時間由新到舊，日期以 UTC 計，預設最近 30 天）"""
+    try:
+        logger.info(f"Getting stay points for user {user_id}")
+        
+        # 驗證用戶是否存在
+        db_user = db.query(user.User).filter(user.User.id == user_id).first()
+        if not db_user:
+            logger.warning(f"Stay point list request failed: User {user_id} not found")
+            raise HTTPException(status_code=404, detail="用戶不存在")
+        
+        start, end = _segment_query_range(start_date, end_date, limit)
+        
+        stays = db.query(StayPoint).filter(
+            StayPoint.user_id == user_id, StayPoint.arrival_time >= start, StayPoint.arrival_time < end
+        ).order_by(StayPoint.arrival_time.desc()).limit(limit).all()
+        
+        return {
+            "user_id": user_id,
+            "count": len(stays),
+            "segmentation_pending": trip_segmentation_service.is_pending(user_id),
+            "stays": [serialize_stay(s) for s in stays]
+        }
+        
+    except ValueError:
+        logger.warning(f"Invalid date format in stay point list for user {user_id}")
+        raise HTTPException(status_code=400, detail="日期格式無效，請使用 YYYY-MM-DD 格式")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Stay point list query failed: {e}")
+        raise HTTPException(status_code=500, detail="停留點查詢失敗")
 
+@router.get("/gps/retention/stats")
+def get_gps_retention_stats():
+    """GPS 資料保留與刪除工作統計"""
+    return gps_retention_service.get_stats()
 
+@router.get("/gps/commute-derivation/stats")
+def get_commute_derivation_stats():
+    """通勤路線偵測工作統計"""
+    return commute_derivation_service.get_stats()
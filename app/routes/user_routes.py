@@ -6,6 +6,7 @@ from app.models.user_status import UserStatus
 from app.models.hobby import Hobby
 from app.database import get_db
 from app.services.avatar_service import cloud_avatar_service
+from app.services.gps_nearby import nearby_user_index
 from pydantic import BaseModel, EmailStr, validator
 from typing import List, Optional
 from datetime import datetime, date
@@ -374,6 +375,7 @@ def login_user(login_data: UserLogin, db: Session = Depends(get_db)):
             )
             db.add(user_status)
         db.commit()
+        nearby_user_index.set_online(db_user.id, True)
         
         logger.info(f"Login successful for user ID: {db_user.id}, email: {login_data.email}")
         
@@ -0,0 +1,346 @@
+"""
+通勤路線走廊索引 - 查詢路徑經過某個位置或某條路徑附近的通勤路線
+
+每條使用中路線的路段切成不超過網格邊長的小段，登記在經過的網格中（網格 → 路線）。
+查詢時由查詢範圍涵蓋的網格取出候選路線，再以 numpy 計算點到線段、線段到線段的最短距離。
+路線經由 API 變更時即時更新，其他程序寫入的路線由定期同步載入（只重新載入有更新的路線）。
+"""
+
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from sqlalchemy import func, select
+from app.database import SessionLocal
+from app.models.commute_route import CommuteRoute
+from app.services.commute_route_service import commute_route_service, decode_route_points
+from app.services.geo_utils import haversine_m_np
+
+logger = logging.getLogger(__name__)
+
+METERS_PER_DEGREE = 111320.0
+
+Cell = Tuple[int, int]
+
+
+def split_segments(lat: np.ndarray, lng: np.ndarray, max_length_m: float) -> np.ndarray:
+    """將折線切成長度不超過 max_length_m 的線段，回傳 (n, 4) 的 [lat1, lng1, lat2, lng2]"""
+    lengths = haversine_m_np(lat[:-1], lng[:-1], lat[1:], lng[1:])
+    pieces = np.maximum(np.ceil(lengths / max_length_m), 1).astype(np.int64)
+    segment = np.repeat(np.arange(len(lengths)), pieces)
+    step = np.arange(len(segment)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    t0 = step / pieces[segment]
+    t1 = (step + 1) / pieces[segment]
+    dlat = lat[segment + 1] - lat[segment]
+    dlng = lng[segment + 1] - lng[segment]
+    return np.column_stack([
+        lat[segment] + t0 * dlat, lng[segment] + t0 * dlng,
+        lat[segment] + t1 * dlat, lng[segment] + t1 * dlng
+    ])
+
+
+def _point_segment_distance(p: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """平面座標中點 p 到線段 ab 的距離（各參數為 (n, 2)，支援 broadcasting）"""
+    ab = b - a
+    length_sq = (ab ** 2).sum(axis=-1)
+    t = np.clip(((p - a) * ab).sum(axis=-1) / np.where(length_sq > 0, length_sq, 1), 0, 1)
+    return np.sqrt(((a + t[..., None] * ab - p) ** 2).sum(axis=-1))
+
+
+def _segment_distance(a1: np.ndarray, a2: np.ndarray, b1: np.ndarray, b2: np.ndarray) -> np.ndarray:
+    """平面座標中線段 a1a2 與 b1b2 的最短距離；相交時為 0"""
+    def cross(o, p, q):
+        return (p[:, 0] - o[:, 0]) * (q[:, 1] - o[:, 1]) - (p[:, 1] - o[:, 1]) * (q[:, 0] - o[:, 0])
+
+    intersects = (np.sign(cross(a1, a2, b1)) * np.sign(cross(a1, a2, b2)) < 0) & \
+                 (np.sign(cross(b1, b2, a1)) * np.sign(cross(b1, b2, a2)) < 0)
+    distance = np.minimum(
+        np.minimum(_point_segment_distance(a1, b1, b2), _point_segment_distance(a2, b1, b2)),
+        np.minimum(_point_segment_distance(b1, a1, a2), _point_segment_distance(b2, a1, a2))
+    )
+    return np.where(intersects, 0.0, distance)
+
+
+class CommuteCorridorIndex:
+    """使用中通勤路線路段的網格索引"""
+
+    def __init__(self):
+        self.cell_m = float(os.getenv('COMMUTE_CORRIDOR_CELL_M', '500'))                # 網格邊長，路段也切成不超過此長度
+        self.max_radius_m = float(os.getenv('COMMUTE_CORRIDOR_MAX_RADIUS_M', '5000'))   # 查詢半徑上限
+        self.refresh_s = float(os.getenv('COMMUTE_CORRIDOR_REFRESH_S', '300'))          # 與資料庫同步的間隔
+        self.cell_deg = self.cell_m / METERS_PER_DEGREE
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._reset()
+
+        # 統計資料
+        self.queries = 0
+        self.last_query_ms = 0.0
+        self.last_candidates = 0
+        self.last_sync_ms = 0.0
+
+        commute_route_service.add_listener(self.on_route)
+
+    def _reset(self):
+        self._cells: Dict[Cell, Set[int]] = {}                # {網格: route_ids}
+        self._route_segments: Dict[int, np.ndarray] = {}      # {route_id: (n, 4) 線段}
+        self._route_cells: Dict[int, List[Cell]] = {}
+        self._route_users: Dict[int, int] = {}
+        self._versions: Dict[int, Any] = {}                   # {route_id: 最後更新時間}
+        self._segment_count = 0
+
+    def _cell_range(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> Iterable[Cell]:
+        for i in range(math.floor(min_lat / self.cell_deg), math.floor(max_lat / self.cell_deg) + 1):
+            for j in range(math.floor(min_lng / self.cell_deg), math.floor(max_lng / self.cell_deg) + 1):
+                yield (i, j)
+
+    def _remove(self, route_id: int):
+        """呼叫端需持有 _lock"""
+        self._versions.pop(route_id, None)
+        self._route_users.pop(route_id, None)
+        segments = self._route_segments.pop(route_id, None)
+        if segments is not None:
+            self._segment_count -= len(segments)
+        for cell in self._route_cells.pop(route_id, ()):
+            members = self._cells.get(cell)
+            if members is not None:
+                members.discard(route_id)
+                if not members:
+                    del self._cells[cell]
+
+    def _cell_index(self, lat: np.ndarray, lng: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return np.floor(lat / self.cell_deg).astype(np.int64), np.floor(lng / self.cell_deg).astype(np.int64)
+
+    def _put(self, route_id: int, user_id: int, lat: np.ndarray, lng: np.ndarray, version):
+        """呼叫端需持有 _lock"""
+        self._remove(route_id)
+        segments = split_segments(lat, lng, self.cell_m)
+
+        # 每個線段邊界框涵蓋的網格（線段不超過網格邊長，經度方向在高緯度可能跨越多格）
+        i0, j0 = self._cell_index(np.minimum(segments[:, 0], segments[:, 2]), np.minimum(segments[:, 1], segments[:, 3]))
+        i1, j1 = self._cell_index(np.maximum(segments[:, 0], segments[:, 2]), np.maximum(segments[:, 1], segments[:, 3]))
+        covered = set()
+        for di in range(int((i1 - i0).max()) + 1):
+            for dj in range(int((j1 - j0).max()) + 1):
+                valid = (i0 + di <= i1) & (j0 + dj <= j1)
+                covered.update(zip((i0[valid] + di).tolist(), (j0[valid] + dj).tolist()))
+        cells = list(covered)
+
+        for cell in cells:
+            self._cells.setdefault(cell, set()).add(route_id)
+        self._route_segments[route_id] = segments
+        self._route_cells[route_id] = cells
+        self._route_users[route_id] = user_id
+        self._versions[route_id] = version
+        self._segment_count += len(segments)
+
+    def on_route(self, route_id: int, route: Optional[CommuteRoute]):
+        """通勤路線服務的回呼：只索引至少有兩個定位點的使用中路線"""
+        if route is None or route.is_active != "active" or (route.point_count or 0) < 2:
+            with self._lock:
+                self._remove(route_id)
+            return
+        lat, lng, _ = decode_route_points(route)
+        with self._lock:
+            self._put(route_id, route.user_id, lat, lng, route.updated_at or route.created_at)
+
+    def sync_from_db(self):
+        """與資料庫同步：移除已刪除或停用的路線，只重新載入新增或更新過的路線定位點"""
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            version = func.coalesce(CommuteRoute.updated_at, CommuteRoute.created_at)
+            current = dict(db.execute(
+                select(CommuteRoute.id, version).where(CommuteRoute.is_active == "active", CommuteRoute.point_count >= 2)
+            ).all())
+
+            with self._lock:
+                for route_id in [route_id for route_id in self._route_segments if route_id not in current]:
+                    self._remove(route_id)
+                changed = [route_id for route_id, updated in current.items() if self._versions.get(route_id) != updated]
+
+            for offset in range(0, len(changed), 500):
+                batch = db.execute(
+                    select(CommuteRoute.id, CommuteRoute.user_id, CommuteRoute.packed_points, CommuteRoute.gps_points, version)
+                    .where(CommuteRoute.id.in_(changed[offset:offset + 500]))
+                ).all()
+                with self._lock:
+                    for row in batch:
+                        lat, lng, _ = decode_route_points(row)
+                        if len(lat) >= 2:
+                            self._put(row.id, row.user_id, lat, lng, row[4])
+        finally:
+            db.close()
+        self.last_sync_ms = (time.perf_counter() - started) * 1000
+        if changed:
+            logger.info(f"Commute corridor index synced {len(changed)} routes ({len(self._route_segments)} indexed)")
+
+    def _gather(self, cells: Iterable[Cell], exclude_user_id: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """呼叫端需持有 _lock；回傳候選路線的所有線段與對應的 route_id"""
+        route_ids: Set[int] = set()
+        for cell in cells:
+            route_ids.update(self._cells.get(cell, ()))
+        if exclude_user_id is not None:
+            route_ids = {route_id for route_id in route_ids if self._route_users[route_id] != exclude_user_id}
+        self.last_candidates = len(route_ids)
+        if not route_ids:
+            return np.empty((0, 4)), np.empty(0, dtype=np.int64)
+        route_ids_list = list(route_ids)
+        segments = [self._route_segments[route_id] for route_id in route_ids_list]
+        owners = np.repeat(np.array(route_ids_list, dtype=np.int64), [len(s) for s in segments])
+        return np.concatenate(segments), owners
+
+    def _rank(self, owners: np.ndarray, distance: np.ndarray, radius_m: float, limit: int) -> List[Dict[str, Any]]:
+        """依路線取最短距離，回傳半徑內最近的 limit 條路線"""
+        within = distance <= radius_m
+        owners, distance = owners[within], distance[within]
+        if len(owners) == 0:
+            return []
+        route_ids, inverse = np.unique(owners, return_inverse=True)
+        nearest = np.full(len(route_ids), np.inf)
+        np.minimum.at(nearest, inverse, distance)
+        order = np.argsort(nearest, kind='stable')[:limit]
+        with self._lock:
+            users = [self._route_users.get(int(route_ids[i])) for i in order]
+        return [
+            {"route_id": int(route_ids[i]), "user_id": user_id, "distance_m": round(float(nearest[i]), 1)}
+            for i, user_id in zip(order, users)
+        ]
+
+    @staticmethod
+    def _projection(ref_lat: float) -> np.ndarray:
+        # 等距圓柱投影：[lat, lng] 乘上此比例換算為公尺
+        return np.array([METERS_PER_DEGREE, METERS_PER_DEGREE * math.cos(math.radians(ref_lat))])
+
+    def _lng_span(self, lat: float, radius_m: float) -> float:
+        return radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + radius_m / METERS_PER_DEGREE, 89.9))), 1e-6))
+
+    def query_point(
+        self, lat: float, lng: float, radius_m: float, limit: int, exclude_user_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """路徑經過 (lat, lng) 半徑 radius_m 內的路線，依最短距離排序"""
+        started = time.perf_counter()
+        lat_span = radius_m / METERS_PER_DEGREE
+        lng_span = self._lng_span(lat, radius_m)
+        with self._lock:
+            segments, owners = self._gather(
+                self._cell_range(lat - lat_span, lng - lng_span, lat + lat_span, lng + lng_span), exclude_user_id
+            )
+
+        scale = self._projection(lat)
+        origin = np.array([lat, lng])
+        distance = _point_segment_distance(
+            np.zeros(2), (segments[:, 0:2] - origin) * scale, (segments[:, 2:4] - origin) * scale
+        )
+        results = self._rank(owners, distance, radius_m, limit)
+        self._record_query(started)
+        return results
+
+    def query_path(
+        self, lat: np.ndarray, lng: np.ndarray, radius_m: float, limit: int, exclude_user_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """路徑與查詢折線最短距離在 radius_m 內的路線，依最短距離排序"""
+        started = time.perf_counter()
+        path = split_segments(lat, lng, self.cell_m)
+
+        # 線段與查詢路徑相距 radius_m 內時，線段中點與查詢路徑的距離不超過 radius_m 加半個網格；
+        # 將每段查詢路徑登記在擴張後涵蓋的網格，再以線段中點所在網格配對，只對配對到的組合計算距離
+        expand_m = radius_m + self.cell_m / 2
+        lat_span = expand_m / METERS_PER_DEGREE
+        lng_span = self._lng_span(float(np.abs(lat).max()), expand_m)
+        i0, j0 = self._cell_index(np.minimum(path[:, 0], path[:, 2]) - lat_span, np.minimum(path[:, 1], path[:, 3]) - lng_span)
+        i1, j1 = self._cell_index(np.maximum(path[:, 0], path[:, 2]) + lat_span, np.maximum(path[:, 1], path[:, 3]) + lng_span)
+        cell_i, cell_j, cell_path = [], [], []
+        for di in range(int((i1 - i0).max()) + 1):
+            for dj in range(int((j1 - j0).max()) + 1):
+                valid = (i0 + di <= i1) & (j0 + dj <= j1)
+                cell_i.append(i0[valid] + di)
+                cell_j.append(j0[valid] + dj)
+                cell_path.append(np.flatnonzero(valid))
+        cell_i, cell_j, cell_path = np.concatenate(cell_i), np.concatenate(cell_j), np.concatenate(cell_path)
+
+        with self._lock:
+            segments, owners = self._gather(set(zip(cell_i.tolist(), cell_j.tolist())), exclude_user_id)
+
+        keys = cell_i * 4294967296 + cell_j
+        order = np.argsort(keys, kind='stable')
+        keys, cell_path = keys[order], cell_path[order]
+        mid_i, mid_j = self._cell_index((segments[:, 0] + segments[:, 2]) / 2, (segments[:, 1] + segments[:, 3]) / 2)
+        mid_keys = mid_i * 4294967296 + mid_j
+        left = np.searchsorted(keys, mid_keys, side='left')
+        counts = np.searchsorted(keys, mid_keys, side='right') - left
+        segment_index = np.repeat(np.arange(len(segments)), counts)
+        path_index = cell_path[np.repeat(left, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+
+        # 網格配對較粗略，先以擴張 radius_m 後的邊界框排除不可能相近的組合
+        radius_lat = radius_m / METERS_PER_DEGREE
+        radius_lng = self._lng_span(float(np.abs(lat).max()), radius_m)
+        seg, piece = segments[segment_index], path[path_index]
+        near = (
+            (np.minimum(seg[:, 0], seg[:, 2]) <= np.maximum(piece[:, 0], piece[:, 2]) + radius_lat)
+            & (np.maximum(seg[:, 0], seg[:, 2]) >= np.minimum(piece[:, 0], piece[:, 2]) - radius_lat)
+            & (np.minimum(seg[:, 1], seg[:, 3]) <= np.maximum(piece[:, 1], piece[:, 3]) + radius_lng)
+            & (np.maximum(seg[:, 1], seg[:, 3]) >= np.minimum(piece[:, 1], piece[:, 3]) - radius_lng)
+        )
+        segment_index, path_index = segment_index[near], path_index[near]
+
+        scale = self._projection(float(lat.mean()))
+        origin = np.array([lat[0], lng[0]])
+        distance = _segment_distance(
+            (segments[segment_index, 0:2] - origin) * scale, (segments[segment_index, 2:4] - origin) * scale,
+            (path[path_index, 0:2] - origin) * scale, (path[path_index, 2:4] - origin) * scale
+        )
+        results = self._rank(owners[segment_index], distance, radius_m, limit)
+        self._record_query(started)
+        return results
+
+    def _record_query(self, started: float):
+        self.queries += 1
+        self.last_query_ms = (time.perf_counter() - started) * 1000
+
+    async def start(self):
+        """載入路線並啟動定期同步工作"""
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.sync_from_db)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Commute corridor index started with {len(self._route_segments)} routes")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.refresh_s)
+            try:
+                await loop.run_in_executor(None, self.sync_from_db)
+            except Exception as e:
+                logger.error(f"Commute corridor index sync failed: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "indexed_routes": len(self._route_segments),
+            "segments": self._segment_count,
+            "cells": len(self._cells),
+            "cell_m": self.cell_m,
+            "queries": self.queries,
+            "last_candidates": self.last_candidates,
+            "last_query_ms": round(self.last_query_ms, 3),
+            "last_sync_ms": round(self.last_sync_ms, 3)
+        }
+
+
+# 創建全局通勤路線走廊索引實例
+commute_corridor_index = CommuteCorridorIndex()
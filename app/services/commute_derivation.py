@@ -0,0 +1,326 @@
+"""
+通勤路線偵測 - 由用戶近期的行程找出反覆出現的起訖點與典型出發時間，寫入 CommuteRoute
+
+停留點依距離分群為地點，同一對地點之間的行程達到次數門檻即視為通勤路線；
+以出發時間的環狀平均、行程時間與距離的中位數代表，並取行程時間最接近中位數的一趟行程作為路線定位點。
+批次工作以多個程序平行處理各用戶，每位用戶在子程序中各自讀寫資料庫；
+子程序不會觸發路線變更通知，全部完成後由主程序通知已註冊的索引。
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import select
+from app.database import SessionLocal
+from app.models.commute_route import CommuteRoute
+from app.models.gps_trip import StayPoint, Trip
+from app.services.commute_route_service import CommuteRouteService, commute_route_service
+from app.services.geo_utils import haversine_m_np
+from app.services.gps_encoding import to_epoch_seconds
+from app.services.gps_track_service import query_track, simplify_track
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 1440
+
+
+def circular_mean_minute(minutes: np.ndarray) -> int:
+    """當日分鐘數的環狀平均，跨午夜的時間（如 23:50 與 00:10）平均為 00:00 而不是中午"""
+    angle = np.asarray(minutes, dtype=np.float64) * (2 * np.pi / MINUTES_PER_DAY)
+    mean = np.arctan2(np.sin(angle).mean(), np.cos(angle).mean())
+    return int(round(mean * MINUTES_PER_DAY / (2 * np.pi))) % MINUTES_PER_DAY
+
+
+class CommuteDerivationService:
+    """由行程偵測通勤路線"""
+
+    def __init__(self):
+        self.enabled = os.getenv('GPS_COMMUTE_ENABLED', 'false').lower() == 'true'
+        self.lookback_days = int(os.getenv('GPS_COMMUTE_LOOKBACK_DAYS', '28'))          # 分析最近 N 天的行程
+        self.place_radius_m = float(os.getenv('GPS_COMMUTE_PLACE_RADIUS_M', '300'))     # 停留點分群為同一地點的半徑
+        self.min_trips = int(os.getenv('GPS_COMMUTE_MIN_TRIPS', '3'))                   # 同一起訖點至少在幾個不同日期出現
+        self.max_routes_per_user = int(os.getenv('GPS_COMMUTE_MAX_ROUTES_PER_USER', '5'))
+        self.simplify_m = float(os.getenv('GPS_COMMUTE_SIMPLIFY_M', '20'))              # 路線定位點的簡化容許誤差
+        self.workers = int(os.getenv('GPS_COMMUTE_WORKERS', str(os.cpu_count() or 1)))  # 子程序數（0 表示在目前程序執行）
+        self.interval = float(os.getenv('GPS_COMMUTE_INTERVAL_S', '86400'))
+        self._task: Optional[asyncio.Task] = None
+
+        # 統計資料
+        self.runs = 0
+        self.last_run: Optional[datetime] = None
+        self.last_run_s = 0.0
+        self.last_run_users = 0
+        self.routes_created = 0
+        self.routes_updated = 0
+        self.routes_deactivated = 0
+        self.failed_users = 0
+
+    def cluster_places(self, lat: np.ndarray, lng: np.ndarray, weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        將停留點分群為地點，回傳 (每個停留點的地點編號, 地點緯度, 地點經度)
+
+        依權重（停留點數）由大到小，加入半徑內最近的地點，否則成為新的地點
+        """
+        labels = np.empty(len(lat), dtype=np.int64)
+        center_lat: List[float] = []
+        center_lng: List[float] = []
+        for i in np.argsort(-weights, kind='stable'):
+            if center_lat:
+                distance = haversine_m_np(lat[i], lng[i], np.array(center_lat), np.array(center_lng))
+                nearest = int(np.argmin(distance))
+                if distance[nearest] <= self.place_radius_m:
+                    labels[i] = nearest
+                    continue
+            labels[i] = len(center_lat)
+            center_lat.append(float(lat[i]))
+            center_lng.append(float(lng[i]))
+        return labels, np.array(center_lat), np.array(center_lng)
+
+    def find_commutes(self, db, user_id: int, since: datetime) -> List[Dict[str, Any]]:
+        """找出用戶在 since 之後反覆出現的起訖點，依行程次數由多到少"""
+        trips = db.query(Trip).filter(
+            Trip.user_id == user_id,
+            Trip.start_time >= since,
+            Trip.origin_stay_id.isnot(None),
+            Trip.destination_stay_id.isnot(None)
+        ).order_by(Trip.start_time).all()
+        if len(trips) < self.min_trips:
+            return []
+
+        stay_ids = sorted({t.origin_stay_id for t in trips} | {t.destination_stay_id for t in trips})
+        stays = db.execute(
+            select(StayPoint.id, StayPoint.latitude, StayPoint.longitude, StayPoint.point_count).where(StayPoint.id.in_(stay_ids))
+        ).all()
+        stay_index = {row[0]: i for i, row in enumerate(stays)}
+        labels, place_lat, place_lng = self.cluster_places(
+            np.array([row[1] for row in stays]), np.array([row[2] for row in stays]), np.array([row[3] for row in stays])
+        )
+
+        pairs: Dict[Tuple[int, int], List[Trip]] = {}
+        for trip in trips:
+            origin = int(labels[stay_index[trip.origin_stay_id]])
+            destination = int(labels[stay_index[trip.destination_stay_id]])
+            if origin != destination:
+                pairs.setdefault((origin, destination), []).append(trip)
+
+        commutes = []
+        for (origin, destination), pair_trips in pairs.items():
+            if len({t.start_time.date() for t in pair_trips}) < self.min_trips:
+                continue
+            departure = np.array([t.start_time.hour * 60 + t.start_time.minute for t in pair_trips])
+            duration = np.array([(t.end_time - t.start_time).total_seconds() for t in pair_trips])
+            distance = np.array([t.distance_m for t in pair_trips])
+            # 行程時間最接近中位數的一趟作為代表路線
+            representative = pair_trips[int(np.argmin(np.abs(duration - np.median(duration))))]
+            commutes.append({
+                "start_latitude": float(place_lat[origin]),
+                "start_longitude": float(place_lng[origin]),
+                "end_latitude": float(place_lat[destination]),
+                "end_longitude": float(place_lng[destination]),
+                "departure_minute": circular_mean_minute(departure),
+                "travel_time": int(round(np.median(duration) / 60)),
+                "distance": round(float(np.median(distance)) / 1000, 3),
+                "trip_count": len(pair_trips),
+                "representative": representative
+            })
+        commutes.sort(key=lambda c: c["trip_count"], reverse=True)
+        return commutes[:self.max_routes_per_user]
+
+    def _route_points(self, db, user_id: int, trip: Trip):
+        """代表行程的簡化定位點 (lat, lng, epoch 秒)"""
+        rows = simplify_track(query_track(db, user_id, trip.start_time, trip.end_time), self.simplify_m)
+        return (
+            np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows)),
+            np.fromiter((row[3] for row in rows), dtype=np.float64, count=len(rows)),
+            to_epoch_seconds([row[1] for row in rows])
+        )
+
+    def derive_user(self, user_id: int) -> Tuple[int, int, int, List[int]]:
+        """偵測用戶的通勤路線並寫入，回傳 (新增, 更新, 停用) 的路線數與變更的路線 ID；用戶自行建立的路線不受影響"""
+        db = SessionLocal()
+        try:
+            commutes = self.find_commutes(db, user_id, datetime.utcnow() - timedelta(days=self.lookback_days))
+            existing = db.query(CommuteRoute).filter(
+                CommuteRoute.user_id == user_id, CommuteRoute.source == "derived"
+            ).all()
+
+            created = updated = 0
+            matched = set()
+            changed: List[CommuteRoute] = []
+            for commute in commutes:
+                route = None
+                for candidate in existing:
+                    if candidate.id in matched:
+                        continue
+                    start_distance, end_distance = haversine_m_np(
+                        [candidate.start_latitude, candidate.end_latitude],
+                        [candidate.start_longitude, candidate.end_longitude],
+                        [commute["start_latitude"], commute["end_latitude"]],
+                        [commute["start_longitude"], commute["end_longitude"]]
+                    )
+                    if start_distance <= self.place_radius_m and end_distance <= self.place_radius_m:
+                        route = candidate
+                        break
+                if route is None:
+                    route = CommuteRoute(user_id=user_id, source="derived")
+                    db.add(route)
+                    created += 1
+                else:
+                    matched.add(route.id)
+                    updated += 1
+                changed.append(route)
+
+                # 先寫入代表行程的定位點，距離與通勤時間再以中位數覆蓋
+                CommuteRouteService.set_points(route, *self._route_points(db, user_id, commute.pop("representative")))
+                for field, value in commute.items():
+                    setattr(route, field, value)
+                route.is_active = "active"
+
+            deactivated = 0
+            for route in existing:
+                if route.id not in matched and route.is_active == "active":
+                    route.is_active = "inactive"
+                    deactivated += 1
+                    changed.append(route)
+            db.commit()
+            return created, updated, deactivated, [route.id for route in changed]
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def candidate_users(self) -> List[int]:
+        """近期有行程的用戶"""
+        since = datetime.utcnow() - timedelta(days=self.lookback_days)
+        db = SessionLocal()
+        try:
+            return list(db.scalars(
+                select(Trip.user_id).where(Trip.start_time >= since).distinct().order_by(Trip.user_id)
+            ).all())
+        finally:
+            db.close()
+
+    def run(self, user_ids: Optional[List[int]] = None) -> Dict[str, Any]:
+        """偵測所有（或指定）用戶的通勤路線"""
+        started = time.perf_counter()
+        if user_ids is None:
+            user_ids = self.candidate_users()
+
+        results: List[Tuple[int, Optional[Tuple[int, int, int, List[int]]], Optional[str]]] = []
+        if self.workers <= 0 or len(user_ids) <= 1:
+            for user_id in user_ids:
+                results.append(_derive_user_safely(user_id))
+        else:
+            # 以 spawn 啟動子程序：服務程序中有其他執行緒與資料庫連線，fork 可能複製到鎖住的狀態
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(
+                max_workers=min(self.workers, len(user_ids)), mp_context=context, initializer=_init_worker
+            ) as pool:
+                futures = [pool.submit(_derive_user_safely, user_id) for user_id in user_ids]
+                results = [future.result() for future in as_completed(futures)]
+
+        created = updated = deactivated = failed = 0
+        changed_ids: List[int] = []
+        for user_id, counts, error in results:
+            if counts is None:
+                failed += 1
+                logger.error(f"Commute route derivation failed for user {user_id}: {error}")
+                continue
+            created += counts[0]
+            updated += counts[1]
+            deactivated += counts[2]
+            changed_ids.extend(counts[3])
+
+        # 子程序寫入的路線不會經過路線服務，由主程序通知索引，不必等待定期同步
+        if changed_ids:
+            db = SessionLocal()
+            try:
+                commute_route_service.notify_changed(db, changed_ids)
+            except Exception as e:
+                logger.error(f"Failed to notify commute route listeners: {e}")
+            finally:
+                db.close()
+
+        self.runs += 1
+        self.last_run = datetime.utcnow()
+        self.last_run_s = time.perf_counter() - started
+        self.last_run_users = len(user_ids)
+        self.routes_created += created
+        self.routes_updated += updated
+        self.routes_deactivated += deactivated
+        self.failed_users += failed
+        logger.info(
+            f"Derived commute routes for {len(user_ids)} users in {self.last_run_s:.1f}s "
+            f"(created={created}, updated={updated}, deactivated={deactivated}, failed={failed})"
+        )
+        return {
+            "users": len(user_ids),
+            "created": created,
+            "updated": updated,
+            "deactivated": deactivated,
+            "failed": failed,
+            "elapsed_s": round(self.last_run_s, 3)
+        }
+
+    async def start(self):
+        """啟動定期偵測工作"""
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Commute route derivation started (interval={self.interval}s, workers={self.workers})")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.run)
+            except Exception as e:
+                logger.error(f"Commute route derivation run failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "workers": self.workers,
+            "runs": self.runs,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "last_run_s": round(self.last_run_s, 3),
+            "last_run_users": self.last_run_users,
+            "routes_created": self.routes_created,
+            "routes_updated": self.routes_updated,
+            "routes_deactivated": self.routes_deactivated,
+            "failed_users": self.failed_users
+        }
+
+
+def _init_worker():
+    """子程序需載入所有模型，relationship 才能對應到其他資料表"""
+    from app.models import user, hobby, user_status, commute_route, room, chat, gps_route, gps_rollup, gps_trip  # noqa: F401
+
+
+def _derive_user_safely(user_id: int) -> Tuple[int, Optional[Tuple[int, int, int, List[int]]], Optional[str]]:
+    """子程序的工作函式：例外轉為錯誤訊息回傳，不中斷其他用戶"""
+    try:
+        return user_id, commute_derivation_service.derive_user(user_id), None
+    except Exception as e:
+        return user_id, None, str(e)
+
+
+# 創建全局通勤路線偵測實例
+commute_derivation_service = CommuteDerivationService()
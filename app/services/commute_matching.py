@@ -0,0 +1,291 @@
+"""
+通勤配對索引 - 依起點、終點與出發時間找出相近的通勤路線
+
+起點與終點各有一個網格空間索引，出發時間以每分鐘一格的區間索引（跨午夜循環）。
+查詢時先估計三個索引各自的候選數，由最少的索引取出候選路線，其餘條件以 numpy 一次篩選，不需掃描全部路線。
+路線經由 API 變更時即時更新，其他程序（例如通勤路線偵測）寫入的路線由定期重新載入同步。
+"""
+
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+import numpy as np
+from sqlalchemy import select
+from app.database import SessionLocal
+from app.models.commute_route import CommuteRoute
+from app.services.commute_route_service import commute_route_service
+from app.services.geo_utils import haversine_m_np
+
+logger = logging.getLogger(__name__)
+
+METERS_PER_DEGREE = 111320.0
+MINUTES_PER_DAY = 1440
+
+Cell = Tuple[int, int]
+
+
+class CommuteMatchIndex:
+    """通勤路線的起點、終點網格索引與出發時間區間索引"""
+
+    def __init__(self):
+        self.cell_m = float(os.getenv('COMMUTE_MATCH_CELL_M', '1000'))                # 網格邊長（公尺，以緯度換算為度）
+        self.max_radius_m = float(os.getenv('COMMUTE_MATCH_MAX_RADIUS_M', '10000'))   # 起點、終點搜尋半徑上限
+        self.max_window_min = int(os.getenv('COMMUTE_MATCH_MAX_WINDOW_MIN', '180'))   # 出發時間範圍上限（±分鐘）
+        self.refresh_s = float(os.getenv('COMMUTE_MATCH_REFRESH_S', '300'))           # 由資料庫重新載入的間隔
+        self.cell_deg = self.cell_m / METERS_PER_DEGREE
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._reset()
+
+        # 統計資料
+        self.queries = 0
+        self.last_query_ms = 0.0
+        self.last_refresh_ms = 0.0
+
+        commute_route_service.add_listener(self.on_route)
+
+    def _reset(self):
+        # 路線存放在以 slot 為索引的 numpy 陣列，各索引中記錄 slot
+        self._slots: Dict[int, int] = {}  # {route_id: slot}
+        self._free_slots: List[int] = []
+        self._size = 0
+        self._route_ids = np.full(1024, -1, dtype=np.int64)
+        self._user_ids = np.zeros(1024, dtype=np.int64)
+        self._coords = np.zeros((1024, 4))  # 起點緯度、起點經度、終點緯度、終點經度
+        self._departure = np.full(1024, -1, dtype=np.int64)  # 沒有出發時間為 -1
+        self._start_cells: Dict[Cell, Set[int]] = {}
+        self._end_cells: Dict[Cell, Set[int]] = {}
+        self._departure_buckets: Dict[int, Set[int]] = {}  # {出發時間（分鐘）: slots}
+
+    def _cell(self, lat: float, lng: float) -> Cell:
+        return (int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg)))
+
+    def _allocate_slot(self) -> int:
+        if self._free_slots:
+            return self._free_slots.pop()
+        if self._size == len(self._route_ids):
+            grow = len(self._route_ids)
+            self._route_ids = np.concatenate([self._route_ids, np.full(grow, -1, dtype=np.int64)])
+            self._user_ids = np.concatenate([self._user_ids, np.zeros(grow, dtype=np.int64)])
+            self._coords = np.concatenate([self._coords, np.zeros((grow, 4))])
+            self._departure = np.concatenate([self._departure, np.full(grow, -1, dtype=np.int64)])
+        self._size += 1
+        return self._size - 1
+
+    @staticmethod
+    def _discard(index: Dict[Any, Set[int]], key, slot: int):
+        members = index.get(key)
+        if members is not None:
+            members.discard(slot)
+            if not members:
+                del index[key]
+
+    def _remove(self, route_id: int):
+        """呼叫端需持有 _lock"""
+        slot = self._slots.pop(route_id, None)
+        if slot is None:
+            return
+        start_lat, start_lng, end_lat, end_lng = self._coords[slot]
+        self._discard(self._start_cells, self._cell(start_lat, start_lng), slot)
+        self._discard(self._end_cells, self._cell(end_lat, end_lng), slot)
+        if self._departure[slot] >= 0:
+            self._discard(self._departure_buckets, int(self._departure[slot]), slot)
+        self._route_ids[slot] = -1
+        self._departure[slot] = -1
+        self._free_slots.append(slot)
+
+    def _put(self, route_id: int, user_id: int, coords: Tuple[float, float, float, float], departure_minute: Optional[int]):
+        """呼叫端需持有 _lock"""
+        self._remove(route_id)
+        slot = self._allocate_slot()
+        self._slots[route_id] = slot
+        self._route_ids[slot] = route_id
+        self._user_ids[slot] = user_id
+        self._coords[slot] = coords
+        self._start_cells.setdefault(self._cell(coords[0], coords[1]), set()).add(slot)
+        self._end_cells.setdefault(self._cell(coords[2], coords[3]), set()).add(slot)
+        if departure_minute is not None:
+            self._departure[slot] = departure_minute % MINUTES_PER_DAY
+            self._departure_buckets.setdefault(departure_minute % MINUTES_PER_DAY, set()).add(slot)
+
+    @staticmethod
+    def _indexable(route) -> bool:
+        return route.is_active == "active" and None not in (
+            route.start_latitude, route.start_longitude, route.end_latitude, route.end_longitude
+        )
+
+    def on_route(self, route_id: int, route: Optional[CommuteRoute]):
+        """通勤路線服務的回呼：只索引有起訖點的使用中路線"""
+        with self._lock:
+            if route is None or not self._indexable(route):
+                self._remove(route_id)
+            else:
+                self._put(
+                    route_id, route.user_id,
+                    (route.start_latitude, route.start_longitude, route.end_latitude, route.end_longitude),
+                    route.departure_minute
+                )
+
+    def refresh_from_db(self):
+        """由資料庫重新建立索引（只讀取起訖點與出發時間，不載入定位點）"""
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            rows = db.execute(select(
+                CommuteRoute.id, CommuteRoute.user_id, CommuteRoute.start_latitude, CommuteRoute.start_longitude,
+                CommuteRoute.end_latitude, CommuteRoute.end_longitude, CommuteRoute.departure_minute
+            ).where(
+                CommuteRoute.is_active == "active",
+                CommuteRoute.start_latitude.isnot(None), CommuteRoute.start_longitude.isnot(None),
+                CommuteRoute.end_latitude.isnot(None), CommuteRoute.end_longitude.isnot(None)
+            )).all()
+        finally:
+            db.close()
+
+        with self._lock:
+            self._reset()
+            for route_id, user_id, start_lat, start_lng, end_lat, end_lng, departure_minute in rows:
+                self._put(route_id, user_id, (start_lat, start_lng, end_lat, end_lng), departure_minute)
+        self.last_refresh_ms = (time.perf_counter() - started) * 1000
+
+    def _cells_within(self, lat: float, lng: float, radius_m: float) -> List[Cell]:
+        lat_span = radius_m / METERS_PER_DEGREE
+        lng_span = radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + lat_span, 89.9))), 1e-6))
+        min_cell = self._cell(lat - lat_span, lng - lng_span)
+        max_cell = self._cell(lat + lat_span, lng + lng_span)
+        return [(i, j) for i in range(min_cell[0], max_cell[0] + 1) for j in range(min_cell[1], max_cell[1] + 1)]
+
+    def _departure_keys(self, departure_minute: int, window_min: int) -> List[int]:
+        if 2 * window_min + 1 >= MINUTES_PER_DAY:
+            return list(range(MINUTES_PER_DAY))
+        return [(departure_minute + offset) % MINUTES_PER_DAY for offset in range(-window_min, window_min + 1)]
+
+    def query(
+        self,
+        start: Tuple[float, float],
+        end: Tuple[float, float],
+        departure_minute: Optional[int],
+        start_radius_m: float,
+        end_radius_m: float,
+        window_min: int,
+        limit: int,
+        exclude_user_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        查詢起點、終點都在半徑內且出發時間相差不超過 window_min 分鐘的路線（departure_minute 為 None 時不限時間）
+
+        依相似度排序：起點距離、終點距離、出發時間差各自除以上限後取平均，分數為 1 減去此平均
+        """
+        started = time.perf_counter()
+        with self._lock:
+            # 估計各索引的候選數，由最少的索引取出候選路線
+            lookups = [
+                (self._start_cells, self._cells_within(start[0], start[1], start_radius_m)),
+                (self._end_cells, self._cells_within(end[0], end[1], end_radius_m))
+            ]
+            if departure_minute is not None:
+                lookups.append((self._departure_buckets, self._departure_keys(departure_minute, window_min)))
+
+            best_index, best_keys = min(lookups, key=lambda lookup: sum(len(lookup[0].get(key, ())) for key in lookup[1]))
+
+            slots: List[int] = []
+            for key in best_keys:
+                members = best_index.get(key)
+                if members:
+                    slots.extend(members)
+            candidates = np.array(slots, dtype=np.int64)
+            route_ids = self._route_ids[candidates]
+            user_ids = self._user_ids[candidates]
+            coords = self._coords[candidates]
+            departures = self._departure[candidates]
+
+        if len(candidates) == 0:
+            self._record_query(started)
+            return []
+
+        start_distance = haversine_m_np(start[0], start[1], coords[:, 0], coords[:, 1])
+        end_distance = haversine_m_np(end[0], end[1], coords[:, 2], coords[:, 3])
+        mask = (start_distance <= start_radius_m) & (end_distance <= end_radius_m)
+        if exclude_user_id is not None:
+            mask &= user_ids != exclude_user_id
+
+        cost = start_distance / start_radius_m + end_distance / end_radius_m
+        if departure_minute is not None:
+            diff = np.abs(departures - departure_minute) % MINUTES_PER_DAY
+            diff = np.minimum(diff, MINUTES_PER_DAY - diff)
+            mask &= (departures >= 0) & (diff <= window_min)
+            cost = (cost + diff / max(window_min, 1)) / 3
+        else:
+            diff = None
+            cost = cost / 2
+        selected = np.flatnonzero(mask)
+
+        # 只排序最相似的 limit 筆
+        if len(selected) > limit:
+            selected = selected[np.argpartition(cost[selected], limit - 1)[:limit]]
+        selected = selected[np.argsort(cost[selected], kind='stable')]
+
+        results = [
+            {
+                "route_id": int(route_ids[i]),
+                "user_id": int(user_ids[i]),
+                "start_distance_m": round(float(start_distance[i]), 1),
+                "end_distance_m": round(float(end_distance[i]), 1),
+                "departure_minute": int(departures[i]) if departures[i] >= 0 else None,
+                "departure_diff_min": int(diff[i]) if diff is not None else None,
+                "score": round(1 - float(cost[i]), 4)
+            }
+            for i in selected
+        ]
+        self._record_query(started)
+        return results
+
+    def _record_query(self, started: float):
+        self.queries += 1
+        self.last_query_ms = (time.perf_counter() - started) * 1000
+
+    async def start(self):
+        """載入路線並啟動定期重新載入工作"""
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.refresh_from_db)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Commute match index started with {len(self._slots)} routes")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.refresh_s)
+            try:
+                await loop.run_in_executor(None, self.refresh_from_db)
+            except Exception as e:
+                logger.error(f"Commute match index refresh failed: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "indexed_routes": len(self._slots),
+            "start_cells": len(self._start_cells),
+            "end_cells": len(self._end_cells),
+            "cell_m": self.cell_m,
+            "queries": self.queries,
+            "last_query_ms": round(self.last_query_ms, 3),
+            "last_refresh_ms": round(self.last_refresh_ms, 3)
+        }
+
+
+# 創建全局通勤配對索引實例
+commute_match_index = CommuteMatchIndex()
@@ -0,0 +1,158 @@
+"""
+通勤路線服務 - 路線定位點以二進位封裝儲存（int32 微度 + 差分秒數），距離與通勤時間於寫入時向量化計算
+
+列表查詢不載入定位點欄位；只有需要定位點時才解開。路線新增、修改、刪除時通知已註冊的索引。
+"""
+
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from sqlalchemy.orm import Session
+from app.models.commute_route import CommuteRoute
+from app.services.geo_utils import haversine_m_np
+from app.services.gps_encoding import pack_points, unpack_points, to_epoch_seconds
+from app.services.gps_service import parse_gps_timestamp
+
+logger = logging.getLogger(__name__)
+
+COMMUTE_ROUTE_MAX_POINTS = int(os.getenv('COMMUTE_ROUTE_MAX_POINTS', '10000'))
+
+# 可由請求更新的路線欄位（定位點另外處理）
+ROUTE_FIELDS = (
+    "route_name", "start_latitude", "start_longitude", "start_address",
+    "end_latitude", "end_longitude", "end_address",
+    "travel_time", "distance", "transport_mode", "departure_minute", "is_active"
+)
+
+# 未明確提供時由定位點的頭尾決定
+ENDPOINT_FIELDS = ("start_latitude", "start_longitude", "end_latitude", "end_longitude")
+
+# (lat, lng, epoch 秒)；沒有時間的路線 epoch 為 None
+RoutePoints = Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]
+
+
+def parse_route_points(points: List[Dict[str, Any]]) -> RoutePoints:
+    """解析請求中的定位點（lat、lng、選填 ts），時間需全部提供或全部省略且不可倒退"""
+    if len(points) > COMMUTE_ROUTE_MAX_POINTS:
+        raise ValueError(f"定位點數量不可超過 {COMMUTE_ROUTE_MAX_POINTS}")
+    lat = np.array([point["lat"] for point in points], dtype=np.float64)
+    lng = np.array([point["lng"] for point in points], dtype=np.float64)
+    if np.any(np.abs(lat) > 90) or np.any(np.abs(lng) > 180):
+        raise ValueError("定位點經緯度超出範圍")
+
+    timestamps = [point.get("ts") for point in points]
+    if all(ts is None for ts in timestamps):
+        return lat, lng, None
+    if any(ts is None for ts in timestamps):
+        raise ValueError("定位點時間必須全部提供或全部省略")
+    epoch = to_epoch_seconds([parse_gps_timestamp(ts) for ts in timestamps])
+    if np.any(np.diff(epoch) < 0):
+        raise ValueError("定位點時間必須依時間排序")
+    return lat, lng, epoch
+
+
+def encode_route_points(lat: np.ndarray, lng: np.ndarray, epoch: Optional[np.ndarray]) -> bytes:
+    # 沒有時間的路線以標頭版本標記，不以全為 0 的時間表示
+    return pack_points(lat, lng, epoch)
+
+
+def decode_route_points(route: CommuteRoute) -> RoutePoints:
+    """解開路線定位點（相容舊版 JSON 格式）"""
+    if route.packed_points:
+        return unpack_points(route.packed_points)
+
+    if not route.gps_points:
+        return np.empty(0), np.empty(0), None
+    points = json.loads(route.gps_points)
+    if points and isinstance(points[0], (list, tuple)):
+        return np.array([p[0] for p in points], dtype=np.float64), np.array([p[1] for p in points], dtype=np.float64), None
+    lat = np.array([p.get("latitude", p.get("lat")) for p in points], dtype=np.float64)
+    lng = np.array([p.get("longitude", p.get("lng")) for p in points], dtype=np.float64)
+    timestamps = [p.get("timestamp", p.get("ts")) for p in points]
+    if not points or any(ts is None for ts in timestamps):
+        return lat, lng, None
+    return lat, lng, to_epoch_seconds([parse_gps_timestamp(ts) for ts in timestamps])
+
+
+def route_metrics(lat: np.ndarray, lng: np.ndarray, epoch: Optional[np.ndarray]) -> Tuple[float, Optional[int]]:
+    """回傳 (距離公里, 通勤時間分鐘)；沒有時間時通勤時間為 None"""
+    distance_km = float(haversine_m_np(lat[:-1], lng[:-1], lat[1:], lng[1:]).sum()) / 1000 if len(lat) > 1 else 0.0
+    travel_time = int(round((epoch[-1] - epoch[0]) / 60)) if epoch is not None and len(epoch) > 1 else None
+    return round(distance_km, 3), travel_time
+
+
+class CommuteRouteService:
+    """通勤路線的讀寫與變更通知"""
+
+    def __init__(self):
+        self._listeners: List[Callable[[int, Optional[CommuteRoute]], None]] = []
+
+    def add_listener(self, listener: Callable[[int, Optional[CommuteRoute]], None]):
+        """註冊路線變更的回呼（路線刪除時第二個參數為 None）"""
+        self._listeners.append(listener)
+
+    def _notify(self, route_id: int, route: Optional[CommuteRoute]):
+        for listener in self._listeners:
+            try:
+                listener(route_id, route)
+            except Exception as e:
+                logger.error(f"Commute route listener failed for route {route_id}: {e}")
+
+    @staticmethod
+    def set_points(route: CommuteRoute, lat: np.ndarray, lng: np.ndarray, epoch: Optional[np.ndarray]):
+        """寫入定位點並重新計算距離、通勤時間與起訖點（第一個與最後一個定位點）"""
+        route.packed_points = encode_route_points(lat, lng, epoch)
+        route.gps_points = None
+        route.point_count = len(lat)
+        route.distance, travel_time = route_metrics(lat, lng, epoch)
+        if travel_time is not None:
+            route.travel_time = travel_time
+        if len(lat):
+            route.start_latitude, route.start_longitude = float(lat[0]), float(lng[0])
+            route.end_latitude, route.end_longitude = float(lat[-1]), float(lng[-1])
+
+    def _apply(self, route: CommuteRoute, fields: Dict[str, Any], points: Optional[RoutePoints]):
+        """寫入欄位與定位點；請求中明確提供的起訖點不被定位點覆蓋"""
+        for field, value in fields.items():
+            setattr(route, field, value)
+        if points is not None:
+            self.set_points(route, *points)
+            for field in ENDPOINT_FIELDS:
+                if field in fields:
+                    setattr(route, field, fields[field])
+
+    def create(self, db: Session, user_id: int, fields: Dict[str, Any], points: Optional[RoutePoints]) -> CommuteRoute:
+        route = CommuteRoute(user_id=user_id, source="manual")
+        self._apply(route, {k: v for k, v in fields.items() if v is not None}, points)
+        db.add(route)
+        db.commit()
+        db.refresh(route)
+        self._notify(route.id, route)
+        return route
+
+    def update(self, db: Session, route: CommuteRoute, fields: Dict[str, Any], points: Optional[RoutePoints]) -> CommuteRoute:
+        self._apply(route, fields, points)
+        db.commit()
+        db.refresh(route)
+        self._notify(route.id, route)
+        return route
+
+    def delete(self, db: Session, route: CommuteRoute):
+        route_id = route.id
+        db.delete(route)
+        db.commit()
+        self._notify(route_id, None)
+
+    def notify_changed(self, db: Session, route_ids: List[int], chunk_size: int = 500):
+        """由其他程序寫入的路線（例如通勤偵測子程序）：重新讀取後通知索引，已不存在的路線視為刪除"""
+        for i in range(0, len(route_ids), chunk_size):
+            chunk = route_ids[i:i + chunk_size]
+            routes = {route.id: route for route in db.query(CommuteRoute).filter(CommuteRoute.id.in_(chunk))}
+            for route_id in chunk:
+                self._notify(route_id, routes.get(route_id))
+
+
+# 創建全局通勤路線服務實例
+commute_route_service = CommuteRouteService()
@@ -0,0 +1,314 @@
+"""
+通勤路線相似度 - 以離散 Fréchet 距離比較路線定位點序列
+
+每條使用中的路線依距離重新取樣為固定點數的形狀存放在記憶體中。
+查詢時先以邊界框與起訖點距離排除不可能在門檻內的路線（Fréchet 距離不小於起點距離、終點距離，
+且兩條路線的邊界框互相擴張門檻後必定包含對方），再以逐點對應的上界排除不可能進入前幾名的路線，
+剩下的候選分批以 numpy 動態規劃計算，批次在執行緒池中平行處理（numpy 運算期間會釋放 GIL）。
+"""
+
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+import numpy as np
+from sqlalchemy import func, select
+from app.database import SessionLocal
+from app.models.commute_route import CommuteRoute
+from app.services.commute_route_service import commute_route_service, decode_route_points
+from app.services.geo_utils import haversine_m_np
+
+logger = logging.getLogger(__name__)
+
+METERS_PER_DEGREE = 111320.0
+
+
+def resample_route(lat: np.ndarray, lng: np.ndarray, samples: int) -> np.ndarray:
+    """依沿線距離等距取樣為 samples 個點，回傳 (samples, 2) 的 [lat, lng]"""
+    distance = np.concatenate([[0.0], np.cumsum(haversine_m_np(lat[:-1], lng[:-1], lat[1:], lng[1:]))])
+    targets = np.linspace(0.0, distance[-1], samples)
+    return np.column_stack([np.interp(targets, distance, lat), np.interp(targets, distance, lng)])
+
+
+def discrete_frechet_batch(query: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    """
+    一條路線對多條路線的離散 Fréchet 距離
+
+    query 為 (n, 2)、candidates 為 (k, m, 2) 的平面座標（公尺），回傳長度 k 的距離。
+    沿反對角線推進動態規劃，每一步同時處理整條對角線與所有候選。
+    """
+    n, m = len(query), candidates.shape[1]
+    distance = np.sqrt(((candidates[:, None, :, :] - query[None, :, None, :]) ** 2).sum(axis=3))  # (k, n, m)
+
+    # 外圍補一圈無限大，省去邊界判斷
+    coupling = np.full((len(candidates), n + 1, m + 1), np.inf)
+    coupling[:, 1, 1] = distance[:, 0, 0]
+    for diagonal in range(1, n + m - 1):
+        i = np.arange(max(0, diagonal - m + 1), min(diagonal, n - 1) + 1)
+        j = diagonal - i
+        previous = np.minimum(np.minimum(coupling[:, i, j + 1], coupling[:, i + 1, j]), coupling[:, i, j])
+        coupling[:, i + 1, j + 1] = np.maximum(distance[:, i, j], previous)
+    return coupling[:, n, m]
+
+
+class CommuteSimilarityIndex:
+    """使用中通勤路線的取樣形狀與相似路線查詢"""
+
+    def __init__(self):
+        self.samples = int(os.getenv('COMMUTE_SIMILARITY_SAMPLES', '32'))                      # 每條路線的取樣點數
+        self.max_distance_m = float(os.getenv('COMMUTE_SIMILARITY_MAX_DISTANCE_M', '2000'))   # Fréchet 距離門檻上限
+        self.chunk_size = int(os.getenv('COMMUTE_SIMILARITY_CHUNK_SIZE', '1024'))             # 每批計算的候選數
+        self.workers = int(os.getenv('COMMUTE_SIMILARITY_WORKERS', str(os.cpu_count() or 1)))  # 0 表示不使用執行緒池
+        self.refresh_s = float(os.getenv('COMMUTE_SIMILARITY_REFRESH_S', '300'))              # 與資料庫同步的間隔
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._task: Optional[asyncio.Task] = None
+        self._reset()
+
+        # 統計資料
+        self.queries = 0
+        self.last_query_ms = 0.0
+        self.last_candidates = 0
+        self.last_scored = 0
+        self.last_sync_ms = 0.0
+
+        commute_route_service.add_listener(self.on_route)
+
+    def _reset(self):
+        # 路線存放在以 slot 為索引的 numpy 陣列；形狀以 float32 存放（約 1 公尺精度）以節省記憶體
+        self._slots: Dict[int, int] = {}  # {route_id: slot}
+        self._versions: Dict[int, Any] = {}  # {route_id: 最後更新時間}，同步時只重新載入有變更的路線
+        self._user_slots: Dict[int, Set[int]] = {}
+        self._free_slots: List[int] = []
+        self._size = 0
+        self._route_ids = np.full(1024, -1, dtype=np.int64)
+        self._user_ids = np.zeros(1024, dtype=np.int64)
+        self._bbox = np.zeros((1024, 4))  # 最小緯度、最小經度、最大緯度、最大經度
+        self._shapes = np.zeros((1024, self.samples, 2), dtype=np.float32)
+
+    def _allocate_slot(self) -> int:
+        if self._free_slots:
+            return self._free_slots.pop()
+        if self._size == len(self._route_ids):
+            grow = len(self._route_ids)
+            self._route_ids = np.concatenate([self._route_ids, np.full(grow, -1, dtype=np.int64)])
+            self._user_ids = np.concatenate([self._user_ids, np.zeros(grow, dtype=np.int64)])
+            self._bbox = np.concatenate([self._bbox, np.zeros((grow, 4))])
+            self._shapes = np.concatenate([self._shapes, np.zeros((grow, self.samples, 2), dtype=np.float32)])
+        self._size += 1
+        return self._size - 1
+
+    def _remove(self, route_id: int):
+        """呼叫端需持有 _lock"""
+        self._versions.pop(route_id, None)
+        slot = self._slots.pop(route_id, None)
+        if slot is None:
+            return
+        user_slots = self._user_slots.get(int(self._user_ids[slot]))
+        if user_slots is not None:
+            user_slots.discard(slot)
+            if not user_slots:
+                del self._user_slots[int(self._user_ids[slot])]
+        self._route_ids[slot] = -1
+        self._free_slots.append(slot)
+
+    def _put(self, route_id: int, user_id: int, lat: np.ndarray, lng: np.ndarray, version):
+        """呼叫端需持有 _lock"""
+        self._remove(route_id)
+        slot = self._allocate_slot()
+        self._slots[route_id] = slot
+        self._versions[route_id] = version
+        self._user_slots.setdefault(user_id, set()).add(slot)
+        self._route_ids[slot] = route_id
+        self._user_ids[slot] = user_id
+        self._bbox[slot] = (lat.min(), lng.min(), lat.max(), lng.max())
+        self._shapes[slot] = resample_route(lat, lng, self.samples)
+
+    def on_route(self, route_id: int, route: Optional[CommuteRoute]):
+        """通勤路線服務的回呼：只索引至少有兩個定位點的使用中路線"""
+        if route is None or route.is_active != "active" or (route.point_count or 0) < 2:
+            with self._lock:
+                self._remove(route_id)
+            return
+        lat, lng, _ = decode_route_points(route)
+        with self._lock:
+            self._put(route_id, route.user_id, lat, lng, route.updated_at or route.created_at)
+
+    def sync_from_db(self):
+        """與資料庫同步：移除已刪除或停用的路線，只重新載入新增或更新過的路線定位點"""
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            version = func.coalesce(CommuteRoute.updated_at, CommuteRoute.created_at)
+            rows = db.execute(
+                select(CommuteRoute.id, version).where(CommuteRoute.is_active == "active", CommuteRoute.point_count >= 2)
+            ).all()
+            current = dict(rows)
+
+            with self._lock:
+                for route_id in [route_id for route_id in self._slots if route_id not in current]:
+                    self._remove(route_id)
+                changed = [route_id for route_id, updated in current.items() if self._versions.get(route_id) != updated]
+
+            for offset in range(0, len(changed), 500):
+                batch = db.execute(
+                    select(CommuteRoute.id, CommuteRoute.user_id, CommuteRoute.packed_points, CommuteRoute.gps_points, version)
+                    .where(CommuteRoute.id.in_(changed[offset:offset + 500]))
+                ).all()
+                with self._lock:
+                    for row in batch:
+                        lat, lng, _ = decode_route_points(row)
+                        if len(lat) >= 2:
+                            self._put(row.id, row.user_id, lat, lng, row[4])
+        finally:
+            db.close()
+        self.last_sync_ms = (time.perf_counter() - started) * 1000
+        if changed:
+            logger.info(f"Commute similarity index synced {len(changed)} routes ({len(self._slots)} indexed)")
+
+    def _candidates(self, slot: int, max_distance_m: float) -> np.ndarray:
+        """呼叫端需持有 _lock；以邊界框與起訖點距離排除不可能在門檻內的路線"""
+        size = self._size
+        min_lat, min_lng, max_lat, max_lng = self._bbox[slot]
+        lat_margin = max_distance_m / METERS_PER_DEGREE
+        lng_margin = max_distance_m / (METERS_PER_DEGREE * max(math.cos(math.radians(min(max(abs(min_lat), abs(max_lat)) + lat_margin, 89.9))), 1e-6))
+
+        bbox = self._bbox[:size]
+        mask = (self._route_ids[:size] >= 0) & (self._user_ids[:size] != self._user_ids[slot])
+        mask &= (bbox[:, 0] >= min_lat - lat_margin) & (bbox[:, 2] <= max_lat + lat_margin)
+        mask &= (bbox[:, 1] >= min_lng - lng_margin) & (bbox[:, 3] <= max_lng + lng_margin)
+        mask &= (min_lat >= bbox[:, 0] - lat_margin) & (max_lat <= bbox[:, 2] + lat_margin)
+        mask &= (min_lng >= bbox[:, 1] - lng_margin) & (max_lng <= bbox[:, 3] + lng_margin)
+        candidates = np.flatnonzero(mask)
+
+        shape = self._shapes[slot]
+        shapes = self._shapes[candidates]
+        start_distance = haversine_m_np(shape[0, 0], shape[0, 1], shapes[:, 0, 0], shapes[:, 0, 1])
+        end_distance = haversine_m_np(shape[-1, 0], shape[-1, 1], shapes[:, -1, 0], shapes[:, -1, 1])
+        return candidates[(start_distance <= max_distance_m) & (end_distance <= max_distance_m)]
+
+    @staticmethod
+    def _project(query: np.ndarray, shapes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # 以查詢路線的平均緯度做等距圓柱投影，換算為公尺
+        ref_lat, ref_lng = query.mean(axis=0)
+        scale = np.array([METERS_PER_DEGREE, METERS_PER_DEGREE * math.cos(math.radians(ref_lat))])
+        return (query - (ref_lat, ref_lng)) * scale, (shapes.astype(np.float64) - (ref_lat, ref_lng)) * scale
+
+    def _shortlist(self, query: np.ndarray, shapes: np.ndarray, max_distance_m: float, limit: int) -> np.ndarray:
+        """
+        以上下界縮小需要精確計算的候選（回傳 shapes 的索引）
+
+        兩條路線取樣點數相同，逐點對應是一種合法的配對，其最大距離為 Fréchet 距離的上界；
+        起點距離與終點距離為下界。下界超過第 limit 小的上界的路線不可能進入前 limit 名。
+        """
+        lockstep = np.sqrt(((shapes - query[None]) ** 2).sum(axis=2))  # (k, samples)
+        upper = lockstep.max(axis=1)
+        lower = np.maximum(lockstep[:, 0], lockstep[:, -1])
+        threshold = max_distance_m
+        if len(upper) > limit:
+            threshold = min(threshold, float(np.partition(upper, limit - 1)[limit - 1]))
+        return np.flatnonzero(lower <= threshold)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="commute-similarity")
+        return self._executor
+
+    def similar_for_user(self, user_id: int, max_distance_m: float, limit: int) -> List[Dict[str, Any]]:
+        """
+        找出與用戶任一條路線 Fréchet 距離不超過 max_distance_m 的其他用戶路線
+
+        同一條路線只保留與用戶路線最相近的一組，依距離排序，分數為 1 減去距離 / max_distance_m
+        """
+        started = time.perf_counter()
+        jobs: List[Tuple[int, np.ndarray, np.ndarray, np.ndarray]] = []
+        candidate_count = 0
+        with self._lock:
+            for slot in self._user_slots.get(user_id, ()):
+                candidates = self._candidates(slot, max_distance_m)
+                candidate_count += len(candidates)
+                query, shapes = self._project(self._shapes[slot].astype(np.float64), self._shapes[candidates])
+                shortlist = self._shortlist(query, shapes, max_distance_m, limit)
+                for offset in range(0, len(shortlist), self.chunk_size):
+                    chunk = shortlist[offset:offset + self.chunk_size]
+                    jobs.append((int(self._route_ids[slot]), query, candidates[chunk], shapes[chunk]))
+            route_ids = self._route_ids[:self._size].copy()
+            user_ids = self._user_ids[:self._size].copy()
+
+        if self.workers > 0 and len(jobs) > 1:
+            distances = list(self._get_executor().map(lambda job: discrete_frechet_batch(job[1], job[3]), jobs))
+        else:
+            distances = [discrete_frechet_batch(job[1], job[3]) for job in jobs]
+
+        # 同一條候選路線保留最小距離
+        best: Dict[int, Tuple[float, int]] = {}
+        for (own_route_id, _, chunk, _), chunk_distances in zip(jobs, distances):
+            for slot, distance in zip(chunk[chunk_distances <= max_distance_m].tolist(), chunk_distances[chunk_distances <= max_distance_m].tolist()):
+                if slot not in best or distance < best[slot][0]:
+                    best[slot] = (distance, own_route_id)
+
+        ranked = sorted(best.items(), key=lambda item: item[1][0])[:limit]
+        self.queries += 1
+        self.last_candidates = candidate_count
+        self.last_scored = sum(len(job[2]) for job in jobs)
+        self.last_query_ms = (time.perf_counter() - started) * 1000
+        return [
+            {
+                "route_id": int(route_ids[slot]),
+                "user_id": int(user_ids[slot]),
+                "matched_route_id": own_route_id,
+                "frechet_m": round(distance, 1),
+                "score": round(1 - distance / max_distance_m, 4)
+            }
+            for slot, (distance, own_route_id) in ranked
+        ]
+
+    async def start(self):
+        """載入路線並啟動定期同步工作"""
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.sync_from_db)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Commute similarity index started with {len(self._slots)} routes")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.refresh_s)
+            try:
+                await loop.run_in_executor(None, self.sync_from_db)
+            except Exception as e:
+                logger.error(f"Commute similarity index sync failed: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "indexed_routes": len(self._slots),
+            "samples": self.samples,
+            "workers": self.workers,
+            "queries": self.queries,
+            "last_candidates": self.last_candidates,
+            "last_scored": self.last_scored,
+            "last_query_ms": round(self.last_query_ms, 3),
+            "last_sync_ms": round(self.last_sync_ms, 3)
+        }
+
+
+# 創建全局通勤路線相似度索引實例
+commute_similarity_index = CommuteSimilarityIndex()
@@ -7,6 +7,7 @@ from sqlalchemy.orm import Session
 from datetime import datetime
 from app.database import get_db
 from app.models.user_status import UserStatus
+from app.services.gps_nearby import nearby_user_index
 
 # 設定 logger
 logger = logging.getLogger(__name__)
@@ -73,6 +74,7 @@ class ConnectionManager:
                 logger.info(f"Created new user status record for user {user_id}")
             
             db.commit()
+            nearby_user_index.set_online(user_id, status == "online")
             logger.info(f"Successfully updated user {user_id} status to {status}")
             
         except Exception as e:
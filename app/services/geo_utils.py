@@ -0,0 +1,118 @@
+"""
+地理計算工具
+"""
+
+import math
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8  # 地球平均半徑（公尺）
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """計算兩點間的大圓距離（公尺）"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def haversine_m_np(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """haversine_m 的向量化版本，參數可為 numpy 陣列（支援 broadcasting）"""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = np.radians(np.asarray(lng2) - np.asarray(lng1))
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 9  # 儲存的 geohash 長度（約 4.8 x 4.8 公尺）
+_GEOHASH_CHARS = np.frombuffer(GEOHASH_BASE32.encode(), dtype=np.uint8)
+
+
+def _geohash_bits(precision: int):
+    bits = 5 * precision
+    return bits, (bits + 1) // 2, bits // 2  # (總位元, 經度位元, 緯度位元)
+
+
+def _geohash_interleave(lat_idx: np.ndarray, lng_idx: np.ndarray, precision: int) -> np.ndarray:
+    """交錯經緯度格索引的位元（經度在最高位），得到 geohash 整數"""
+    bits, lng_bits, lat_bits = _geohash_bits(precision)
+    lat_idx = np.asarray(lat_idx, dtype=np.uint64)
+    lng_idx = np.asarray(lng_idx, dtype=np.uint64)
+    code = np.zeros(lat_idx.shape, dtype=np.uint64)
+    one = np.uint64(1)
+    for b in range(bits):
+        if b % 2 == 0:
+            bit = (lng_idx >> np.uint64(lng_bits - 1 - b // 2)) & one
+        else:
+            bit = (lat_idx >> np.uint64(lat_bits - 1 - b // 2)) & one
+        code = (code << one) | bit
+    return code
+
+
+def geohash_to_strings(codes: np.ndarray, precision: int) -> list:
+    """geohash 整數轉為 base32 字串"""
+    codes = np.asarray(codes, dtype=np.uint64)
+    shifts = np.uint64(5) * np.arange(precision - 1, -1, -1, dtype=np.uint64)
+    chars = _GEOHASH_CHARS[((codes[:, None] >> shifts[None, :]) & np.uint64(31)).astype(np.intp)]
+    return np.ascontiguousarray(chars).view(f'S{precision}').ravel().astype(str).tolist()
+
+
+def geohash_cell_index(lat, lng, precision: int):
+    """經緯度所在的緯度、經度格索引"""
+    _, lng_bits, lat_bits = _geohash_bits(precision)
+    lat_idx = np.clip(np.floor((np.asarray(lat, dtype=np.float64) + 90) / 180 * 2 ** lat_bits), 0, 2 ** lat_bits - 1)
+    lng_idx = np.clip(np.floor((np.asarray(lng, dtype=np.float64) + 180) / 360 * 2 ** lng_bits), 0, 2 ** lng_bits - 1)
+    return lat_idx.astype(np.uint64), lng_idx.astype(np.uint64)
+
+
+def geohash_codes_np(lat, lng, precision: int = GEOHASH_PRECISION) -> np.ndarray:
+    """向量化 geohash 編碼（整數，與字串版本的 base32 位元相同）"""
+    lat_idx, lng_idx = geohash_cell_index(np.atleast_1d(lat), np.atleast_1d(lng), precision)
+    return _geohash_interleave(lat_idx, lng_idx, precision)
+
+
+def geohash_encode_np(lat, lng, precision: int = GEOHASH_PRECISION) -> list:
+    """向量化 geohash 編碼"""
+    return geohash_to_strings(geohash_codes_np(lat, lng, precision), precision)
+
+
+def geohash_ranges(min_lat: float, min_lng: float, max_lat: float, max_lng: float, max_cells: int = 64):
+    """
+    將範圍框轉為 geohash 字串區間
+
+    選擇涵蓋格數不超過 max_cells 的最高精度，相鄰（z-order 連續）的格合併為同一區間；
+    回傳 (精度, [(起始字串, 結束字串或 None)])，區間為 起始 <= geohash < 結束
+    """
+    precision = 1
+    for p in range(GEOHASH_PRECISION, 0, -1):
+        (lat_lo, lng_lo), (lat_hi, lng_hi) = [geohash_cell_index(lat, lng, p) for lat, lng in ((min_lat, min_lng), (max_lat, max_lng))]
+        if (int(lat_hi) - int(lat_lo) + 1) * (int(lng_hi) - int(lng_lo) + 1) <= max_cells:
+            precision = p
+            break
+
+    (lat_lo, lng_lo), (lat_hi, lng_hi) = [geohash_cell_index(lat, lng, precision) for lat, lng in ((min_lat, min_lng), (max_lat, max_lng))]
+    lat_grid, lng_grid = np.meshgrid(
+        np.arange(int(lat_lo), int(lat_hi) + 1, dtype=np.uint64),
+        np.arange(int(lng_lo), int(lng_hi) + 1, dtype=np.uint64)
+    )
+    codes = np.unique(_geohash_interleave(lat_grid.ravel(), lng_grid.ravel(), precision))
+
+    # 連續的整數合併為區間 [start, end]
+    breaks = np.flatnonzero(np.diff(codes) != 1) + 1
+    starts = codes[np.concatenate(([0], breaks))]
+    ends = codes[np.concatenate((breaks - 1, [len(codes) - 1]))] + np.uint64(1)
+
+    limit = 1 << (5 * precision)
+    start_strings = geohash_to_strings(starts, precision)
+    valid_ends = ends < np.uint64(limit)
+    end_strings = geohash_to_strings(ends[valid_ends], precision) if valid_ends.any() else []
+    end_iter = iter(end_strings)
+    return precision, [
+        (start, next(end_iter) if valid else None)
+        for start, valid in zip(start_strings, valid_ends.tolist())
+    ]
@@ -0,0 +1,364 @@
+"""
+GPS 冷資料歸檔 - 將熱資料窗口以外的定位點移到本地壓縮檔
+
+每位用戶每個月一個檔案（{GPS_ARCHIVE_DIR}/{user_id}/{YYYY-MM}.npz.z），內容為欄式 numpy 陣列
+（id、timestamp 微秒、latitude、longitude），以 zstd 壓縮（未安裝 zstandard 時改用 zlib）。
+歸檔後的資料列會從 gps_locations 分批刪除，查詢時由 gps_track_service 自動合併讀取。
+"""
+
+import asyncio
+import io
+import logging
+import os
+import threading
+import zlib
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import delete, func, select
+from app.database import SessionLocal
+from app.models.gps_route import GPSLocation
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+EPOCH = np.datetime64('1970-01-01T00:00:00', 'us')
+
+
+def _month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def _next_month(month_start: date) -> date:
+    return date(month_start.year + month_start.month // 12, month_start.month % 12 + 1, 1)
+
+
+def _to_micros(timestamps: List[datetime]) -> np.ndarray:
+    return (np.array(timestamps, dtype='datetime64[us]') - EPOCH).astype(np.int64)
+
+
+def _to_datetimes(micros: np.ndarray) -> List[datetime]:
+    return (EPOCH + micros.astype('timedelta64[us]')).astype(datetime).tolist()
+
+
+class GPSArchive:
+    """按用戶、按月的冷資料歸檔"""
+
+    def __init__(self):
+        self.enabled = os.getenv('GPS_ARCHIVE_ENABLED', 'false').lower() == 'true'
+        self.directory = os.getenv('GPS_ARCHIVE_DIR', './gps_archive')
+        self.hot_days = int(os.getenv('GPS_ARCHIVE_HOT_DAYS', '90'))  # 資料庫中保留的天數
+        self.interval = float(os.getenv('GPS_ARCHIVE_INTERVAL_S', '86400'))
+        self.chunk_size = int(os.getenv('GPS_PURGE_CHUNK_SIZE', '5000'))
+        self.compression_level = int(os.getenv('GPS_ARCHIVE_ZSTD_LEVEL', '9'))
+
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        # 統計資料
+        self.archived_rows = 0
+        self.archive_runs = 0
+        self.last_archive_run: Optional[datetime] = None
+
+        if self.enabled and zstandard is None:
+            logger.warning("zstandard not available, GPS archive files will be compressed with zlib")
+
+    def hot_boundary(self) -> datetime:
+        """熱資料窗口的起點（此時間之前的完整日期可以歸檔）"""
+        return datetime.combine(date.today() - timedelta(days=self.hot_days), datetime.min.time())
+
+    def _path(self, user_id: int, month_start: date) -> str:
+        return os.path.join(self.directory, str(user_id), f"{month_start.year:04d}-{month_start.month:02d}.npz.z")
+
+    def _months(self, user_id: int) -> List[date]:
+        user_dir = os.path.join(self.directory, str(user_id))
+        if not os.path.isdir(user_dir):
+            return []
+        months = []
+        for name in os.listdir(user_dir):
+            if name.endswith('.npz.z'):
+                year, month = name[:7].split('-')
+                months.append(date(int(year), int(month), 1))
+        return sorted(months)
+
+    def _load(self, path: str) -> Optional[Dict[str, np.ndarray]]:
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:4] == ZSTD_MAGIC:
+            if zstandard is None:
+                raise RuntimeError(f"zstandard is required to read {path}")
+            raw = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            raw = zlib.decompress(data)
+        with np.load(io.BytesIO(raw), allow_pickle=False) as npz:
+            return {key: npz[key] for key in ("id", "ts", "lat", "lng")}
+
+    def _save(self, path: str, arrays: Dict[str, np.ndarray]):
+        """寫入暫存檔後再取代，避免讀到寫到一半的檔案"""
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        raw = buffer.getvalue()
+        if zstandard is not None:
+            data = zstandard.ZstdCompressor(level=self.compression_level).compress(raw)
+        else:
+            data = zlib.compress(raw, 6)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _write_month(self, user_id: int, month_start: date, arrays: Dict[str, np.ndarray]):
+        """以 (timestamp, id) 排序並依 id 去重後寫入，沒有資料時刪除檔案"""
+        path = self._path(user_id, month_start)
+        _, unique = np.unique(arrays["id"], return_index=True)
+        arrays = {key: value[unique] for key, value in arrays.items()}
+        order = np.lexsort((arrays["id"], arrays["ts"]))
+        arrays = {key: value[order] for key, value in arrays.items()}
+        if len(arrays["id"]):
+            self._save(path, arrays)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def archive_closed_days(self) -> int:
+        """將熱資料窗口以前的定位點歸檔並從資料庫刪除，回傳歸檔數量"""
+        if not self.enabled:
+            return 0
+
+        cutoff = self.hot_boundary()
+        db = SessionLocal()
+        try:
+            user_ids = db.scalars(
+                select(GPSLocation.user_id).where(GPSLocation.timestamp < cutoff).distinct()
+            ).all()
+        finally:
+            db.close()
+
+        total = 0
+        for user_id in user_ids:
+            total += self._archive_user(user_id, cutoff)
+
+        self.archive_runs += 1
+        self.archived_rows += total
+        self.last_archive_run = datetime.utcnow()
+        if total:
+            logger.info(f"Archived {total} GPS locations older than {cutoff.date()} for {len(user_ids)} users")
+        return total
+
+    def _archive_user(self, user_id: int, cutoff: datetime) -> int:
+        db = SessionLocal()
+        try:
+            oldest = db.scalar(
+                select(func.min(GPSLocation.timestamp)).where(GPSLocation.user_id == user_id, GPSLocation.timestamp < cutoff)
+            )
+            if oldest is None:
+                return 0
+
+            total = 0
+            month_start = _month_start(oldest.date())
+            while datetime.combine(month_start, datetime.min.time()) < cutoff:
+                start = datetime.combine(month_start, datetime.min.time())
+                end = min(datetime.combine(_next_month(month_start), datetime.min.time()), cutoff)
+                conditions = (GPSLocation.user_id == user_id, GPSLocation.timestamp >= start, GPSLocation.timestamp < end)
+
+                rows = db.execute(
+                    select(GPSLocation.id, GPSLocation.timestamp, GPSLocation.latitude, GPSLocation.longitude)
+                    .where(*conditions)
+                ).all()
+                if rows:
+                    ids, timestamps, lats, lngs = zip(*rows)
+                    fresh = {
+                        "id": np.array(ids, dtype=np.int64),
+                        "ts": _to_micros(timestamps),
+                        "lat": np.array(lats, dtype=np.float64),
+                        "lng": np.array(lngs, dtype=np.float64)
+                    }
+                    with self._lock:
+                        existing = self._load(self._path(user_id, month_start))
+                        if existing is not None:
+                            fresh = {key: np.concatenate([existing[key], fresh[key]]) for key in fresh}
+                        self._write_month(user_id, month_start, fresh)
+
+                    # 檔案寫入後才刪除；只刪除已歸檔的 ID，歸檔期間新寫入的舊定位點留待下次處理
+                    for i in range(0, len(ids), self.chunk_size):
+                        db.execute(delete(GPSLocation).where(GPSLocation.id.in_(ids[i:i + self.chunk_size]), *conditions[1:]))
+                        db.commit()
+                    total += len(ids)
+
+                month_start = _next_month(month_start)
+            return total
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def read(
+        self,
+        user_id: int,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        descending: bool = False,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[datetime, int]] = None
+    ) -> List[Tuple[int, datetime, float, float]]:
+        """讀取歸檔定位點，條件與排序同 query_track；依排序方向逐月讀取，取滿 limit 即停止"""
+        rows = []
+        for chunk in self.iter_months(user_id, start, end, descending, after):
+            rows.extend(chunk)
+            if limit is not None and len(rows) >= limit:
+                return rows[:limit]
+        return rows
+
+    def iter_months(
+        self,
+        user_id: int,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        descending: bool = False,
+        after: Optional[Tuple[datetime, int]] = None
+    ) -> Iterator[List[Tuple[int, datetime, float, float]]]:
+        """依排序方向逐月產出符合條件的歸檔定位點"""
+        if not self.enabled:
+            return
+        months = self._months(user_id)
+        if start is not None:
+            months = [m for m in months if _next_month(m) > start.date()]
+        if end is not None:
+            months = [m for m in months if m <= end.date()]
+        if descending:
+            months.reverse()
+
+        for month_start in months:
+            with self._lock:
+                arrays = self._load(self._path(user_id, month_start))
+            if arrays is None:
+                continue
+
+            ts = arrays["ts"]
+            ids = arrays["id"]
+            mask = np.ones(len(ts), dtype=bool)
+            if start is not None:
+                mask &= ts >= _to_micros([start])[0]
+            if end is not None:
+                mask &= ts <= _to_micros([end])[0]
+            if after is not None:
+                after_ts = _to_micros([after[0]])[0]
+                if descending:
+                    mask &= (ts < after_ts) | ((ts == after_ts) & (ids < after[1]))
+                else:
+                    mask &= (ts > after_ts) | ((ts == after_ts) & (ids > after[1]))
+
+            selected = np.flatnonzero(mask)
+            if descending:
+                selected = selected[::-1]
+            if len(selected) == 0:
+                continue
+            yield list(zip(
+                ids[selected].tolist(),
+                _to_datetimes(ts[selected]),
+                arrays["lat"][selected].tolist(),
+                arrays["lng"][selected].tolist()
+            ))
+
+    def has_data(self, user_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None) -> bool:
+        """範圍內是否可能有歸檔資料（只檢查月份檔案是否存在）"""
+        if not self.enabled:
+            return False
+        for month_start in self._months(user_id):
+            if (start is None or _next_month(month_start) > start.date()) and (end is None or month_start <= end.date()):
+                return True
+        return False
+
+    def delete(self, user_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None) -> int:
+        """刪除用戶範圍內的歸檔定位點，回傳刪除數量"""
+        if not self.enabled:
+            return 0
+        deleted = 0
+        for month_start in self._months(user_id):
+            if start is not None and _next_month(month_start) <= start.date():
+                continue
+            if end is not None and month_start > end.date():
+                continue
+            with self._lock:
+                arrays = self._load(self._path(user_id, month_start))
+                if arrays is None:
+                    continue
+                mask = np.ones(len(arrays["ts"]), dtype=bool)
+                if start is not None:
+                    mask &= arrays["ts"] >= _to_micros([start])[0]
+                if end is not None:
+                    mask &= arrays["ts"] <= _to_micros([end])[0]
+                deleted += int(mask.sum())
+                self._write_month(user_id, month_start, {key: value[~mask] for key, value in arrays.items()})
+        return deleted
+
+    def drop_before(self, cutoff: datetime) -> int:
+        """刪除早於 cutoff 的歸檔定位點（保留期限用），整月過期的檔案直接刪除，回傳處理的用戶數"""
+        if not self.enabled or not os.path.isdir(self.directory):
+            return 0
+        users = 0
+        for name in os.listdir(self.directory):
+            if not name.isdigit():
+                continue
+            user_id = int(name)
+            months = [m for m in self._months(user_id) if datetime.combine(m, datetime.min.time()) < cutoff]
+            if not months:
+                continue
+            for month_start in months:
+                if datetime.combine(_next_month(month_start), datetime.min.time()) <= cutoff:
+                    with self._lock:
+                        os.remove(self._path(user_id, month_start))
+            self.delete(user_id, end=cutoff - timedelta(microseconds=1))
+            users += 1
+        return users
+
+    async def start(self):
+        """啟動定期歸檔工作"""
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"GPS archiver started (hot_days={self.hot_days}, dir={self.directory})")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.archive_closed_days)
+            except Exception as e:
+                logger.error(f"GPS archive run failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "hot_days": self.hot_days,
+            "hot_boundary": self.hot_boundary().isoformat(),
+            "compression": "zstd" if zstandard is not None else "zlib",
+            "archive_runs": self.archive_runs,
+            "archived_rows": self.archived_rows,
+            "last_archive_run": self.last_archive_run.isoformat() if self.last_archive_run else None
+        }
+
+
+# 創建全局 GPS 冷資料歸檔實例
+gps_archive = GPSArchive()
@@ -0,0 +1,112 @@
+"""
+GPS 軌跡精簡編碼 - Google polyline 與二進位封裝格式
+
+二進位格式（little-endian）：
+    header: magic b'GPSB' (4 bytes) | version uint16 | count uint32 | base_ts int64（epoch 秒）
+    body:   lat int32[count]（微度）| lng int32[count]（微度）| dt int32[count]（與前一點相差秒數，第一點為 0）
+
+版本 2 表示沒有時間的定位點（例如手動建立的通勤路線）：base_ts 為 0，省略 dt 陣列。
+"""
+
+import calendar
+import struct
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+
+BINARY_MAGIC = b'GPSB'
+BINARY_VERSION = 1
+BINARY_VERSION_NO_TIME = 2
+BINARY_HEADER = struct.Struct('<4sHIq')
+
+
+def to_epoch_seconds(timestamps: Sequence[datetime]) -> np.ndarray:
+    """datetime 轉 epoch 秒（無時區的時間視為 UTC）"""
+    return np.fromiter(
+        (calendar.timegm(ts.utctimetuple()) for ts in timestamps),
+        dtype=np.int64,
+        count=len(timestamps)
+    )
+
+
+def encode_varints(values: np.ndarray) -> str:
+    """以 polyline 演算法編碼整數陣列（zigzag + 每 5 bits 一組），全程向量化"""
+    if len(values) == 0:
+        return ""
+    values = np.asarray(values, dtype=np.int64)
+    zigzag = np.where(values < 0, ~(values << 1), values << 1).astype(np.uint64)
+
+    # 每個數值最多 64/5 → 13 組；先算出每組的 5 bits 與是否還有下一組
+    shifts = np.arange(13, dtype=np.uint64) * np.uint64(5)
+    chunks = (zigzag[:, None] >> shifts[None, :]) & np.uint64(0x1f)
+    remaining = zigzag[:, None] >> (shifts[None, :] + np.uint64(5))
+    has_more = remaining > 0
+
+    # 第一組一定輸出，之後只在前一組有後續時輸出
+    used = np.concatenate([np.ones((len(zigzag), 1), dtype=bool), has_more[:, :-1]], axis=1)
+    chars = (chunks | np.where(has_more, np.uint64(0x20), np.uint64(0))) + np.uint64(63)
+    return chars[used].astype(np.uint8).tobytes().decode('ascii')
+
+
+def decode_varints(encoded: str) -> List[int]:
+    """encode_varints 的反向解碼"""
+    values = []
+    result = 0
+    shift = 0
+    for char in encoded:
+        chunk = ord(char) - 63
+        result |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(result >> 1) if result & 1 else result >> 1)
+            result = 0
+            shift = 0
+    return values
+
+
+def encode_polyline(lat: np.ndarray, lng: np.ndarray, precision: int = 5) -> str:
+    """Google polyline 編碼（座標差分後交錯編碼）"""
+    factor = 10 ** precision
+    lat_int = np.round(np.asarray(lat) * factor).astype(np.int64)
+    lng_int = np.round(np.asarray(lng) * factor).astype(np.int64)
+    deltas = np.empty(len(lat_int) * 2, dtype=np.int64)
+    deltas[0::2] = np.diff(lat_int, prepend=0)
+    deltas[1::2] = np.diff(lng_int, prepend=0)
+    return encode_varints(deltas)
+
+
+def decode_polyline(encoded: str, precision: int = 5) -> List[Tuple[float, float]]:
+    """Google polyline 解碼"""
+    deltas = np.array(decode_varints(encoded), dtype=np.int64)
+    coords = np.cumsum(deltas.reshape(-1, 2), axis=0) / 10 ** precision
+    return [tuple(pair) for pair in coords.tolist()]
+
+
+def pack_points(lat: np.ndarray, lng: np.ndarray, epoch_seconds: Optional[np.ndarray]) -> bytes:
+    """封裝為二進位格式（int32 微度 + 差分秒數）；epoch_seconds 為 None 時以版本 2 標記沒有時間"""
+    count = len(lat)
+    lat_micro = np.round(np.asarray(lat) * 1e6).astype('<i4')
+    lng_micro = np.round(np.asarray(lng) * 1e6).astype('<i4')
+    if epoch_seconds is None:
+        header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION_NO_TIME, count, 0)
+        return header + lat_micro.tobytes() + lng_micro.tobytes()
+
+    base_ts = int(epoch_seconds[0]) if count else 0
+    dt = np.diff(np.asarray(epoch_seconds, dtype=np.int64), prepend=base_ts).astype('<i4')
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, count, base_ts)
+    return header + lat_micro.tobytes() + lng_micro.tobytes() + dt.tobytes()
+
+
+def unpack_points(data: bytes) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """解開二進位格式，回傳 (lat, lng, epoch 秒)；沒有時間（版本 2）時 epoch 為 None"""
+    magic, version, count, base_ts = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC or version not in (BINARY_VERSION, BINARY_VERSION_NO_TIME):
+        raise ValueError('不支援的 GPS 二進位格式')
+    columns = 3 if version == BINARY_VERSION else 2
+    body = np.frombuffer(data, dtype='<i4', count=count * columns, offset=BINARY_HEADER.size)
+    lat = body[:count] / 1e6
+    lng = body[count:2 * count] / 1e6
+    if version == BINARY_VERSION_NO_TIME:
+        return lat, lng, None
+    epoch_seconds = base_ts + np.cumsum(body[2 * count:].astype(np.int64))
+    return lat, lng, epoch_seconds
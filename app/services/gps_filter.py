@@ -0,0 +1,222 @@
+"""
+GPS 寫入過濾器 - 在寫入資料庫前略過靜止重複點並標記瞬移異常點
+
+個別用戶的門檻存於 gps_filter_settings，各程序定期重新載入；
+最後接受的定位點只在寫入成功後（commit）才更新，寫入失敗的定位點不影響之後的過濾
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.models.gps_route import GPSFilterSettings
+from app.services.geo_utils import haversine_m
+
+logger = logging.getLogger(__name__)
+
+
+def _epoch_seconds(timestamp: datetime) -> float:
+    # 無時區的時間為 UTC；datetime.timestamp() 會把它當作本地時間
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+class GPSIngestFilter:
+    """依每位用戶最後一個接受的定位點過濾新定位點"""
+
+    def __init__(self):
+        self.enabled = os.getenv('GPS_INGEST_FILTER_ENABLED', 'false').lower() == 'true'
+
+        # 預設門檻，可針對個別用戶覆寫
+        self.default_thresholds = {
+            "min_distance_m": float(os.getenv('GPS_FILTER_MIN_DISTANCE_M', '10')),     # 小於此距離視為未移動
+            "min_interval_s": float(os.getenv('GPS_FILTER_MIN_INTERVAL_S', '1')),      # 小於此間隔的定位點一律略過
+            "keepalive_s": float(os.getenv('GPS_FILTER_KEEPALIVE_S', '300')),          # 靜止時仍每隔此秒數保留一點
+            "max_speed_mps": float(os.getenv('GPS_FILTER_MAX_SPEED_MPS', '70')),       # 超過此速度視為瞬移異常
+        }
+        self.user_thresholds: Dict[int, Dict[str, float]] = {}
+        self.settings_refresh_s = float(os.getenv('GPS_FILTER_SETTINGS_REFRESH_S', '30'))  # 重新載入門檻設定的間隔
+        self._task: Optional[asyncio.Task] = None
+
+        self._last_accepted: Dict[int, Tuple[float, float, float]] = {}  # {user_id: (lat, lng, epoch)}
+        self._last_flagged: Dict[int, Tuple[float, float, float]] = {}
+        self._lock = threading.Lock()
+
+        # 統計資料
+        self.accepted_count = 0
+        self.dropped_count = 0
+        self.flagged_count = 0
+
+    def get_thresholds(self, user_id: int) -> Dict[str, float]:
+        return {**self.default_thresholds, **self.user_thresholds.get(user_id, {})}
+
+    def set_user_thresholds(self, db: Session, user_id: int, thresholds: Dict[str, Optional[float]]):
+        """覆寫個別用戶的門檻並寫入資料庫（值為 None 的欄位沿用預設，全部為 None 時刪除設定）"""
+        overrides = {k: v for k, v in thresholds.items() if v is not None and k in self.default_thresholds}
+        settings = db.query(GPSFilterSettings).filter(GPSFilterSettings.user_id == user_id).first()
+        if overrides:
+            if settings is None:
+                settings = GPSFilterSettings(user_id=user_id)
+                db.add(settings)
+            for key in self.default_thresholds:
+                setattr(settings, key, overrides.get(key))
+        elif settings is not None:
+            db.delete(settings)
+        db.commit()
+
+        # 本程序立即生效，其他程序於下次重新載入時生效
+        with self._lock:
+            if overrides:
+                self.user_thresholds[user_id] = overrides
+            else:
+                self.user_thresholds.pop(user_id, None)
+
+    def load_settings(self):
+        """由資料庫載入所有用戶的門檻設定"""
+        db = SessionLocal()
+        try:
+            user_thresholds = {}
+            for settings in db.query(GPSFilterSettings).all():
+                overrides = {
+                    key: getattr(settings, key) for key in self.default_thresholds
+                    if getattr(settings, key) is not None
+                }
+                if overrides:
+                    user_thresholds[settings.user_id] = overrides
+        finally:
+            db.close()
+        with self._lock:
+            self.user_thresholds = user_thresholds
+
+    async def start(self):
+        """載入門檻設定並啟動定期重新載入工作"""
+        if not self.enabled or self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.load_settings)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"GPS ingest filter started with {len(self.user_thresholds)} user overrides")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.settings_refresh_s)
+            try:
+                await loop.run_in_executor(None, self.load_settings)
+            except Exception as e:
+                logger.error(f"GPS ingest filter settings refresh failed: {e}")
+
+    def apply(self, rows: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int, int]:
+        """
+        過濾一批定位點（依時間順序處理）
+
+        回傳 (接受的資料列, 略過數量, 標記為異常的數量)；接受的資料列寫入成功後需呼叫 commit()
+        """
+        if not self.enabled or not rows:
+            return rows, 0, 0
+
+        accepted = []
+        dropped = 0
+        flagged = 0
+        # 批次內依序以前面接受的定位點為基準，寫入成功前不更新共用狀態
+        last_accepted: Dict[int, Tuple[float, float, float]] = {}
+        with self._lock:
+            for row in rows:
+                verdict = self._check(row, last_accepted)
+                if verdict == "accept":
+                    accepted.append(row)
+                elif verdict == "drop":
+                    dropped += 1
+                else:
+                    flagged += 1
+
+            self.accepted_count += len(accepted)
+            self.dropped_count += dropped
+            self.flagged_count += flagged
+
+        if flagged:
+            logger.warning(f"GPS ingest filter flagged {flagged} implausible points for user {rows[0]['user_id']}")
+        return accepted, dropped, flagged
+
+    def commit(self, rows: List[Dict[str, Any]]):
+        """已接受的定位點寫入成功後，更新各用戶最後接受的定位點"""
+        if not self.enabled or not rows:
+            return
+        with self._lock:
+            for row in rows:
+                user_id = row["user_id"]
+                point = (row["latitude"], row["longitude"], _epoch_seconds(row["timestamp"]))
+                last = self._last_accepted.get(user_id)
+                # 晚到的舊定位點不更新狀態
+                if last is None or point[2] >= last[2]:
+                    self._last_accepted[user_id] = point
+                    flagged_point = self._last_flagged.get(user_id)
+                    if flagged_point is not None and flagged_point[2] <= point[2]:
+                        self._last_flagged.pop(user_id, None)
+
+    def _check(self, row: Dict[str, Any], last_accepted: Dict[int, Tuple[float, float, float]]) -> str:
+        user_id = row["user_id"]
+        point = (row["latitude"], row["longitude"], _epoch_seconds(row["timestamp"]))
+        last = last_accepted.get(user_id) or self._last_accepted.get(user_id)
+
+        if last is None:
+            last_accepted[user_id] = point
+            return "accept"
+
+        dt = point[2] - last[2]
+        # 晚到的舊定位點不做過濾，也不更新狀態
+        if dt < 0:
+            return "accept"
+
+        thresholds = self.get_thresholds(user_id)
+        if dt < thresholds["min_interval_s"]:
+            return "drop"
+
+        distance = haversine_m(last[0], last[1], point[0], point[1])
+        if distance < thresholds["min_distance_m"] and dt < thresholds["keepalive_s"]:
+            return "drop"
+
+        speed = distance / dt if dt > 0 else float('inf')
+        if speed > thresholds["max_speed_mps"]:
+            # 若與上一個異常點相符（真的移動到新位置），改為接受
+            flagged_point = self._last_flagged.get(user_id)
+            if flagged_point is not None and point[2] > flagged_point[2]:
+                jump = haversine_m(flagged_point[0], flagged_point[1], point[0], point[1])
+                if jump / (point[2] - flagged_point[2]) <= thresholds["max_speed_mps"]:
+                    last_accepted[user_id] = point
+                    return "accept"
+            # 異常點不寫入資料庫，直接記錄
+            self._last_flagged[user_id] = point
+            return "flag"
+
+        last_accepted[user_id] = point
+        return "accept"
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "default_thresholds": self.default_thresholds,
+            "users_with_overrides": len(self.user_thresholds),
+            "tracked_users": len(self._last_accepted),
+            "accepted": self.accepted_count,
+            "dropped": self.dropped_count,
+            "flagged": self.flagged_count
+        }
+
+
+# 創建全局 GPS 寫入過濾器實例
+gps_ingest_filter = GPSIngestFilter()
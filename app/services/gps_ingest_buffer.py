@@ -0,0 +1,354 @@
+"""
+GPS 寫入緩衝區 - 集中多個請求的定位點，以單一交易批次寫入
+
+啟用寫入日誌（GPS_JOURNAL_ENABLED）時，定位點在 fsync 到本地日誌後即回應，
+不必等待資料庫寫入；寫入資料庫失敗的批次在執行期間定時重試，
+仍未寫入的定位點會在下次啟動時重播（已寫入的日誌位置會略過）。
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+from app.database import SessionLocal
+from app.services.gps_service import insert_gps_rows
+from app.services.gps_journal import (
+    GPSJournal, gps_journal, is_committed, load_journal_commits, record_journal_commit
+)
+
+logger = logging.getLogger(__name__)
+
+
+class GPSIngestBuffer:
+    """GPS 寫入緩衝區（write-behind + group commit）"""
+
+    def __init__(self, journal=gps_journal):
+        self.journal = journal
+        self.enabled = os.getenv('GPS_INGEST_BUFFER_ENABLED', 'true').lower() == 'true'
+        self.max_size = int(os.getenv('GPS_BUFFER_MAX_SIZE', '500'))          # 達到筆數即寫入
+        self.max_age = float(os.getenv('GPS_BUFFER_MAX_AGE_MS', '200')) / 1000  # 最舊一筆等待上限（秒）
+        self.retry_s = float(os.getenv('GPS_JOURNAL_RETRY_S', '5'))              # 寫入失敗批次的重試間隔（秒）
+
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._failed: List[list] = []  # 日誌模式下寫入資料庫失敗、等待重試的批次
+        self._retry_task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+        # 統計資料
+        self.flush_count = 0
+        self.flushed_rows = 0
+        self.failed_flushes = 0
+        self.retried_rows = 0
+        self.in_flight = 0
+        self.last_flush_size = 0
+        self.last_flush_latency_ms = 0.0
+        self.max_flush_latency_ms = 0.0
+        self.total_flush_latency_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """啟動背景寫入工作"""
+        if not self.enabled or self.running:
+            return
+        if self.journal.enabled:
+            await self._replay_journal()
+        self.queue = asyncio.Queue()
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"GPS ingest buffer started (max_size={self.max_size}, max_age={self.max_age}s)")
+
+    async def stop(self):
+        """停止背景工作，並寫入所有尚未寫入的定位點"""
+        if not self.running:
+            return
+        await self.queue.put(None)  # 結束信號，排在所有待寫入資料之後
+        await self._task
+        self._task = None
+        # 最後一次重試失敗批次，仍失敗的留在日誌中待下次啟動重播
+        self._stopping.set()
+        if self._retry_task is not None:
+            await self._retry_task
+            self._retry_task = None
+        if self._failed:
+            logger.error(
+                f"{sum(len(batch) for batch in self._failed)} GPS rows not written to the database, "
+                "kept in the journal for next startup"
+            )
+        if self.journal.enabled:
+            await self.journal.close()
+        logger.info("GPS ingest buffer stopped")
+
+    async def _replay_journal(self):
+        """將上次未寫入資料庫的日誌資料寫入資料庫，並接手已停止程序留下的日誌目錄"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.journal.claim)
+        committed = await loop.run_in_executor(None, self._load_commits, self.journal.journal_id)
+        seqs, rows, offsets = await loop.run_in_executor(
+            None, self.journal.open, committed[-1][1] if committed else -1
+        )
+        await self._replay_segments(self.journal, committed, seqs, rows, offsets)
+
+        # 其他目錄若未被鎖定，表示其程序已停止，由本程序重播其中的定位點
+        for slot in self.journal.other_slots():
+            orphan = GPSJournal()
+            orphan.directory = self.journal.directory
+            if orphan.claim(slot) is None:
+                continue
+            try:
+                committed = await loop.run_in_executor(None, self._load_commits, slot)
+                seqs, rows, offsets = await loop.run_in_executor(None, orphan.read_segments)
+                if seqs:
+                    logger.info(f"Adopting GPS journal directory worker-{slot}")
+                    await self._replay_segments(orphan, committed, seqs, rows, offsets)
+            finally:
+                orphan.release_slot()
+
+    async def _replay_segments(self, journal: GPSJournal, committed, seqs, rows, offsets):
+        """重播日誌目錄中未寫入資料庫的定位點，成功後刪除分段"""
+        loop = asyncio.get_running_loop()
+
+        # 崩潰於提交後、刪除分段前的資料已在資料庫中，不再重複寫入
+        starts = [first for first, _ in committed]
+        pending = [i for i, offset in enumerate(offsets) if not is_committed(committed, starts, offset)]
+        if len(pending) < len(rows):
+            logger.info(f"Skipping {len(rows) - len(pending)} GPS journal records already written to the database")
+        if not pending:
+            journal.discard(seqs)
+            return
+
+        logger.info(f"Replaying {len(pending)} GPS locations from {len(seqs)} journal segments")
+        try:
+            for i in range(0, len(pending), self.max_size):
+                chunk = pending[i:i + self.max_size]
+                await loop.run_in_executor(
+                    None, self._write,
+                    [rows[j] for j in chunk], [offsets[j] for j in chunk], journal.journal_id, journal.watermark
+                )
+        except Exception as e:
+            # 保留分段檔，下次啟動再重播
+            logger.error(f"GPS journal replay failed, segments kept for next startup: {e}")
+            return
+        journal.discard(seqs)
+        logger.info("GPS journal replay completed")
+
+    async def submit(self, row: Dict[str, Any]) -> Optional[int]:
+        """加入單一定位點，寫入完成後回傳 ID（日誌模式下回傳 None）"""
+        ids = await self.submit_many([row])
+        return ids[0]
+
+    async def submit_many(self, rows: List[Dict[str, Any]]) -> List[Optional[int]]:
+        """加入多個定位點，寫入完成後依序回傳 ID（日誌模式下回傳 None）"""
+        if not rows:
+            return []
+
+        loop = asyncio.get_running_loop()
+
+        # 未啟用緩衝區時直接寫入
+        if not self.running:
+            return await loop.run_in_executor(None, self._write, rows)
+
+        # 日誌模式：fsync 到日誌後即回應，資料庫寫入在背景進行
+        if self.journal.enabled:
+            if self.journal.segment_full:
+                await self.journal.rotate()
+            seq, first = self.journal.append(rows)
+            for i, row in enumerate(rows):
+                self.queue.put_nowait((row, None, seq, first + i))
+            await self.journal.sync()
+            return [None] * len(rows)
+
+        futures = []
+        for row in rows:
+            future = loop.create_future()
+            self.queue.put_nowait((row, future, None, None))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+
+    async def _run(self):
+        """背景迴圈：依筆數或等待時間觸發批次寫入"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = loop.time() + self.max_age
+            while len(batch) < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+        # 關閉前寫入剩餘資料
+        remaining = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                remaining.append(item)
+        for i in range(0, len(remaining), self.max_size):
+            await self._flush(remaining[i:i + self.max_size])
+
+    async def _flush(self, batch):
+        """以單一交易寫入一批定位點，並通知等待中的請求"""
+        loop = asyncio.get_running_loop()
+        rows = [row for row, _, _, _ in batch]
+        offsets = None
+
+        # 分段已滿或已開啟一段時間時，之後的寫入進入新分段，方便刪除已寫入的分段
+        if self.journal.enabled:
+            if self.journal.segment_due:
+                await self.journal.rotate()
+            offsets = [offset for _, _, _, offset in batch]
+
+        self.in_flight = len(rows)
+        started = time.perf_counter()
+        try:
+            ids = await loop.run_in_executor(
+                None, self._write, rows, offsets, self.journal.journal_id, self.journal.watermark
+            )
+        except Exception as e:
+            self.failed_flushes += 1
+            logger.error(f"GPS ingest buffer flush failed ({len(rows)} rows): {e}")
+            if self.journal.enabled:
+                # 定位點仍在日誌中，於背景定時重試寫入
+                self._failed.append(batch)
+                if self._retry_task is None or self._retry_task.done():
+                    self._retry_task = asyncio.create_task(self._retry_failed())
+            for _, future, _, _ in batch:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.in_flight = 0
+
+        latency_ms = (time.perf_counter() - started) * 1000
+        self.flush_count += 1
+        self.flushed_rows += len(rows)
+        self.last_flush_size = len(rows)
+        self.last_flush_latency_ms = latency_ms
+        self.max_flush_latency_ms = max(self.max_flush_latency_ms, latency_ms)
+        self.total_flush_latency_ms += latency_ms
+
+        for (_, future, _, _), location_id in zip(batch, ids):
+            if future is not None and not future.done():
+                future.set_result(location_id)
+
+        self._release(batch)
+
+    def _release(self, batch):
+        """已寫入資料庫的日誌分段可以刪除"""
+        segment_counts: Dict[int, int] = {}
+        for _, _, seq, _ in batch:
+            if seq is not None:
+                segment_counts[seq] = segment_counts.get(seq, 0) + 1
+        for seq, count in segment_counts.items():
+            self.journal.release(seq, count)
+
+    async def _retry_failed(self):
+        """定時重試寫入失敗的批次；停止時最後再嘗試一次"""
+        while self._failed:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.retry_s)
+            except asyncio.TimeoutError:
+                pass
+            await self._retry_once()
+            if self._stopping.is_set():
+                return
+
+    async def _retry_once(self):
+        loop = asyncio.get_running_loop()
+        while self._failed:
+            batch = self._failed[0]
+            try:
+                written = await loop.run_in_executor(None, self._write_uncommitted, batch)
+            except Exception as e:
+                logger.warning(f"GPS ingest buffer retry failed ({len(batch)} rows): {e}")
+                return
+            self._failed.pop(0)
+            self.retried_rows += written
+            self._release(batch)
+
+    def _write_uncommitted(self, batch) -> int:
+        """寫入批次中尚未寫入資料庫的定位點（提交結果不明時可能已寫入），回傳寫入筆數"""
+        journal_id = self.journal.journal_id
+        committed = self._load_commits(journal_id)
+        starts = [first for first, _ in committed]
+        pending = [item for item in batch if not is_committed(committed, starts, item[3])]
+        if pending:
+            self._write(
+                [row for row, _, _, _ in pending], [offset for _, _, _, offset in pending],
+                journal_id, self.journal.watermark
+            )
+        return len(pending)
+
+    @staticmethod
+    def _write(
+        rows: List[Dict[str, Any]],
+        offsets: Optional[List[int]] = None,
+        journal_id: Optional[int] = None,
+        watermark: Optional[int] = None
+    ) -> List[int]:
+        db = SessionLocal()
+        try:
+            if offsets is None:
+                return insert_gps_rows(db, rows)
+            # 日誌位置與定位點同一交易提交，重播時可略過已寫入的紀錄
+            return insert_gps_rows(
+                db, rows,
+                before_commit=lambda session: record_journal_commit(session, journal_id, offsets, watermark)
+            )
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    @staticmethod
+    def _load_commits(journal_id: int):
+        db = SessionLocal()
+        try:
+            return load_journal_commits(db, journal_id)
+        finally:
+            db.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """取得緩衝區狀態"""
+        return {
+            "enabled": self.enabled,
+            "running": self.running,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "in_flight": self.in_flight,
+            "max_size": self.max_size,
+            "max_age_ms": self.max_age * 1000,
+            "flush_count": self.flush_count,
+            "flushed_rows": self.flushed_rows,
+            "failed_flushes": self.failed_flushes,
+            "retry_pending_rows": sum(len(batch) for batch in self._failed),
+            "retried_rows": self.retried_rows,
+            "last_flush_size": self.last_flush_size,
+            "last_flush_latency_ms": round(self.last_flush_latency_ms, 2),
+            "max_flush_latency_ms": round(self.max_flush_latency_ms, 2),
+            "avg_flush_latency_ms": round(self.total_flush_latency_ms / self.flush_count, 2) if self.flush_count else 0.0,
+            "journal": self.journal.get_stats()
+        }
+
+
+# 創建全局 GPS 寫入緩衝區實例
+gps_ingest_buffer = GPSIngestBuffer()
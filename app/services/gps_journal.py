@@ -0,0 +1,311 @@
+"""
+GPS 寫入日誌 - 緩衝中的定位點先寫入本地分段檔，避免程序崩潰時遺失
+
+每筆紀錄帶有遞增的日誌位置（offset），寫入資料庫時在同一交易記錄已寫入的位置區間，
+重播時略過已寫入的紀錄，避免崩潰於提交後、刪除分段前造成重複寫入。
+
+多個程序（例如多個 uvicorn worker）共用 GPS_JOURNAL_DIR 時，每個程序以檔案鎖佔用自己的子目錄 worker-N，
+日誌位置與已寫入區間也依目錄編號分開記錄；已停止的程序留下的目錄由其他程序啟動時接手重播。
+"""
+
+import asyncio
+import bisect
+import fcntl
+import itertools
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+from app.models.gps_route import GPSJournalCommit
+
+logger = logging.getLogger(__name__)
+
+
+def offset_ranges(offsets: List[int]) -> List[Tuple[int, int]]:
+    """將遞增的日誌位置合併為連續區間 [(first, last), ...]"""
+    ranges = []
+    for offset in offsets:
+        if ranges and offset == ranges[-1][1] + 1:
+            ranges[-1][1] = offset
+        else:
+            ranges.append([offset, offset])
+    return [(first, last) for first, last in ranges]
+
+
+def record_journal_commit(db: Session, journal_id: int, offsets: List[int], watermark: int):
+    """
+    記錄日誌位置已寫入資料庫（應與定位點在同一交易中執行）
+
+    watermark 之前的紀錄所在分段皆已刪除，順便清除這些不再需要的區間
+    """
+    ranges = offset_ranges(offsets)
+    if ranges:
+        db.execute(insert(GPSJournalCommit), [
+            {"journal_id": journal_id, "first_offset": first, "last_offset": last} for first, last in ranges
+        ])
+    db.execute(delete(GPSJournalCommit).where(
+        GPSJournalCommit.journal_id == journal_id, GPSJournalCommit.last_offset < watermark
+    ))
+
+
+def load_journal_commits(db: Session, journal_id: int) -> List[Tuple[int, int]]:
+    """讀取日誌目錄已寫入資料庫的日誌位置區間（依起點排序）"""
+    return [tuple(row) for row in db.execute(
+        select(GPSJournalCommit.first_offset, GPSJournalCommit.last_offset)
+        .where(GPSJournalCommit.journal_id == journal_id)
+        .order_by(GPSJournalCommit.first_offset)
+    )]
+
+
+def is_committed(ranges: List[Tuple[int, int]], starts: List[int], offset: int) -> bool:
+    """日誌位置是否落在已寫入的區間內（starts 為各區間起點）"""
+    i = bisect.bisect_right(starts, offset) - 1
+    return i >= 0 and offset <= ranges[i][1]
+
+
+class GPSJournal:
+    """僅追加（append-only）的分段日誌，fsync 以批次合併執行"""
+
+    def __init__(self):
+        self.enabled = os.getenv('GPS_JOURNAL_ENABLED', 'false').lower() == 'true'
+        self.directory = os.getenv('GPS_JOURNAL_DIR', './gps_journal')
+        self.fsync_interval = float(os.getenv('GPS_JOURNAL_FSYNC_INTERVAL_MS', '10')) / 1000
+        self.segment_max_bytes = int(os.getenv('GPS_JOURNAL_SEGMENT_MAX_BYTES', str(16 * 1024 * 1024)))
+        self.segment_max_age = float(os.getenv('GPS_JOURNAL_SEGMENT_MAX_AGE_S', '5'))  # 分段封存間隔（秒）
+
+        # 本程序佔用的日誌目錄（claim 之後才有值）
+        self.journal_id: Optional[int] = None
+        self.path: Optional[str] = None
+        self._lock_file = None
+
+        self._file = None
+        self._seq = 0
+        self._bytes = 0
+        self._opened_at = 0.0
+        self._pending: Dict[int, int] = {}  # {segment_seq: 尚未寫入資料庫的筆數}
+        self._next_offset = 0
+        self._segment_offsets: Dict[int, int] = {}  # {segment_seq: 分段第一筆的日誌位置}
+        self._sync_task: Optional[asyncio.Task] = None
+        # fsync 與封存分段互斥，避免關閉仍在 fsync 中的檔案
+        self._io_lock = asyncio.Lock()
+
+        # 統計資料
+        self.fsync_count = 0
+        self.last_fsync_latency_ms = 0.0
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.path, f"segment-{seq:012d}.log")
+
+    def _list_segments(self) -> List[Tuple[int, str]]:
+        segments = []
+        for name in os.listdir(self.path):
+            if name.startswith("segment-") and name.endswith(".log"):
+                segments.append((int(name[8:-4]), os.path.join(self.path, name)))
+        return sorted(segments)
+
+    def claim(self, slot: Optional[int] = None) -> Optional[int]:
+        """
+        以檔案鎖佔用一個日誌目錄（worker-N），回傳其編號
+
+        未指定 slot 時取第一個未被其他程序佔用的目錄；指定的目錄已被佔用時回傳 None
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for candidate in ([slot] if slot is not None else itertools.count()):
+            path = os.path.join(self.directory, f"worker-{candidate}")
+            os.makedirs(path, exist_ok=True)
+            lock_file = open(os.path.join(path, "lock"), 'a')
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue
+            self.journal_id, self.path, self._lock_file = candidate, path, lock_file
+            return candidate
+        return None
+
+    def release_slot(self):
+        """釋放日誌目錄的檔案鎖（程序結束時也會自動釋放）"""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def other_slots(self) -> List[int]:
+        """本程序以外的日誌目錄編號"""
+        return sorted(
+            int(name[7:]) for name in os.listdir(self.directory)
+            if name.startswith("worker-") and name[7:].isdigit() and int(name[7:]) != self.journal_id
+        )
+
+    def read_segments(self) -> Tuple[List[int], List[Dict[str, Any]], List[int]]:
+        """讀取目錄中所有分段，回傳 (分段編號, 資料列, 各資料列的日誌位置)"""
+        segments = self._list_segments()
+        rows = []
+        offsets = []
+        for seq, path in segments:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        row = {
+                            "user_id": record["u"],
+                            "latitude": record["lat"],
+                            "longitude": record["lng"],
+                            "timestamp": datetime.fromisoformat(record["ts"])
+                        }
+                        offset = record["n"]
+                    except (ValueError, KeyError):
+                        # 崩潰時寫到一半的最後一行
+                        logger.warning(f"Skipping corrupt GPS journal record in {path}")
+                        continue
+                    rows.append(row)
+                    offsets.append(offset)
+                    self._segment_offsets.setdefault(seq, offset)
+        return [seq for seq, _ in segments], rows, offsets
+
+    def open(self, committed_offset: int = -1) -> Tuple[List[int], List[Dict[str, Any]], List[int]]:
+        """
+        開啟日誌並讀取上次未寫入資料庫的定位點（尚未佔用日誌目錄時先 claim）
+
+        committed_offset 為資料庫中已記錄的最大日誌位置，新的位置從兩者較大者之後開始。
+        回傳 (舊分段編號, 待重播的資料列, 各資料列的日誌位置)；重播寫入成功後應呼叫 discard() 刪除舊分段
+        """
+        if self.journal_id is None:
+            self.claim()
+        seqs, rows, offsets = self.read_segments()
+        self._next_offset = max(max(offsets, default=-1), committed_offset) + 1
+        self._seq = seqs[-1] + 1 if seqs else 0
+        self._open_segment()
+        return seqs, rows, offsets
+
+    @property
+    def watermark(self) -> int:
+        """仍留在分段檔中的最小日誌位置，之前的紀錄都已刪除"""
+        return min(self._segment_offsets.values(), default=self._next_offset)
+
+    async def close(self):
+        if self._file is None:
+            return
+        async with self._io_lock:
+            sealed_file, self._file = self._file, None
+            sealed_file.flush()
+            await asyncio.get_running_loop().run_in_executor(None, self._seal, sealed_file)
+        # 已全部寫入資料庫的最後分段可直接刪除
+        if not self._pending.get(self._seq):
+            self._pending.pop(self._seq, None)
+            self.discard([self._seq])
+        self.release_slot()
+
+    def _open_segment(self):
+        self._file = open(self._segment_path(self._seq), 'a', encoding='utf-8')
+        self._bytes = 0
+        self._opened_at = time.monotonic()
+        self._segment_offsets[self._seq] = self._next_offset
+
+    @staticmethod
+    def _seal(file):
+        os.fsync(file.fileno())
+        file.close()
+
+    @property
+    def segment_full(self) -> bool:
+        return self._bytes >= self.segment_max_bytes
+
+    @property
+    def segment_due(self) -> bool:
+        """分段已滿或已開啟超過封存間隔，寫入資料庫後應封存以便刪除"""
+        return self.segment_full or time.monotonic() - self._opened_at >= self.segment_max_age
+
+    async def rotate(self):
+        """封存目前分段並開啟新分段（目前分段為空時不動作）"""
+        async with self._io_lock:
+            if self._bytes == 0:
+                return
+            sealed, sealed_file = self._seq, self._file
+            sealed_file.flush()
+            self._seq += 1
+            self._open_segment()
+            # 新寫入已進入新分段，舊分段的 fsync 與關閉不佔用事件迴圈
+            await asyncio.get_running_loop().run_in_executor(None, self._seal, sealed_file)
+        # 封存時若已無待寫入資料則直接刪除
+        if not self._pending.get(sealed):
+            self._pending.pop(sealed, None)
+            self.discard([sealed])
+
+    def append(self, rows: List[Dict[str, Any]]) -> Tuple[int, int]:
+        """寫入定位點（尚未 fsync），回傳 (所在分段編號, 第一筆的日誌位置)"""
+        first = self._next_offset
+        lines = "".join(
+            json.dumps({
+                "n": first + i,
+                "u": row["user_id"],
+                "lat": row["latitude"],
+                "lng": row["longitude"],
+                "ts": row["timestamp"].isoformat()
+            }) + "\n"
+            for i, row in enumerate(rows)
+        )
+        self._file.write(lines)
+        self._bytes += len(lines)
+        self._next_offset += len(rows)
+        self._pending[self._seq] = self._pending.get(self._seq, 0) + len(rows)
+        return self._seq, first
+
+    async def sync(self):
+        """等待已寫入的資料 fsync 完成；同一時間窗內的呼叫共用一次 fsync"""
+        if self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync_later())
+        await asyncio.shield(self._sync_task)
+
+    async def _sync_later(self):
+        await asyncio.sleep(self.fsync_interval)
+        async with self._io_lock:
+            # 之後的寫入由下一次 fsync 負責
+            self._sync_task = None
+            # 持有檔案物件：封存分段需等待此鎖，fsync 期間檔案不會被關閉
+            file = self._file
+            if file is None:
+                return  # 日誌已關閉，關閉時已 fsync
+            file.flush()
+
+            started = time.perf_counter()
+            await asyncio.get_running_loop().run_in_executor(None, os.fsync, file.fileno())
+            self.fsync_count += 1
+            self.last_fsync_latency_ms = (time.perf_counter() - started) * 1000
+
+    def release(self, seq: int, count: int):
+        """標記分段中的資料已寫入資料庫，已封存且全部寫入的分段會被刪除"""
+        remaining = self._pending.get(seq, 0) - count
+        if remaining > 0:
+            self._pending[seq] = remaining
+            return
+        self._pending.pop(seq, None)
+        if seq != self._seq:
+            self.discard([seq])
+
+    def discard(self, seqs: List[int]):
+        for seq in seqs:
+            self._segment_offsets.pop(seq, None)
+            try:
+                os.remove(self._segment_path(seq))
+            except FileNotFoundError:
+                pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "journal_id": self.journal_id,
+            "current_segment": self._seq,
+            "next_offset": self._next_offset,
+            "pending_rows": sum(self._pending.values()),
+            "pending_segments": len(self._pending),
+            "fsync_count": self.fsync_count,
+            "last_fsync_latency_ms": round(self.last_fsync_latency_ms, 2)
+        }
+
+
+# 創建全局 GPS 寫入日誌實例
+gps_journal = GPSJournal()
@@ -0,0 +1,137 @@
+"""
+最新定位快取 - 每位用戶最後一個已知定位，查詢不需存取資料庫
+
+啟動時由資料庫載入，之後於每次寫入定位點時更新。
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import and_, func, select
+from app.database import SessionLocal
+from app.models.gps_route import GPSLocation
+from app.services.gps_track_service import query_track
+
+logger = logging.getLogger(__name__)
+
+# (location_id, timestamp, latitude, longitude)
+LatestLocation = Tuple[Optional[int], datetime, float, float]
+
+
+def _naive_utc(timestamp: datetime) -> datetime:
+    if timestamp.tzinfo is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+class LatestLocationCache:
+    """用戶最新定位的記憶體對照表"""
+
+    def __init__(self):
+        self.warm_days = int(os.getenv('GPS_LATEST_WARM_DAYS', '0'))  # 啟動時只載入最近 N 天有定位的用戶（0 表示全部）
+        self._locations: Dict[int, LatestLocation] = {}
+        self._listeners: List[Callable[[int, LatestLocation], None]] = []
+        self._lock = threading.Lock()
+        self.warmed = False
+
+        # 統計資料
+        self.hits = 0
+        self.misses = 0
+
+    def add_listener(self, listener: Callable[[int, LatestLocation], None]):
+        """註冊最新定位變更的回呼（在更新的執行緒中呼叫）"""
+        self._listeners.append(listener)
+
+    def warm(self):
+        """由資料庫載入每位用戶最後一個定位"""
+        latest = select(
+            GPSLocation.user_id, func.max(GPSLocation.timestamp).label("timestamp")
+        ).group_by(GPSLocation.user_id)
+        if self.warm_days > 0:
+            latest = latest.where(GPSLocation.timestamp >= datetime.utcnow() - timedelta(days=self.warm_days))
+        latest = latest.subquery()
+
+        stmt = select(
+            GPSLocation.user_id, GPSLocation.id, GPSLocation.timestamp, GPSLocation.latitude, GPSLocation.longitude
+        ).join(latest, and_(GPSLocation.user_id == latest.c.user_id, GPSLocation.timestamp == latest.c.timestamp))
+
+        db = SessionLocal()
+        try:
+            rows = db.execute(stmt).all()
+        finally:
+            db.close()
+
+        for user_id, location_id, timestamp, latitude, longitude in rows:
+            self._set(user_id, (location_id, _naive_utc(timestamp), latitude, longitude))
+        self.warmed = True
+        logger.info(f"Loaded latest GPS locations for {len(self._locations)} users")
+
+    def update_rows(self, rows: List[Dict[str, Any]], ids: Optional[List[int]] = None):
+        """以剛寫入的定位點更新（只保留每位用戶時間最新的一筆）"""
+        newest: Dict[int, LatestLocation] = {}
+        for index, row in enumerate(rows):
+            location = (ids[index] if ids else None, _naive_utc(row["timestamp"]), row["latitude"], row["longitude"])
+            current = newest.get(row["user_id"])
+            if current is None or location[1] >= current[1]:
+                newest[row["user_id"]] = location
+        for user_id, location in newest.items():
+            self._set(user_id, location)
+
+    def _set(self, user_id: int, location: LatestLocation):
+        with self._lock:
+            current = self._locations.get(user_id)
+            # 晚到的舊定位點不覆蓋
+            if current is not None and location[1] < current[1]:
+                return
+            self._locations[user_id] = location
+        for listener in self._listeners:
+            listener(user_id, location)
+
+    def get(self, user_id: int) -> Optional[LatestLocation]:
+        location = self._locations.get(user_id)
+        if location is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return location
+
+    def get_many(self, user_ids: Iterable[int]) -> Dict[int, Optional[LatestLocation]]:
+        return {user_id: self.get(user_id) for user_id in user_ids}
+
+    def snapshot(self) -> Dict[int, LatestLocation]:
+        """所有用戶最新定位的複本"""
+        with self._lock:
+            return dict(self._locations)
+
+    def refresh_user(self, user_id: int):
+        """刪除定位記錄後由資料庫重新載入該用戶的最新定位"""
+        db = SessionLocal()
+        try:
+            rows = query_track(db, user_id, descending=True, limit=1)
+        finally:
+            db.close()
+
+        with self._lock:
+            self._locations.pop(user_id, None)
+        if rows:
+            self._set(user_id, (rows[0][0], _naive_utc(rows[0][1]), rows[0][2], rows[0][3]))
+
+    def remove_before(self, cutoff: datetime):
+        """移除最新定位早於 cutoff 的用戶（資料保留期限用）"""
+        with self._lock:
+            for user_id in [u for u, location in self._locations.items() if location[1] < cutoff]:
+                del self._locations[user_id]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "warmed": self.warmed,
+            "users": len(self._locations),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+# 創建全局最新定位快取實例
+latest_location_cache = LatestLocationCache()
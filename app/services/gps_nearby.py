@@ -0,0 +1,272 @@
+"""
+附近用戶索引 - 線上用戶最新定位的記憶體網格索引
+
+以固定大小（度）的網格切分經緯度，每格記錄其中的用戶；查詢時只檢查半徑範圍涵蓋的網格，
+候選用戶的距離以 numpy 一次算完。定位由最新定位快取推送，線上狀態來自 UserStatus。
+"""
+
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from app.database import SessionLocal
+from app.models.user_status import UserStatus
+from app.services.geo_utils import haversine_m_np
+from app.services.gps_latest import latest_location_cache
+
+logger = logging.getLogger(__name__)
+
+METERS_PER_DEGREE = 111320.0
+EPOCH = datetime(1970, 1, 1)
+
+# 半徑涵蓋超過此網格數時改用全表向量化篩選
+MAX_GRID_SCAN_CELLS = 1024
+
+
+class NearbyUserIndex:
+    """線上用戶的網格空間索引"""
+
+    def __init__(self):
+        self.cell_m = float(os.getenv('GPS_NEARBY_CELL_M', '500'))                   # 網格邊長（公尺，以緯度換算為度）
+        self.max_radius_m = float(os.getenv('GPS_NEARBY_MAX_RADIUS_M', '50000'))     # 查詢半徑上限
+        self.max_age_s = float(os.getenv('GPS_NEARBY_MAX_AGE_S', '900'))             # 定位超過此秒數不列入結果（0 表示不限）
+        self.status_refresh_s = float(os.getenv('GPS_NEARBY_STATUS_REFRESH_S', '30'))  # 由資料庫同步線上狀態的間隔
+        self.cell_deg = self.cell_m / METERS_PER_DEGREE
+        # 經度方向的格數取整，格寬恰好整除 360 度，±180 度兩側的網格才能相接
+        self.lng_cells = max(1, round(360 / self.cell_deg))
+        self.lng_cell_deg = 360 / self.lng_cells
+
+        # 定位存放在以 slot 為索引的 numpy 陣列，網格中記錄 slot，查詢時可直接以陣列索引取出
+        self._cells: Dict[Tuple[int, int], Set[int]] = {}
+        self._slots: Dict[int, int] = {}  # {user_id: slot}
+        self._slot_cells: Dict[int, Tuple[int, int]] = {}
+        self._free_slots: List[int] = []
+        self._size = 0
+        self._lat = np.zeros(1024)
+        self._lng = np.zeros(1024)
+        self._epoch = np.zeros(1024)
+        self._user_ids = np.full(1024, -1, dtype=np.int64)
+        self._online: Set[int] = set()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        # 統計資料
+        self.queries = 0
+        self.last_query_ms = 0.0
+
+        latest_location_cache.add_listener(self.on_location)
+
+    def _lng_cell(self, lng: float) -> int:
+        """未取餘數的經度格索引，查詢範圍跨越 ±180 度時可連續計算"""
+        return int(math.floor((lng + 180) / self.lng_cell_deg))
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return (int(math.floor(lat / self.cell_deg)), self._lng_cell(lng) % self.lng_cells)
+
+    def _allocate_slot(self) -> int:
+        if self._free_slots:
+            return self._free_slots.pop()
+        if self._size == len(self._lat):
+            grow = len(self._lat)
+            self._lat = np.concatenate([self._lat, np.zeros(grow)])
+            self._lng = np.concatenate([self._lng, np.zeros(grow)])
+            self._epoch = np.concatenate([self._epoch, np.zeros(grow)])
+            self._user_ids = np.concatenate([self._user_ids, np.full(grow, -1, dtype=np.int64)])
+        self._size += 1
+        return self._size - 1
+
+    def _put(self, user_id: int, lat: float, lng: float, timestamp: datetime):
+        """呼叫端需持有 _lock"""
+        cell = self._cell(lat, lng)
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._allocate_slot()
+            self._slots[user_id] = slot
+        elif self._slot_cells[slot] != cell:
+            self._discard_from_cell(slot, self._slot_cells[slot])
+        self._cells.setdefault(cell, set()).add(slot)
+        self._slot_cells[slot] = cell
+        self._lat[slot] = lat
+        self._lng[slot] = lng
+        self._epoch[slot] = (timestamp - EPOCH).total_seconds()
+        self._user_ids[slot] = user_id
+
+    def _discard_from_cell(self, slot: int, cell: Tuple[int, int]):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(slot)
+            if not members:
+                del self._cells[cell]
+
+    def _remove(self, user_id: int):
+        """呼叫端需持有 _lock"""
+        slot = self._slots.pop(user_id, None)
+        if slot is not None:
+            self._discard_from_cell(slot, self._slot_cells.pop(slot))
+            self._user_ids[slot] = -1
+            self._free_slots.append(slot)
+
+    def on_location(self, user_id: int, location):
+        """最新定位快取的回呼：只索引線上用戶"""
+        if user_id not in self._online:
+            return
+        with self._lock:
+            self._put(user_id, location[2], location[3], location[1])
+
+    def set_online(self, user_id: int, online: bool):
+        """用戶上線時由最新定位快取加入索引，離線時移除"""
+        with self._lock:
+            if online:
+                self._online.add(user_id)
+                location = latest_location_cache.get(user_id)
+                if location is not None:
+                    self._put(user_id, location[2], location[3], location[1])
+            else:
+                self._online.discard(user_id)
+                self._remove(user_id)
+
+    def sync_online_users(self, user_ids: Iterable[int]):
+        """以完整的線上用戶清單同步索引"""
+        user_ids = set(user_ids)
+        with self._lock:
+            went_offline = self._online - user_ids
+            came_online = user_ids - self._online
+        for user_id in went_offline:
+            self.set_online(user_id, False)
+        for user_id in came_online:
+            self.set_online(user_id, True)
+
+    def refresh_from_db(self):
+        """由 UserStatus 載入線上用戶（多台伺服器時同步其他伺服器的連線）"""
+        db = SessionLocal()
+        try:
+            user_ids = [row[0] for row in db.query(UserStatus.user_id).filter(UserStatus.status == "online").all()]
+        finally:
+            db.close()
+        self.sync_online_users(user_ids)
+
+    def query(
+        self,
+        lat: float,
+        lng: float,
+        radius_m: float,
+        limit: int,
+        exclude_user_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """查詢半徑內最近的 limit 位線上用戶（依距離排序）"""
+        started = time.perf_counter()
+        lat_span = radius_m / METERS_PER_DEGREE
+        lng_span = radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + lat_span, 89.9))), 1e-6))
+        min_lat_cell = int(math.floor((lat - lat_span) / self.cell_deg))
+        max_lat_cell = int(math.floor((lat + lat_span) / self.cell_deg))
+        # 經度格在 ±180 度處循環，涵蓋整圈時每格只檢查一次
+        min_lng_cell = self._lng_cell(lng - lng_span)
+        lng_cell_count = min(self._lng_cell(lng + lng_span) - min_lng_cell + 1, self.lng_cells)
+        cell_count = (max_lat_cell - min_lat_cell + 1) * lng_cell_count
+
+        with self._lock:
+            if cell_count <= min(len(self._cells), MAX_GRID_SCAN_CELLS):
+                slots: List[int] = []
+                for i in range(min_lat_cell, max_lat_cell + 1):
+                    for j in range(min_lng_cell, min_lng_cell + lng_cell_count):
+                        members = self._cells.get((i, j % self.lng_cells))
+                        if members:
+                            slots.extend(members)
+                candidates = np.array(slots, dtype=np.int64)
+            else:
+                # 範圍涵蓋的網格太多時，逐格查詢反而較慢，改為對所有 slot 做向量化範圍篩選
+                lat_all = self._lat[:self._size]
+                lng_all = self._lng[:self._size]
+                # 經度差換算到 [-180, 180)，跨越 ±180 度的用戶也在範圍內
+                lng_delta = (lng_all - lng + 180) % 360 - 180
+                candidates = np.flatnonzero(
+                    (self._user_ids[:self._size] >= 0)
+                    & (lat_all >= lat - lat_span) & (lat_all <= lat + lat_span)
+                    & (np.abs(lng_delta) <= lng_span)
+                )
+            user_ids = self._user_ids[candidates]
+            lats = self._lat[candidates]
+            lngs = self._lng[candidates]
+            epochs = self._epoch[candidates]
+
+        if len(candidates) == 0:
+            self._record_query(started)
+            return []
+
+        # haversine 以經度差的正弦計算，跨越 ±180 度（差 360 度）時距離仍正確
+        distance = haversine_m_np(lat, lng, lats, lngs)
+
+        mask = distance <= radius_m
+        if self.max_age_s > 0:
+            mask &= epochs >= (datetime.utcnow() - EPOCH).total_seconds() - self.max_age_s
+        if exclude_user_id is not None:
+            mask &= user_ids != exclude_user_id
+        selected = np.flatnonzero(mask)
+
+        # 只排序最近的 limit 筆
+        if len(selected) > limit:
+            selected = selected[np.argpartition(distance[selected], limit - 1)[:limit]]
+        selected = selected[np.argsort(distance[selected], kind='stable')]
+
+        results = [
+            {
+                "user_id": int(user_ids[i]),
+                "latitude": float(lats[i]),
+                "longitude": float(lngs[i]),
+                "distance_m": round(float(distance[i]), 1),
+                "timestamp": (EPOCH + timedelta(seconds=float(epochs[i]))).isoformat()
+            }
+            for i in selected
+        ]
+        self._record_query(started)
+        return results
+
+    def _record_query(self, started: float):
+        self.queries += 1
+        self.last_query_ms = (time.perf_counter() - started) * 1000
+
+    async def start(self):
+        """載入線上用戶並啟動定期同步工作"""
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.refresh_from_db)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Nearby user index started with {len(self._slots)} online users")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.status_refresh_s)
+            try:
+                await loop.run_in_executor(None, self.refresh_from_db)
+            except Exception as e:
+                logger.error(f"Nearby user index status refresh failed: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "online_users": len(self._online),
+            "indexed_users": len(self._slots),
+            "occupied_cells": len(self._cells),
+            "cell_m": self.cell_m,
+            "queries": self.queries,
+            "last_query_ms": round(self.last_query_ms, 3)
+        }
+
+
+# 創建全局附近用戶索引實例
+nearby_user_index = NearbyUserIndex()
@@ -0,0 +1,170 @@
+"""
+GPS 定位資料表分割（PostgreSQL 按月 RANGE 分割）
+
+啟用 GPS_PARTITIONING_ENABLED 且使用 PostgreSQL 時，新建立的 gps_locations 會是依 timestamp
+按月分割的資料表，並由背景工作預先建立未來月份的分割區。日期查詢只會掃描相關月份，
+保留期限到期的資料可以直接刪除整個分割區。
+
+既有的非分割 gps_locations 不會自動轉換，需手動搬移資料。
+"""
+
+import asyncio
+import logging
+import os
+from datetime import date
+from typing import List, Optional, Tuple
+from sqlalchemy import inspect, text
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = "gps_locations"
+DEFAULT_PARTITION = "gps_locations_default"
+
+# 主鍵必須包含分割鍵 timestamp
+PARTITIONED_TABLE_DDL = """
+CREATE TABLE gps_locations (
+    id SERIAL NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    latitude DOUBLE PRECISION NOT NULL,
+    longitude DOUBLE PRECISION NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    geohash VARCHAR(12),
+    created_at TIMESTAMP WITHOUT TIME ZONE,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp)
+"""
+
+
+def _add_months(day: date, months: int) -> date:
+    month_index = day.year * 12 + (day.month - 1) + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(month_start: date) -> str:
+    return f"{PARENT_TABLE}_y{month_start.year:04d}m{month_start.month:02d}"
+
+
+class GPSPartitionManager:
+    """建立與維護 gps_locations 的月分割區"""
+
+    def __init__(self):
+        self.enabled = (
+            os.getenv('GPS_PARTITIONING_ENABLED', 'false').lower() == 'true'
+            and engine.dialect.name == "postgresql"
+        )
+        self.months_ahead = int(os.getenv('GPS_PARTITION_MONTHS_AHEAD', '3'))
+        self.maintenance_interval = float(os.getenv('GPS_PARTITION_MAINTENANCE_INTERVAL_S', '86400'))
+        self._task: Optional[asyncio.Task] = None
+
+    def is_partitioned(self) -> bool:
+        with engine.connect() as conn:
+            relkind = conn.execute(
+                text("SELECT relkind FROM pg_class WHERE relname = :name AND relkind IN ('r', 'p')"),
+                {"name": PARENT_TABLE}
+            ).scalar()
+        return relkind == 'p'
+
+    def create_partitioned_table(self):
+        """gps_locations 不存在時建立為分割資料表（須在 users 表建立之後、create_all 之前呼叫）"""
+        if not self.enabled:
+            return
+        if inspect(engine).has_table(PARENT_TABLE):
+            if not self.is_partitioned():
+                logger.warning("gps_locations already exists and is not partitioned; partitioning skipped")
+            return
+
+        logger.info("Creating partitioned gps_locations table...")
+        with engine.connect() as conn:
+            conn.execute(text(PARTITIONED_TABLE_DDL))
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {PARENT_TABLE} DEFAULT"))
+        self.ensure_partitions()
+
+    def ensure_partitions(self) -> List[str]:
+        """建立本月與未來 months_ahead 個月的分割區，回傳新建立的分割區名稱"""
+        if not self.enabled or not self.is_partitioned():
+            return []
+
+        created = []
+        existing = {name for name, _ in self.list_partitions()}
+        this_month = date.today().replace(day=1)
+        with engine.connect() as conn:
+            for offset in range(self.months_ahead + 1):
+                month_start = _add_months(this_month, offset)
+                name = partition_name(month_start)
+                if name in existing:
+                    continue
+                try:
+                    conn.execute(text(
+                        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARENT_TABLE} "
+                        f"FOR VALUES FROM ('{month_start.isoformat()}') TO ('{_add_months(month_start, 1).isoformat()}')"
+                    ))
+                    created.append(name)
+                    logger.info(f"Created GPS partition {name}")
+                except Exception as e:
+                    # 預設分割區中已有該月份資料時無法建立
+                    logger.error(f"Failed to create GPS partition {name}: {e}")
+        return created
+
+    def list_partitions(self) -> List[Tuple[str, Optional[date]]]:
+        """列出月分割區 (名稱, 月份起始日)，預設分割區的月份為 None"""
+        with engine.connect() as conn:
+            names = conn.execute(text("""
+                SELECT child.relname
+                FROM pg_inherits
+                JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+                JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+                WHERE parent.relname = :name
+            """), {"name": PARENT_TABLE}).scalars().all()
+
+        partitions = []
+        prefix = f"{PARENT_TABLE}_y"
+        for name in sorted(names):
+            month_start = None
+            if name.startswith(prefix):
+                month_start = date(int(name[len(prefix):len(prefix) + 4]), int(name[-2:]), 1)
+            partitions.append((name, month_start))
+        return partitions
+
+    def drop_partitions_before(self, cutoff: date) -> List[str]:
+        """刪除整個月份都早於 cutoff 的分割區，回傳已刪除的名稱"""
+        if not self.enabled or not self.is_partitioned():
+            return []
+
+        dropped = []
+        with engine.connect() as conn:
+            for name, month_start in self.list_partitions():
+                if month_start is None or _add_months(month_start, 1) > cutoff:
+                    continue
+                conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+                dropped.append(name)
+                logger.info(f"Dropped GPS partition {name}")
+        return dropped
+
+    async def start(self):
+        """啟動背景工作，定期建立未來月份的分割區"""
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.ensure_partitions)
+            except Exception as e:
+                logger.error(f"GPS partition maintenance failed: {e}")
+            await asyncio.sleep(self.maintenance_interval)
+
+
+# 創建全局 GPS 分割區管理實例
+gps_partition_manager = GPSPartitionManager()
@@ -0,0 +1,316 @@
+"""
+GPS 資料保留與分批刪除
+
+所有刪除都以主鍵分批進行，每批一個短交易，避免單一 DELETE 長時間鎖住大量資料列。
+用戶刪除請求記錄在 gps_delete_jobs，由各程序的背景工作領取執行並回報進度；
+執行中的程序停止後（心跳逾時）由其他程序接手，已刪除的資料不會重複計算。
+保留期限（GPS_RETENTION_DAYS）由定期工作負責清除。
+"""
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+from sqlalchemy import delete, func, or_, select, update
+from app.database import SessionLocal
+from app.models.gps_route import GPSDeleteJob, GPSLocation
+from app.services.gps_archive import gps_archive
+from app.services.gps_partition_service import gps_partition_manager
+from app.services.gps_rollup import gps_rollup_service
+from app.services.gps_latest import latest_location_cache
+from app.services.gps_track_service import simplified_track_cache
+from app.services.gps_stats import trip_stats_cache
+from app.services.gps_trips import trip_segmentation_service
+
+logger = logging.getLogger(__name__)
+
+
+def purge_locations(
+    user_id: Optional[int] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    before: Optional[datetime] = None,
+    chunk_size: int = 5000,
+    pause_s: float = 0.0,
+    progress: Optional[Callable[[int], None]] = None
+) -> int:
+    """
+    依條件分批刪除定位點，回傳刪除總數
+
+    每批先以索引取出最多 chunk_size 筆 ID，再以 ID 刪除並提交；progress 會收到累計刪除數
+    """
+    conditions = []
+    if user_id is not None:
+        conditions.append(GPSLocation.user_id == user_id)
+    if start is not None:
+        conditions.append(GPSLocation.timestamp >= start)
+    if end is not None:
+        conditions.append(GPSLocation.timestamp <= end)
+    if before is not None:
+        conditions.append(GPSLocation.timestamp < before)
+
+    deleted = 0
+    db = SessionLocal()
+    try:
+        while True:
+            ids = db.scalars(select(GPSLocation.id).where(*conditions).limit(chunk_size)).all()
+            if not ids:
+                break
+            # 保留時間條件，分割資料表只需掃描相關分割區
+            db.execute(delete(GPSLocation).where(GPSLocation.id.in_(ids), *conditions))
+            db.commit()
+            deleted += len(ids)
+            if progress is not None:
+                progress(deleted)
+            if pause_s:
+                time.sleep(pause_s)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    return deleted
+
+
+class GPSRetentionService:
+    """用戶刪除工作與保留期限清除"""
+
+    def __init__(self):
+        self.retention_days = int(os.getenv('GPS_RETENTION_DAYS', '0'))  # 0 表示永久保留
+        self.chunk_size = int(os.getenv('GPS_PURGE_CHUNK_SIZE', '5000'))
+        self.pause_s = float(os.getenv('GPS_PURGE_PAUSE_MS', '10')) / 1000  # 每批之間讓出資料庫的時間
+        self.interval = float(os.getenv('GPS_RETENTION_INTERVAL_S', '3600'))
+        self.job_poll_s = float(os.getenv('GPS_PURGE_JOB_POLL_S', '2'))          # 領取刪除工作的間隔
+        self.job_stale_s = float(os.getenv('GPS_PURGE_JOB_STALE_S', '300'))      # 心跳逾時即由其他程序接手
+        self.job_history_days = int(os.getenv('GPS_PURGE_JOB_HISTORY_DAYS', '30'))  # 已結束工作的保留天數
+
+        self.worker_id = uuid.uuid4().hex[:8]
+        self._task: Optional[asyncio.Task] = None
+        self._job_task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # 統計資料
+        self.retention_runs = 0
+        self.retention_deleted = 0
+        self.last_retention_run: Optional[datetime] = None
+
+    def submit_delete(self, user_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None) -> Dict[str, Any]:
+        """建立用戶刪除工作（由背景工作執行），回傳工作狀態"""
+        db = SessionLocal()
+        try:
+            job = GPSDeleteJob(id=uuid.uuid4().hex, user_id=user_id, start=start, end=end, status="pending", deleted_count=0)
+            db.add(job)
+            db.commit()
+            result = serialize_job(job)
+        finally:
+            db.close()
+
+        # 本程序的背景工作立即領取，不必等到下次輪詢
+        if self._loop is not None and self._wake is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+        return result
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        db = SessionLocal()
+        try:
+            job = db.get(GPSDeleteJob, job_id)
+            return serialize_job(job) if job is not None else None
+        finally:
+            db.close()
+
+    def claim_job(self) -> Optional[Dict[str, Any]]:
+        """領取一個待執行或中斷（心跳逾時）的刪除工作，回傳工作狀態；沒有可領取的工作時回傳 None"""
+        db = SessionLocal()
+        try:
+            stale_before = datetime.utcnow() - timedelta(seconds=self.job_stale_s)
+            claimable = or_(
+                GPSDeleteJob.status == "pending",
+                (GPSDeleteJob.status == "running") & (GPSDeleteJob.heartbeat_at < stale_before)
+            )
+            for job_id in db.scalars(
+                select(GPSDeleteJob.id).where(claimable).order_by(GPSDeleteJob.created_at).limit(10)
+            ).all():
+                # 條件式更新：多個程序同時領取時只有一個成功
+                result = db.execute(
+                    update(GPSDeleteJob)
+                    .where(GPSDeleteJob.id == job_id, claimable)
+                    .values(status="running", heartbeat_at=datetime.utcnow())
+                )
+                db.commit()
+                if result.rowcount == 1:
+                    return serialize_job(db.get(GPSDeleteJob, job_id))
+            return None
+        finally:
+            db.close()
+
+    def run_pending_jobs(self) -> int:
+        """依序執行所有可領取的刪除工作，回傳執行的工作數"""
+        count = 0
+        while True:
+            job = self.claim_job()
+            if job is None:
+                return count
+            self._run_delete_job(job)
+            count += 1
+
+    def _update_job(self, job_id: str, **values):
+        db = SessionLocal()
+        try:
+            db.execute(update(GPSDeleteJob).where(GPSDeleteJob.id == job_id).values(**values))
+            db.commit()
+        finally:
+            db.close()
+
+    def _run_delete_job(self, job: Dict[str, Any]):
+        job_id = job["job_id"]
+        user_id = job["user_id"]
+        start = datetime.fromisoformat(job["start"]) if job["start"] else None
+        end = datetime.fromisoformat(job["end"]) if job["end"] else None
+        # 接手中斷的工作時，之前已刪除的數量繼續累計
+        resumed_count = job["deleted_count"]
+        if resumed_count:
+            logger.info(f"Resuming GPS deletion job {job_id} ({resumed_count} already deleted)")
+
+        def progress(count: int):
+            self._update_job(job_id, deleted_count=resumed_count + count, heartbeat_at=datetime.utcnow())
+
+        try:
+            deleted = resumed_count + purge_locations(
+                user_id=user_id, start=start, end=end,
+                chunk_size=self.chunk_size, pause_s=self.pause_s, progress=progress
+            )
+            deleted += gps_archive.delete(user_id, start, end)
+            gps_rollup_service.rebuild(user_id, start, end)
+            trip_segmentation_service.rewind(user_id, start)
+            latest_location_cache.refresh_user(user_id)
+            self._update_job(job_id, status="completed", deleted_count=deleted, finished_at=datetime.utcnow())
+            logger.info(f"Deleted {deleted} GPS locations for user {user_id} (job {job_id})")
+        except Exception as e:
+            logger.error(f"GPS deletion job {job_id} failed: {e}")
+            self._update_job(job_id, status="failed", error=str(e), finished_at=datetime.utcnow())
+        finally:
+            simplified_track_cache.invalidate(user_id)
+            trip_stats_cache.invalidate(user_id)
+
+    def prune_jobs(self) -> int:
+        """刪除超過保留天數的已結束工作，回傳刪除數量"""
+        cutoff = datetime.utcnow() - timedelta(days=self.job_history_days)
+        db = SessionLocal()
+        try:
+            result = db.execute(delete(GPSDeleteJob).where(
+                GPSDeleteJob.status.in_(("completed", "failed")), GPSDeleteJob.finished_at < cutoff
+            ))
+            db.commit()
+            return result.rowcount
+        finally:
+            db.close()
+
+    def enforce_retention(self) -> int:
+        """刪除超過保留期限的定位點，回傳刪除的資料列數（整個分割區刪除的不計入）"""
+        if self.retention_days <= 0:
+            return 0
+
+        cutoff = datetime.combine(date.today() - timedelta(days=self.retention_days), datetime.min.time())
+        # 分割資料表先直接刪除整月過期的分割區，剩下的再分批刪除
+        dropped = gps_partition_manager.drop_partitions_before(cutoff.date())
+        deleted = purge_locations(before=cutoff, chunk_size=self.chunk_size, pause_s=self.pause_s)
+        gps_archive.drop_before(cutoff)
+        latest_location_cache.remove_before(cutoff)
+
+        self.retention_runs += 1
+        self.retention_deleted += deleted
+        self.last_retention_run = datetime.utcnow()
+        if deleted or dropped:
+            simplified_track_cache.clear()
+            trip_stats_cache.clear()
+            logger.info(f"GPS retention removed {deleted} rows and {len(dropped)} partitions older than {cutoff.date()}")
+        return deleted
+
+    async def start(self):
+        """啟動刪除工作的背景執行與定期保留期限清除工作"""
+        if self._job_task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._job_task = asyncio.create_task(self._run_jobs())
+            logger.info(f"GPS deletion job worker {self.worker_id} started")
+        if self.retention_days <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"GPS retention job started (retention_days={self.retention_days})")
+
+    async def stop(self):
+        # 執行中的刪除工作停止後留在 running 狀態，心跳逾時後由其他程序（或重啟後）接手
+        for task in (self._task, self._job_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._job_task = None
+        self._loop = None
+
+    async def _run_jobs(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.run_pending_jobs)
+                await loop.run_in_executor(None, self.prune_jobs)
+            except Exception as e:
+                logger.error(f"GPS deletion job worker failed: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.job_poll_s)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.enforce_retention)
+            except Exception as e:
+                logger.error(f"GPS retention run failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def get_stats(self) -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            active = db.scalar(
+                select(func.count()).select_from(GPSDeleteJob).where(GPSDeleteJob.status.in_(("pending", "running")))
+            )
+        finally:
+            db.close()
+        return {
+            "retention_days": self.retention_days,
+            "chunk_size": self.chunk_size,
+            "active_jobs": active,
+            "retention_runs": self.retention_runs,
+            "retention_deleted": self.retention_deleted,
+            "last_retention_run": self.last_retention_run.isoformat() if self.last_retention_run else None,
+            "archive": gps_archive.get_stats()
+        }
+
+
+def serialize_job(job: GPSDeleteJob) -> Dict[str, Any]:
+    """將刪除工作轉為回應格式"""
+    return {
+        "job_id": job.id,
+        "user_id": job.user_id,
+        "start": job.start.isoformat() if job.start else None,
+        "end": job.end.isoformat() if job.end else None,
+        "status": job.status,
+        "deleted_count": job.deleted_count or 0,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None
+    }
+
+
+# 創建全局 GPS 資料保留服務實例
+gps_retention_service = GPSRetentionService()
@@ -0,0 +1,434 @@
+"""
+GPS 彙總表 - 每位用戶每小時、每天的定位點數量、移動距離、活動時間與範圍框
+
+寫入定位點時記錄待更新的用戶，由背景工作增量更新（晚到的舊定位點改為重算受影響的日期），既有資料以 backfill 建立。
+距離與活動時間只計算相鄰兩點間隔不超過 GPS_ROLLUP_MAX_GAP_S 的路段，歸屬於路段終點所在的時段。
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import Session
+from app.database import SessionLocal, TRANSACTION_ISOLATION_LEVEL
+from app.models.gps_rollup import GPSDailyRollup, GPSHourlyRollup
+from app.services.geo_utils import haversine_m_np
+from app.services.gps_track_service import query_track, stream_track
+from app.services.gps_latest import latest_location_cache
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+# 彙總欄位（不含 user_id 與時段鍵）
+ROLLUP_FIELDS = (
+    "point_count", "distance_m", "active_seconds",
+    "min_latitude", "max_latitude", "min_longitude", "max_longitude",
+    "first_timestamp", "last_timestamp", "last_latitude", "last_longitude"
+)
+
+# 前一個定位點 (timestamp, latitude, longitude)
+PreviousPoint = Optional[Tuple[datetime, float, float]]
+
+
+def _naive_utc(timestamp: datetime) -> datetime:
+    if timestamp.tzinfo is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _combine(current: Dict[str, Any], later: Dict[str, Any]) -> Dict[str, Any]:
+    """合併同一時段的兩份彙總（later 的定位點都在 current 之後）"""
+    return {
+        "point_count": current["point_count"] + later["point_count"],
+        "distance_m": current["distance_m"] + later["distance_m"],
+        "active_seconds": current["active_seconds"] + later["active_seconds"],
+        "min_latitude": min(current["min_latitude"], later["min_latitude"]),
+        "max_latitude": max(current["max_latitude"], later["max_latitude"]),
+        "min_longitude": min(current["min_longitude"], later["min_longitude"]),
+        "max_longitude": max(current["max_longitude"], later["max_longitude"]),
+        "first_timestamp": current["first_timestamp"],
+        "last_timestamp": later["last_timestamp"],
+        "last_latitude": later["last_latitude"],
+        "last_longitude": later["last_longitude"]
+    }
+
+
+def _to_dict(rollup) -> Dict[str, Any]:
+    return {field: getattr(rollup, field) for field in ROLLUP_FIELDS}
+
+
+class GPSRollupService:
+    """維護每小時、每天的 GPS 彙總表"""
+
+    def __init__(self):
+        self.enabled = os.getenv('GPS_ROLLUP_ENABLED', 'true').lower() == 'true'
+        self.max_gap_s = float(os.getenv('GPS_ROLLUP_MAX_GAP_S', '600'))  # 超過此間隔視為未活動，不計距離
+        self.interval_s = float(os.getenv('GPS_ROLLUP_INTERVAL_S', '10'))
+        self.chunk_size = int(os.getenv('GPS_ROLLUP_CHUNK_SIZE', '5000'))  # 增量更新時每次讀取的定位點數
+        # {user_id: (新定位點中最早的時間, 新定位點所在的日期)}
+        self._pending: Dict[int, Tuple[datetime, Set[date]]] = {}
+        self._pending_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        # 統計資料
+        self.incremental_updates = 0
+        self.recomputed_days = 0
+        self.failed_updates = 0
+        self.last_run_ms = 0.0
+
+    def aggregate_hours(
+        self,
+        timestamps: List[datetime],
+        lat: np.ndarray,
+        lng: np.ndarray,
+        previous: PreviousPoint = None
+    ) -> "OrderedDict[datetime, Dict[str, Any]]":
+        """將依時間排序的定位點彙總為每小時的統計（向量化計算），previous 為這批之前的最後一個定位點"""
+        buckets: "OrderedDict[datetime, Dict[str, Any]]" = OrderedDict()
+        n = len(timestamps)
+        if n == 0:
+            return buckets
+
+        epoch = np.array(timestamps, dtype='datetime64[us]').astype(np.int64) / 1e6
+        if previous is not None:
+            prev_epoch = (previous[0] - EPOCH).total_seconds()
+            seg_dt = np.diff(epoch, prepend=prev_epoch)
+            seg_dist = haversine_m_np(
+                np.concatenate(([previous[1]], lat[:-1])), np.concatenate(([previous[2]], lng[:-1])), lat, lng
+            )
+        else:
+            seg_dt = np.diff(epoch, prepend=epoch[0])
+            seg_dist = np.concatenate(([0.0], haversine_m_np(lat[:-1], lng[:-1], lat[1:], lng[1:])))
+
+        active = (seg_dt > 0) & (seg_dt <= self.max_gap_s)
+        distance = np.where(active, seg_dist, 0.0)
+        active_seconds = np.where(active, seg_dt, 0.0)
+
+        # 已依時間排序，同一小時的定位點相鄰，以 reduceat 分段加總
+        hours = np.floor(epoch / 3600).astype(np.int64)
+        starts = np.flatnonzero(np.diff(hours, prepend=hours[0] - 1))
+        ends = np.append(starts[1:], n) - 1
+        counts = np.diff(np.append(starts, n))
+
+        columns = zip(
+            hours[starts].tolist(), counts.tolist(),
+            np.add.reduceat(distance, starts).tolist(), np.add.reduceat(active_seconds, starts).tolist(),
+            np.minimum.reduceat(lat, starts).tolist(), np.maximum.reduceat(lat, starts).tolist(),
+            np.minimum.reduceat(lng, starts).tolist(), np.maximum.reduceat(lng, starts).tolist(),
+            starts.tolist(), ends.tolist()
+        )
+        for hour, count, dist, active_s, min_lat, max_lat, min_lng, max_lng, first, last in columns:
+            buckets[EPOCH + timedelta(hours=hour)] = {
+                "point_count": count,
+                "distance_m": dist,
+                "active_seconds": active_s,
+                "min_latitude": min_lat,
+                "max_latitude": max_lat,
+                "min_longitude": min_lng,
+                "max_longitude": max_lng,
+                "first_timestamp": timestamps[first],
+                "last_timestamp": timestamps[last],
+                "last_latitude": float(lat[last]),
+                "last_longitude": float(lng[last])
+            }
+        return buckets
+
+    @staticmethod
+    def aggregate_days(hourly: "OrderedDict[datetime, Dict[str, Any]]") -> "OrderedDict[date, Dict[str, Any]]":
+        days: "OrderedDict[date, Dict[str, Any]]" = OrderedDict()
+        for hour, values in hourly.items():
+            day = hour.date()
+            days[day] = _combine(days[day], values) if day in days else dict(values)
+        return days
+
+    @staticmethod
+    def _transaction() -> Session:
+        """開啟交易中的 Session：引擎為 AUTOCOMMIT，刪除與重建需一起提交，失敗時才能回滾"""
+        db = SessionLocal()
+        db.connection(execution_options={"isolation_level": TRANSACTION_ISOLATION_LEVEL})
+        return db
+
+    def _aggregate_rows(self, rows: List[Tuple[int, datetime, float, float]], previous: PreviousPoint = None):
+        timestamps = [_naive_utc(row[1]) for row in rows]
+        lat = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+        lng = np.fromiter((row[3] for row in rows), dtype=np.float64, count=len(rows))
+        return self.aggregate_hours(timestamps, lat, lng, previous)
+
+    def on_insert(self, rows: List[Dict[str, Any]]):
+        """寫入定位點後記錄待更新的用戶與日期，由背景工作更新彙總表"""
+        if not self.enabled or not rows:
+            return
+        with self._pending_lock:
+            for row in rows:
+                timestamp = _naive_utc(row["timestamp"])
+                self._queue(row["user_id"], timestamp, {timestamp.date()})
+
+    def _queue(self, user_id: int, earliest: datetime, days: Set[date]):
+        # 呼叫端需持有 _pending_lock
+        current = self._pending.get(user_id)
+        if current is None:
+            self._pending[user_id] = (earliest, set(days))
+        else:
+            self._pending[user_id] = (min(current[0], earliest), current[1] | days)
+
+    def process_user(self, user_id: int):
+        """將用戶待更新的定位點併入彙總表"""
+        with self._pending_lock:
+            pending = self._pending.pop(user_id, None)
+        if pending is None:
+            return
+        earliest, days = pending
+
+        with self._lock:
+            db = self._transaction()
+            try:
+                latest = db.query(GPSDailyRollup).filter(
+                    GPSDailyRollup.user_id == user_id
+                ).order_by(GPSDailyRollup.day.desc()).first()
+
+                if latest is None or earliest > latest.last_timestamp:
+                    # 依時間接續在最後一個定位點之後：讀取之後的定位點直接累加
+                    self._append_after(db, user_id, latest, earliest)
+                    self.incremental_updates += 1
+                else:
+                    # 晚到的舊定位點會改變路段歸屬，重算受影響的日期（含隔天的第一段）
+                    self._rebuild_days(db, user_id, sorted(days | {day + timedelta(days=1) for day in days}))
+                db.commit()
+            except Exception:
+                db.rollback()
+                with self._pending_lock:
+                    self._queue(user_id, earliest, days)
+                raise
+            finally:
+                db.close()
+
+    def _append_after(self, db: Session, user_id: int, latest: Optional[GPSDailyRollup], earliest: datetime):
+        # 尚無彙總時只彙總新定位點，既有資料由 backfill 建立
+        start = earliest
+        previous = None
+        if latest is not None:
+            start = latest.last_timestamp + timedelta(microseconds=1)
+            previous = (latest.last_timestamp, latest.last_latitude, latest.last_longitude)
+
+        hourly: "OrderedDict[datetime, Dict[str, Any]]" = OrderedDict()
+        for chunk in stream_track(user_id, start, None, self.chunk_size):
+            for hour, aggregate in self._aggregate_rows(chunk, previous).items():
+                hourly[hour] = _combine(hourly[hour], aggregate) if hour in hourly else aggregate
+            previous = (_naive_utc(chunk[-1][1]), chunk[-1][2], chunk[-1][3])
+        if hourly:
+            self._merge(db, user_id, hourly)
+
+    def process_pending(self):
+        """更新所有待處理用戶的彙總"""
+        started = time.perf_counter()
+        with self._pending_lock:
+            user_ids = list(self._pending)
+        for user_id in user_ids:
+            try:
+                self.process_user(user_id)
+            except Exception as e:
+                self.failed_updates += 1
+                logger.error(f"GPS rollup update failed for user {user_id}: {e}")
+        self.last_run_ms = (time.perf_counter() - started) * 1000
+
+    def _catch_up(self):
+        """服務未執行期間寫入的定位點：最新定位晚於彙總最後一點的用戶加入待更新（尚無彙總的用戶由 backfill 建立）"""
+        db = SessionLocal()
+        try:
+            rolled_up = dict(db.execute(
+                select(GPSDailyRollup.user_id, func.max(GPSDailyRollup.last_timestamp))
+                .group_by(GPSDailyRollup.user_id)
+            ).all())
+        finally:
+            db.close()
+        with self._pending_lock:
+            for user_id, location in latest_location_cache.snapshot().items():
+                last_timestamp = rolled_up.get(user_id)
+                if last_timestamp is not None and location[1] > last_timestamp:
+                    self._queue(user_id, datetime.max, set())
+
+    async def start(self):
+        """啟動定期更新工作"""
+        if not self.enabled or self._task is not None:
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self._catch_up)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"GPS rollup updates started with {len(self._pending)} pending users")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.process_pending)
+            except Exception as e:
+                logger.error(f"GPS rollup run failed: {e}")
+            await asyncio.sleep(self.interval_s)
+
+    def _merge(self, db: Session, user_id: int, hourly: "OrderedDict[datetime, Dict[str, Any]]"):
+        """將新的小時彙總累加到既有的小時與每日彙總"""
+        daily = self.aggregate_days(hourly)
+        existing_hours = {
+            rollup.hour: rollup for rollup in db.query(GPSHourlyRollup).filter(
+                GPSHourlyRollup.user_id == user_id, GPSHourlyRollup.hour.in_(list(hourly))
+            )
+        }
+        existing_days = {
+            rollup.day: rollup for rollup in db.query(GPSDailyRollup).filter(
+                GPSDailyRollup.user_id == user_id, GPSDailyRollup.day.in_(list(daily))
+            )
+        }
+        for model, key_name, values, existing in (
+            (GPSHourlyRollup, "hour", hourly, existing_hours),
+            (GPSDailyRollup, "day", daily, existing_days)
+        ):
+            for key, aggregate in values.items():
+                rollup = existing.get(key)
+                if rollup is None:
+                    db.add(model(user_id=user_id, **{key_name: key}, **aggregate))
+                else:
+                    for field, value in _combine(_to_dict(rollup), aggregate).items():
+                        setattr(rollup, field, value)
+
+    def _previous_point(self, db: Session, user_id: int, before: datetime) -> PreviousPoint:
+        rows = query_track(db, user_id, end=before - timedelta(microseconds=1), descending=True, limit=1)
+        if not rows:
+            return None
+        return (_naive_utc(rows[0][1]), rows[0][2], rows[0][3])
+
+    def _rebuild_days(self, db: Session, user_id: int, days: Iterable[date]):
+        """由原始定位點（含歸檔）重算指定日期的彙總"""
+        for day in days:
+            start = datetime.combine(day, datetime.min.time())
+            end = start + timedelta(days=1)
+            db.execute(delete(GPSHourlyRollup).where(
+                GPSHourlyRollup.user_id == user_id, GPSHourlyRollup.hour >= start, GPSHourlyRollup.hour < end
+            ))
+            db.execute(delete(GPSDailyRollup).where(GPSDailyRollup.user_id == user_id, GPSDailyRollup.day == day))
+
+            rows = query_track(db, user_id, start, end - timedelta(microseconds=1))
+            if rows:
+                self._merge(db, user_id, self._aggregate_rows(rows, self._previous_point(db, user_id, start)))
+            self.recomputed_days += 1
+
+    def rebuild(self, user_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None):
+        """刪除定位點後更新彙總：未指定範圍時刪除用戶全部彙總，否則重算範圍內已有彙總的日期"""
+        if not self.enabled:
+            return
+        db = self._transaction()
+        try:
+            with self._lock:
+                if start is None and end is None:
+                    db.execute(delete(GPSHourlyRollup).where(GPSHourlyRollup.user_id == user_id))
+                    db.execute(delete(GPSDailyRollup).where(GPSDailyRollup.user_id == user_id))
+                else:
+                    query = select(GPSDailyRollup.day).where(GPSDailyRollup.user_id == user_id)
+                    if start is not None:
+                        query = query.where(GPSDailyRollup.day >= start.date())
+                    if end is not None:
+                        query = query.where(GPSDailyRollup.day <= end.date())
+                    days = set(db.scalars(query).all())
+                    days |= {day + timedelta(days=1) for day in days}
+                    self._rebuild_days(db, user_id, sorted(days))
+                db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def backfill(
+        self,
+        user_id: int,
+        start_day: Optional[date] = None,
+        end_day: Optional[date] = None,
+        chunk_size: int = 5000
+    ) -> int:
+        """以原始定位點（含歸檔）重建用戶在日期範圍內的彙總，回傳彙總的天數"""
+        start = datetime.combine(start_day, datetime.min.time()) if start_day else None
+        end = datetime.combine(end_day + timedelta(days=1), datetime.min.time()) if end_day else None
+
+        db = SessionLocal()
+        try:
+            previous = self._previous_point(db, user_id, start) if start else None
+        finally:
+            db.close()
+
+        hourly: "OrderedDict[datetime, Dict[str, Any]]" = OrderedDict()
+        # 逐批串流讀取，跨批的同一小時以 _combine 接續
+        for chunk in stream_track(user_id, start, end - timedelta(microseconds=1) if end else None, chunk_size):
+            for hour, aggregate in self._aggregate_rows(chunk, previous).items():
+                hourly[hour] = _combine(hourly[hour], aggregate) if hour in hourly else aggregate
+            previous = (_naive_utc(chunk[-1][1]), chunk[-1][2], chunk[-1][3])
+        daily = self.aggregate_days(hourly)
+
+        db = self._transaction()
+        try:
+            with self._lock:
+                hour_delete = delete(GPSHourlyRollup).where(GPSHourlyRollup.user_id == user_id)
+                day_delete = delete(GPSDailyRollup).where(GPSDailyRollup.user_id == user_id)
+                if start is not None:
+                    hour_delete = hour_delete.where(GPSHourlyRollup.hour >= start)
+                    day_delete = day_delete.where(GPSDailyRollup.day >= start_day)
+                if end is not None:
+                    hour_delete = hour_delete.where(GPSHourlyRollup.hour < end)
+                    day_delete = day_delete.where(GPSDailyRollup.day <= end_day)
+                db.execute(hour_delete)
+                db.execute(day_delete)
+                db.add_all(GPSHourlyRollup(user_id=user_id, hour=hour, **values) for hour, values in hourly.items())
+                db.add_all(GPSDailyRollup(user_id=user_id, day=day, **values) for day, values in daily.items())
+                db.commit()
+            return len(daily)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "max_gap_s": self.max_gap_s,
+            "pending_users": len(self._pending),
+            "incremental_updates": self.incremental_updates,
+            "recomputed_days": self.recomputed_days,
+            "failed_updates": self.failed_updates,
+            "last_run_ms": round(self.last_run_ms, 3)
+        }
+
+
+def summarize(rollups: List[Any]) -> Dict[str, Any]:
+    """加總多個時段的彙總"""
+    if not rollups:
+        return {"point_count": 0, "distance_m": 0.0, "active_seconds": 0.0, "bounding_box": None}
+    return {
+        "point_count": sum(r.point_count for r in rollups),
+        "distance_m": round(sum(r.distance_m for r in rollups), 1),
+        "active_seconds": round(sum(r.active_seconds for r in rollups), 1),
+        "bounding_box": {
+            "min_latitude": min(r.min_latitude for r in rollups),
+            "max_latitude": max(r.max_latitude for r in rollups),
+            "min_longitude": min(r.min_longitude for r in rollups),
+            "max_longitude": max(r.max_longitude for r in rollups)
+        }
+    }
+
+
+# 創建全局 GPS 彙總服務實例
+gps_rollup_service = GPSRollupService()
@@ -0,0 +1,218 @@
+"""
+GPS 定位寫入服務 - 批次驗證與批次寫入
+"""
+
+import logging
+import os
+import time
+from datetime import date, datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from app.database import TRANSACTION_ISOLATION_LEVEL
+from app.models.gps_route import GPSLocation
+from app.services.geo_utils import geohash_encode_np
+from app.services.gps_track_service import simplified_track_cache
+from app.services.gps_stats import trip_stats_cache
+from app.services.gps_trips import trip_segmentation_service
+from app.services.gps_rollup import gps_rollup_service
+from app.services.gps_latest import latest_location_cache
+
+logger = logging.getLogger(__name__)
+
+# 批次上傳單次最多的定位點數量
+GPS_BATCH_MAX_POINTS = int(os.getenv('GPS_BATCH_MAX_POINTS', '1000'))
+
+# 允許定位時間超前伺服器時間的秒數（裝置時鐘誤差）
+GPS_MAX_FUTURE_SKEW_SECONDS = float(os.getenv('GPS_MAX_FUTURE_SKEW_SECONDS', '300'))
+
+# 允許的最早定位時間（UTC），早於此時間多為裝置時鐘未設定；同時避免轉換 datetime64 時溢位
+GPS_MIN_TIMESTAMP = datetime.fromisoformat(os.getenv('GPS_MIN_TIMESTAMP', '2000-01-01T00:00:00'))
+GPS_MIN_EPOCH = GPS_MIN_TIMESTAMP.replace(tzinfo=timezone.utc).timestamp()
+
+
+def parse_gps_timestamp(ts: str) -> datetime:
+    """
+    解析 ISO 8601 時間戳記（支援 Z 結尾）
+
+    統一轉為無時區的 UTC 時間，與欄式批次（validate_gps_columns）及資料庫中的格式一致；
+    未帶時區的時間視為 UTC
+    """
+    timestamp = datetime.fromisoformat(ts.replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def check_gps_timestamp(timestamp: datetime):
+    """檢查定位時間不早於 GPS_MIN_TIMESTAMP，失敗時拋出 ValueError"""
+    if timestamp < GPS_MIN_TIMESTAMP:
+        raise ValueError(f'時間戳記不可早於 {GPS_MIN_TIMESTAMP.isoformat()}')
+
+
+def validate_gps_point(point: Dict[str, Any]) -> Tuple[float, float, datetime]:
+    """驗證單一定位點，失敗時拋出 ValueError"""
+    if not isinstance(point, dict):
+        raise ValueError('定位點格式無效')
+
+    try:
+        lat = float(point['lat'])
+        lng = float(point['lng'])
+        ts = point['ts']
+    except KeyError as e:
+        raise ValueError(f'缺少欄位 {e.args[0]}')
+    except (TypeError, ValueError):
+        raise ValueError('經緯度必須是數字')
+
+    if not (-90 <= lat <= 90):
+        raise ValueError('緯度必須在 -90 到 90 之間')
+    if not (-180 <= lng <= 180):
+        raise ValueError('經度必須在 -180 到 180 之間')
+    if not isinstance(ts, str):
+        raise ValueError('時間戳記必須是 ISO 8601 字串')
+
+    try:
+        timestamp = parse_gps_timestamp(ts)
+    except ValueError:
+        raise ValueError(f'時間戳記格式無效: {ts}')
+    check_gps_timestamp(timestamp)
+
+    return lat, lng, timestamp
+
+
+def validate_gps_points(user_id: int, points: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    驗證整批定位點
+
+    回傳 (可寫入的資料列, 錯誤列表)，錯誤列表中的 index 對應原始陣列位置
+    """
+    rows = []
+    errors = []
+    for index, point in enumerate(points):
+        try:
+            lat, lng, timestamp = validate_gps_point(point)
+        except ValueError as e:
+            errors.append({"index": index, "error": str(e)})
+            continue
+
+        rows.append({
+            "user_id": user_id,
+            "latitude": lat,
+            "longitude": lng,
+            "timestamp": timestamp
+        })
+    return rows, errors
+
+
+def validate_gps_columns(
+    user_id: int,
+    lat: Sequence[float],
+    lng: Sequence[float],
+    ts: Sequence[float]
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    以向量化方式驗證欄式（columnar）批次：lat[]、lng[]、ts[]（UTC epoch 秒）
+
+    回傳格式與 validate_gps_points 相同
+    """
+    lat_arr = np.asarray(lat, dtype=np.float64)
+    lng_arr = np.asarray(lng, dtype=np.float64)
+    ts_arr = np.asarray(ts, dtype=np.float64)
+
+    if not (lat_arr.shape == lng_arr.shape == ts_arr.shape) or lat_arr.ndim != 1:
+        raise ValueError('lat、lng、ts 陣列長度必須相同')
+
+    # 依序檢查，每個點只回報第一個錯誤
+    checks = [
+        (~(np.isfinite(lat_arr) & np.isfinite(lng_arr) & np.isfinite(ts_arr)), '數值無效'),
+        ((lat_arr < -90) | (lat_arr > 90), '緯度必須在 -90 到 90 之間'),
+        ((lng_arr < -180) | (lng_arr > 180), '經度必須在 -180 到 180 之間'),
+        (ts_arr > time.time() + GPS_MAX_FUTURE_SKEW_SECONDS, '時間戳記不可晚於目前時間'),
+        (ts_arr < GPS_MIN_EPOCH, f'時間戳記不可早於 {GPS_MIN_TIMESTAMP.isoformat()}'),
+    ]
+
+    invalid = np.zeros(len(ts_arr), dtype=bool)
+    reasons = np.empty(len(ts_arr), dtype=object)
+    for mask, message in checks:
+        new = mask & ~invalid
+        reasons[new] = message
+        invalid |= mask
+
+    # 時間必須遞增：與前面有效定位點的最大時間比較
+    if len(ts_arr) > 1:
+        valid_ts = np.where(invalid, -np.inf, ts_arr)
+        previous_max = np.maximum.accumulate(valid_ts)[:-1]
+        out_of_order = np.concatenate(([False], ts_arr[1:] < previous_max)) & ~invalid
+        reasons[out_of_order] = '時間戳記必須遞增'
+        invalid |= out_of_order
+
+    errors = [{"index": int(i), "error": reasons[i]} for i in np.flatnonzero(invalid)]
+
+    valid = ~invalid
+    # epoch 秒一次轉換為 datetime（UTC）
+    timestamps = (ts_arr[valid] * 1e6).astype('datetime64[us]').astype(object)
+    rows = [
+        {"user_id": user_id, "latitude": la, "longitude": ln, "timestamp": t}
+        for la, ln, t in zip(lat_arr[valid].tolist(), lng_arr[valid].tolist(), timestamps)
+    ]
+    return rows, errors
+
+
+def insert_gps_rows(
+    db: Session,
+    rows: List[Dict[str, Any]],
+    before_commit: Optional[Callable[[Session], None]] = None
+) -> List[int]:
+    """
+    以單一多列 INSERT 寫入定位點，回傳依輸入順序排列的 ID
+
+    before_commit 在提交前、與定位點同一交易中執行（例如記錄已寫入的日誌位置）
+    """
+    if not rows:
+        return []
+
+    if before_commit is not None:
+        # 引擎為 AUTOCOMMIT，需與定位點一起提交時改用交易
+        db.connection(execution_options={"isolation_level": TRANSACTION_ISOLATION_LEVEL})
+
+    # 一次計算整批的 geohash
+    geohashes = geohash_encode_np(
+        np.fromiter((row["latitude"] for row in rows), dtype=np.float64, count=len(rows)),
+        np.fromiter((row["longitude"] for row in rows), dtype=np.float64, count=len(rows))
+    )
+    rows = [{**row, "geohash": geohash} for row, geohash in zip(rows, geohashes)]
+
+    ids = db.scalars(
+        insert(GPSLocation).returning(GPSLocation.id, sort_by_parameter_order=True),
+        rows
+    ).all()
+    if before_commit is not None:
+        before_commit(db)
+    db.commit()
+    ids = list(ids)
+    logger.info(f"Bulk inserted {len(ids)} GPS locations")
+
+    # 以下皆在提交之後：失敗只記錄，不可讓已提交的批次被回報為寫入失敗（會導致重送而重複）
+    _after_commit("invalidate cached tracks", _invalidate_past_days, rows)
+    _after_commit("update latest location cache", latest_location_cache.update_rows, rows, ids)
+    _after_commit("update GPS rollups", gps_rollup_service.on_insert, rows)
+    _after_commit("update trip segmentation", trip_segmentation_service.on_insert, rows)
+    return ids
+
+
+def _invalidate_past_days(rows: List[Dict[str, Any]]):
+    # 晚到的過去日期定位點會改變該日的簡化軌跡
+    today = date.today()
+    for user_id, day in {(row["user_id"], row["timestamp"].date()) for row in rows}:
+        if day < today:
+            simplified_track_cache.invalidate(user_id, day)
+            trip_stats_cache.invalidate(user_id, day)
+
+
+def _after_commit(action: str, func: Callable, *args):
+    """執行寫入後的快取與衍生資料更新，例外只記錄不往外拋"""
+    try:
+        func(*args)
+    except Exception as e:
+        logger.error(f"Failed to {action} after GPS insert: {e}")
@@ -0,0 +1,378 @@
+"""
+相似用戶索引 - 以 MinHash / LSH 找出移動範圍相似的用戶
+
+每位用戶近 GPS_SIMILAR_LOOKBACK_DAYS 天行程中的定位點與使用中通勤路線，轉為經過的 geohash 網格集合，
+以 MinHash 簽章估計兩個集合的 Jaccard 相似度。簽章切成多個 band，每個 band 雜湊到一個桶，
+查詢時只比較至少有一個 band 落在同一桶的用戶，不需與全部用戶比較。
+背景工作定期檢查行程與通勤路線的變更，只重新計算有變更的用戶（行程滑出回溯期間也會改變行程數）；
+查詢時尚未計算的用戶加入待計算，由背景工作在短間隔內計算，不在請求中計算。
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+import numpy as np
+from sqlalchemy import func, select
+from app.database import SessionLocal
+from app.models.commute_route import CommuteRoute
+from app.models.gps_trip import Trip
+from app.services.commute_route_service import decode_route_points
+from app.services.geo_utils import geohash_codes_np, haversine_m_np
+from app.services.gps_encoding import to_epoch_seconds
+from app.services.gps_track_service import stream_track
+
+logger = logging.getLogger(__name__)
+
+METERS_PER_DEGREE = 111320.0
+
+# splitmix64 的常數
+_MIX_1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX_2 = np.uint64(0x94d049bb133111eb)
+
+# 用戶資料版本：(最新行程 id, 行程數, 最新路線更新時間, 路線數)
+UserVersion = Tuple[Any, int, Any, int]
+
+
+def _mix64(values: np.ndarray) -> np.ndarray:
+    """splitmix64 混合函數（uint64 乘法溢位即為取模）"""
+    values = (values ^ (values >> np.uint64(30))) * _MIX_1
+    values = (values ^ (values >> np.uint64(27))) * _MIX_2
+    return values ^ (values >> np.uint64(31))
+
+
+def minhash_signature(cells: np.ndarray, seeds: np.ndarray) -> np.ndarray:
+    """每個 seed 對應一個雜湊函數，簽章為各雜湊函數在集合上的最小值（取低 32 位元）"""
+    hashed = _mix64(cells.astype(np.uint64)[None, :] ^ seeds[:, None]) & np.uint64(0xffffffff)
+    return hashed.min(axis=1).astype(np.uint32)
+
+
+def path_cells(lat: np.ndarray, lng: np.ndarray, connected: np.ndarray, step_m: float, precision: int) -> np.ndarray:
+    """
+    折線經過的 geohash 網格（整數）
+
+    connected[i] 表示第 i 點與第 i+1 點屬於同一條路徑；相連的兩點間以 step_m 插點，避免稀疏定位跳過網格
+    """
+    if len(lat) == 0:
+        return np.empty(0, dtype=np.uint64)
+    lengths = haversine_m_np(lat[:-1], lng[:-1], lat[1:], lng[1:])
+    pieces = np.where(connected[:len(lengths)], np.maximum(np.ceil(lengths / step_m), 1), 1).astype(np.int64)
+    segment = np.repeat(np.arange(len(lengths)), pieces)
+    t = (np.arange(len(segment)) - np.repeat(np.cumsum(pieces) - pieces, pieces)) / pieces[segment]
+    t = np.where(connected[segment], t, 0.0)
+    sample_lat = np.append(lat[segment] + t * (lat[segment + 1] - lat[segment]), lat[-1])
+    sample_lng = np.append(lng[segment] + t * (lng[segment + 1] - lng[segment]), lng[-1])
+    return np.unique(geohash_codes_np(sample_lat, sample_lng, precision))
+
+
+class SimilarUserIndex:
+    """用戶移動網格集合的 MinHash 簽章與 LSH 桶"""
+
+    def __init__(self):
+        self.enabled = os.getenv('GPS_SIMILAR_ENABLED', 'true').lower() == 'true'
+        self.lookback_days = int(os.getenv('GPS_SIMILAR_LOOKBACK_DAYS', '28'))        # 使用最近 N 天的行程
+        self.precision = int(os.getenv('GPS_SIMILAR_GEOHASH_PRECISION', '6'))         # 網格的 geohash 長度（6 約 1.2 x 0.6 公里）
+        self.bands = int(os.getenv('GPS_SIMILAR_BANDS', '32'))                        # LSH band 數
+        self.rows = int(os.getenv('GPS_SIMILAR_ROWS', '4'))                           # 每個 band 的簽章長度
+        self.min_cells = int(os.getenv('GPS_SIMILAR_MIN_CELLS', '3'))                 # 網格數少於此值的用戶不列入索引
+        self.batch_users = int(os.getenv('GPS_SIMILAR_BATCH_USERS', '1000'))          # 每次背景工作最多重新計算的用戶數
+        self.interval_s = float(os.getenv('GPS_SIMILAR_INTERVAL_S', '3600'))          # 背景工作間隔
+        self.pending_interval_s = float(os.getenv('GPS_SIMILAR_PENDING_S', '5'))      # 檢查待計算用戶的間隔
+        self.num_perm = self.bands * self.rows
+        self._seeds = np.random.default_rng(20240101).integers(0, 2 ** 63, size=self.num_perm, dtype=np.uint64)
+
+        # 插點間距取網格較短邊的一半
+        lat_bits = 5 * self.precision // 2
+        self.step_m = 180 / 2 ** lat_bits * METERS_PER_DEGREE / 2
+
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        # 簽章存放在以 slot 為索引的 numpy 陣列，桶中記錄 slot
+        self._slots: Dict[int, int] = {}  # {user_id: slot}
+        self._versions: Dict[int, Optional[UserVersion]] = {}  # 已檢查但沒有行程與通勤路線的用戶為 None
+        self._pending: Set[int] = set()  # 查詢時尚未計算的用戶
+        self._free_slots: List[int] = []
+        self._size = 0
+        self._user_ids = np.full(1024, -1, dtype=np.int64)
+        self._cell_counts = np.zeros(1024, dtype=np.int64)
+        self._signatures = np.zeros((1024, self.num_perm), dtype=np.uint32)
+        self._buckets: List[Dict[bytes, Set[int]]] = [{} for _ in range(self.bands)]
+
+        # 統計資料
+        self.queries = 0
+        self.last_query_ms = 0.0
+        self.last_candidates = 0
+        self.rebuilt_users = 0
+        self.last_rebuild: Optional[datetime] = None
+        self.last_rebuild_ms = 0.0
+
+    def _allocate_slot(self) -> int:
+        if self._free_slots:
+            return self._free_slots.pop()
+        if self._size == len(self._user_ids):
+            grow = len(self._user_ids)
+            self._user_ids = np.concatenate([self._user_ids, np.full(grow, -1, dtype=np.int64)])
+            self._cell_counts = np.concatenate([self._cell_counts, np.zeros(grow, dtype=np.int64)])
+            self._signatures = np.concatenate([self._signatures, np.zeros((grow, self.num_perm), dtype=np.uint32)])
+        self._size += 1
+        return self._size - 1
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def _remove(self, user_id: int):
+        """呼叫端需持有 _lock"""
+        self._versions.pop(user_id, None)
+        slot = self._slots.pop(user_id, None)
+        if slot is None:
+            return
+        for buckets, key in zip(self._buckets, self._band_keys(self._signatures[slot])):
+            members = buckets.get(key)
+            if members is not None:
+                members.discard(slot)
+                if not members:
+                    del buckets[key]
+        self._user_ids[slot] = -1
+        self._free_slots.append(slot)
+
+    def _put(self, user_id: int, signature: np.ndarray, cell_count: int, version: UserVersion):
+        """呼叫端需持有 _lock"""
+        self._remove(user_id)
+        slot = self._allocate_slot()
+        self._slots[user_id] = slot
+        self._versions[user_id] = version
+        self._user_ids[slot] = user_id
+        self._cell_counts[slot] = cell_count
+        self._signatures[slot] = signature
+        for buckets, key in zip(self._buckets, self._band_keys(signature)):
+            buckets.setdefault(key, set()).add(slot)
+
+    def user_versions(self, user_ids: Optional[List[int]] = None) -> Dict[int, UserVersion]:
+        """回溯期間內有行程或有使用中通勤路線的用戶與其資料版本"""
+        since = datetime.utcnow() - timedelta(days=self.lookback_days)
+        db = SessionLocal()
+        try:
+            trip_query = select(Trip.user_id, func.max(Trip.id), func.count(Trip.id)).where(Trip.start_time >= since)
+            route_query = select(
+                CommuteRoute.user_id,
+                func.max(func.coalesce(CommuteRoute.updated_at, CommuteRoute.created_at)),
+                func.count(CommuteRoute.id)
+            ).where(CommuteRoute.is_active == "active", CommuteRoute.point_count >= 2)
+            if user_ids is not None:
+                trip_query = trip_query.where(Trip.user_id.in_(user_ids))
+                route_query = route_query.where(CommuteRoute.user_id.in_(user_ids))
+            trips = {row[0]: row[1:] for row in db.execute(trip_query.group_by(Trip.user_id)).all()}
+            routes = {row[0]: row[1:] for row in db.execute(route_query.group_by(CommuteRoute.user_id)).all()}
+        finally:
+            db.close()
+        return {
+            user_id: (*trips.get(user_id, (None, 0)), *routes.get(user_id, (None, 0)))
+            for user_id in trips.keys() | routes.keys()
+        }
+
+    def user_cells(self, user_id: int) -> np.ndarray:
+        """用戶回溯期間內行程經過的網格，加上使用中通勤路線經過的網格"""
+        since = datetime.utcnow() - timedelta(days=self.lookback_days)
+        db = SessionLocal()
+        try:
+            trips = db.execute(
+                select(Trip.start_time, Trip.end_time).where(Trip.user_id == user_id, Trip.start_time >= since).order_by(Trip.start_time)
+            ).all()
+            routes = db.execute(
+                select(CommuteRoute.packed_points, CommuteRoute.gps_points)
+                .where(CommuteRoute.user_id == user_id, CommuteRoute.is_active == "active", CommuteRoute.point_count >= 2)
+            ).all()
+        finally:
+            db.close()
+
+        cells = [np.empty(0, dtype=np.uint64)]
+        for route in routes:
+            lat, lng, _ = decode_route_points(route)
+            cells.append(path_cells(lat, lng, np.ones(len(lat), dtype=bool), self.step_m, self.precision))
+
+        if trips:
+            trip_start = to_epoch_seconds([trip[0] for trip in trips])
+            trip_end = to_epoch_seconds([trip[1] for trip in trips])
+            for chunk in stream_track(user_id, trips[0][0], trips[-1][1]):
+                epoch = to_epoch_seconds([row[1] for row in chunk])
+                trip_index = np.searchsorted(trip_start, epoch, side='right') - 1
+                inside = (trip_index >= 0) & (epoch <= trip_end[np.maximum(trip_index, 0)])
+                if not inside.any():
+                    continue
+                lat = np.array([row[2] for row in chunk], dtype=np.float64)[inside]
+                lng = np.array([row[3] for row in chunk], dtype=np.float64)[inside]
+                trip_index = trip_index[inside]
+                # 同一趟行程的相鄰點才插點（跨批次的第一點只取網格）
+                cells.append(path_cells(lat, lng, np.append(trip_index[1:] == trip_index[:-1], False), self.step_m, self.precision))
+
+        return np.unique(np.concatenate(cells))
+
+    def rebuild(self, user_ids: Optional[List[int]] = None) -> int:
+        """
+        重新計算資料有變更的用戶簽章（指定 user_ids 時只檢查這些用戶），回傳重新計算的用戶數
+
+        已沒有行程與通勤路線的用戶自索引移除
+        """
+        started = time.perf_counter()
+        versions = self.user_versions(user_ids)
+        with self._lock:
+            indexed = list(self._versions) if user_ids is None else [u for u in user_ids if u in self._versions]
+            for user_id in indexed:
+                if user_id not in versions:
+                    self._remove(user_id)
+            # 從未計算過的用戶優先
+            due = sorted(
+                (user_id for user_id, version in versions.items() if self._versions.get(user_id) != version),
+                key=lambda user_id: user_id in self._versions
+            )[:self.batch_users]
+
+        for user_id in due:
+            try:
+                cells = self.user_cells(user_id)
+            except Exception as e:
+                logger.error(f"Similar user signature failed for user {user_id}: {e}")
+                continue
+            with self._lock:
+                if len(cells) < self.min_cells:
+                    self._remove(user_id)
+                    # 記錄版本，資料未變更前不再重新計算
+                    self._versions[user_id] = versions[user_id]
+                else:
+                    self._put(user_id, minhash_signature(cells, self._seeds), len(cells), versions[user_id])
+
+        self.rebuilt_users += len(due)
+        self.last_rebuild = datetime.utcnow()
+        self.last_rebuild_ms = (time.perf_counter() - started) * 1000
+        if due:
+            logger.info(f"Similar user index rebuilt {len(due)} users ({len(self._slots)} indexed)")
+        return len(due)
+
+    def is_indexed(self, user_id: int) -> bool:
+        return user_id in self._slots
+
+    def status(self, user_id: int) -> str:
+        """
+        用戶簽章的狀態：ready（已列入索引）、insufficient_data（網格數不足或沒有資料）、indexing（等待背景工作計算）
+
+        尚未檢查過的用戶加入待計算
+        """
+        with self._lock:
+            if user_id in self._slots:
+                return "ready"
+            if user_id in self._versions:
+                return "insufficient_data"
+            self._pending.add(user_id)
+            return "indexing"
+
+    def process_pending(self) -> int:
+        """計算查詢時加入的待計算用戶，回傳處理的用戶數"""
+        with self._lock:
+            user_ids = sorted(self._pending)[:self.batch_users]
+            self._pending.difference_update(user_ids)
+        if not user_ids:
+            return 0
+        try:
+            self.rebuild(user_ids)
+        except Exception:
+            with self._lock:
+                self._pending.update(user_ids)
+            raise
+        with self._lock:
+            for user_id in user_ids:
+                # 沒有行程與通勤路線的用戶記錄為已檢查，資料變更時由定期重建列入
+                self._versions.setdefault(user_id, None)
+        return len(user_ids)
+
+    def query(self, user_id: int, limit: int, min_similarity: float = 0.0) -> List[Dict[str, Any]]:
+        """
+        與用戶移動網格相似的其他用戶，依估計的 Jaccard 相似度排序
+
+        只比較至少有一個 band 與用戶同桶的候選（估計相似度 s 的用戶成為候選的機率為 1 - (1 - s^rows)^bands）
+        """
+        started = time.perf_counter()
+        with self._lock:
+            slot = self._slots.get(user_id)
+            if slot is None:
+                return []
+            signature = self._signatures[slot].copy()
+            slots: Set[int] = set()
+            for buckets, key in zip(self._buckets, self._band_keys(signature)):
+                slots.update(buckets.get(key, ()))
+            slots.discard(slot)
+            candidates = np.fromiter(slots, dtype=np.int64, count=len(slots))
+            user_ids = self._user_ids[candidates]
+            cell_counts = self._cell_counts[candidates]
+            signatures = self._signatures[candidates]
+
+        similarity = (signatures == signature[None, :]).mean(axis=1) if len(candidates) else np.empty(0)
+        selected = np.flatnonzero(similarity >= min_similarity)
+        if len(selected) > limit:
+            selected = selected[np.argpartition(-similarity[selected], limit - 1)[:limit]]
+        selected = selected[np.argsort(-similarity[selected], kind='stable')]
+
+        self.queries += 1
+        self.last_candidates = len(candidates)
+        self.last_query_ms = (time.perf_counter() - started) * 1000
+        return [
+            {"user_id": int(user_ids[i]), "similarity": round(float(similarity[i]), 4), "cell_count": int(cell_counts[i])}
+            for i in selected
+        ]
+
+    async def start(self):
+        """啟動定期重建工作"""
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info("Similar user index started")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_rebuild = 0.0
+        while True:
+            if time.monotonic() >= next_rebuild:
+                next_rebuild = time.monotonic() + self.interval_s
+                try:
+                    # 一次最多處理 batch_users 位用戶，還有待處理的用戶時立即繼續
+                    while await loop.run_in_executor(None, self.rebuild) >= self.batch_users:
+                        pass
+                except Exception as e:
+                    logger.error(f"Similar user index rebuild failed: {e}")
+            try:
+                await loop.run_in_executor(None, self.process_pending)
+            except Exception as e:
+                logger.error(f"Similar user pending signatures failed: {e}")
+            await asyncio.sleep(self.pending_interval_s)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "indexed_users": len(self._slots),
+            "pending_users": len(self._pending),
+            "bands": self.bands,
+            "rows": self.rows,
+            "geohash_precision": self.precision,
+            "buckets": sum(len(buckets) for buckets in self._buckets),
+            "rebuilt_users": self.rebuilt_users,
+            "last_rebuild": self.last_rebuild.isoformat() if self.last_rebuild else None,
+            "last_rebuild_ms": round(self.last_rebuild_ms, 3),
+            "queries": self.queries,
+            "last_candidates": self.last_candidates,
+            "last_query_ms": round(self.last_query_ms, 3)
+        }
+
+
+# 創建全局相似用戶索引實例
+similar_user_index = SimilarUserIndex()
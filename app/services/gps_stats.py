@@ -0,0 +1,128 @@
+"""
+GPS 行程統計 - 以 numpy 向量化計算單日的距離、速度、移動與停留時間
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from app.services.geo_utils import haversine_m_np
+from app.services.gps_encoding import to_epoch_seconds
+
+# 速度分布的區間（公里/小時）
+SPEED_BINS_KMH = (0, 5, 15, 30, 60, 90, 120)
+
+
+class TripStatsCalculator:
+    """依設定門檻計算軌跡統計"""
+
+    def __init__(self):
+        self.moving_speed_mps = float(os.getenv('GPS_STATS_MOVING_SPEED_MPS', '0.5'))  # 低於此速度視為停留
+        self.max_gap_s = float(os.getenv('GPS_STATS_MAX_GAP_S', '600'))                # 超過此間隔視為訊號中斷
+        self.min_interval_s = float(os.getenv('GPS_STATS_MIN_INTERVAL_S', '1'))        # 計算速度的最短間隔，避免除以極小值
+
+    def compute(self, rows: List[Tuple[int, datetime, float, float]]) -> Dict[str, Any]:
+        """由依時間排序的 (id, timestamp, latitude, longitude) 計算統計"""
+        n = len(rows)
+        stats: Dict[str, Any] = {
+            "point_count": n,
+            "start_time": rows[0][1].isoformat() if n else None,
+            "end_time": rows[-1][1].isoformat() if n else None,
+            "duration_s": 0.0,
+            "distance_m": 0.0,
+            "moving_time_s": 0.0,
+            "stopped_time_s": 0.0,
+            "gap_time_s": 0.0,
+            "max_speed_mps": 0.0,
+            "avg_moving_speed_mps": 0.0,
+            "speed_percentiles_mps": {"p50": 0.0, "p90": 0.0, "p95": 0.0, "p99": 0.0},
+            "speed_histogram_kmh": [
+                {"min": low, "max": high, "time_s": 0.0, "distance_m": 0.0}
+                for low, high in zip(SPEED_BINS_KMH, SPEED_BINS_KMH[1:] + (None,))
+            ]
+        }
+        if n < 2:
+            return stats
+
+        epoch = to_epoch_seconds([row[1] for row in rows]).astype(np.float64)
+        lat = np.fromiter((row[2] for row in rows), dtype=np.float64, count=n)
+        lng = np.fromiter((row[3] for row in rows), dtype=np.float64, count=n)
+
+        dt = np.diff(epoch)
+        distance = haversine_m_np(lat[:-1], lng[:-1], lat[1:], lng[1:])
+        speed = distance / np.maximum(dt, self.min_interval_s)
+
+        gap = dt > self.max_gap_s
+        moving = ~gap & (speed >= self.moving_speed_mps)
+        stopped = ~gap & ~moving
+
+        moving_time = float(dt[moving].sum())
+        moving_distance = float(distance[moving].sum())
+        # 速度與分布只採計間隔足夠長的移動路段
+        measured = moving & (dt >= self.min_interval_s)
+
+        stats.update({
+            "duration_s": float(epoch[-1] - epoch[0]),
+            "distance_m": round(float(distance[~gap].sum()), 1),
+            "moving_time_s": moving_time,
+            "stopped_time_s": float(dt[stopped].sum()),
+            "gap_time_s": float(dt[gap].sum()),
+            "max_speed_mps": round(float(speed[measured].max()), 2) if measured.any() else 0.0,
+            "avg_moving_speed_mps": round(moving_distance / moving_time, 2) if moving_time > 0 else 0.0
+        })
+
+        if measured.any():
+            percentiles = np.percentile(speed[measured], [50, 90, 95, 99])
+            stats["speed_percentiles_mps"] = dict(zip(("p50", "p90", "p95", "p99"), np.round(percentiles, 2).tolist()))
+
+            # 各速度區間的移動時間與距離
+            bins = np.digitize(speed[measured] * 3.6, SPEED_BINS_KMH[1:])
+            time_per_bin = np.bincount(bins, weights=dt[measured], minlength=len(SPEED_BINS_KMH))
+            distance_per_bin = np.bincount(bins, weights=distance[measured], minlength=len(SPEED_BINS_KMH))
+            for bucket, time_s, distance_m in zip(stats["speed_histogram_kmh"], time_per_bin.tolist(), distance_per_bin.tolist()):
+                bucket["time_s"] = round(time_s, 1)
+                bucket["distance_m"] = round(distance_m, 1)
+        return stats
+
+
+class TripStatsCache:
+    """過去日期的行程統計快取（LRU）"""
+
+    def __init__(self):
+        self.max_entries = int(os.getenv('GPS_STATS_CACHE_SIZE', '4096'))
+        self._cache: "OrderedDict[Tuple[int, date], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, day: date) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            value = self._cache.get((user_id, day))
+            if value is not None:
+                self._cache.move_to_end((user_id, day))
+            return value
+
+    def put(self, user_id: int, day: date, value: Dict[str, Any]):
+        # 當天的行程還會變動，不快取
+        if day >= date.today():
+            return
+        with self._lock:
+            self._cache[(user_id, day)] = value
+            self._cache.move_to_end((user_id, day))
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, user_id: int, day: Optional[date] = None):
+        """清除用戶的快取（未指定日期時清除全部日期）"""
+        with self._lock:
+            for key in [k for k in self._cache if k[0] == user_id and (day is None or k[1] == day)]:
+                del self._cache[key]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+# 創建全局行程統計實例
+trip_stats_calculator = TripStatsCalculator()
+trip_stats_cache = TripStatsCache()
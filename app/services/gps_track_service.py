@@ -0,0 +1,290 @@
+"""
+GPS 軌跡服務 - 軌跡查詢、簡化與快取
+"""
+
+import base64
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Any, Iterator, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import Session
+from app.database import engine
+from app.models.gps_route import GPSLocation
+from app.services.geo_utils import EARTH_RADIUS_M, geohash_ranges
+from app.services.gps_archive import gps_archive
+
+logger = logging.getLogger(__name__)
+
+
+def encode_cursor(timestamp: datetime, location_id: int) -> str:
+    """將分頁位置 (timestamp, id) 編碼為不透明字串"""
+    raw = json.dumps({"ts": timestamp.isoformat(), "id": location_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """解碼分頁位置，格式錯誤時拋出 ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(data["ts"]), int(data["id"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+
+def query_track(
+    db: Session,
+    user_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    descending: bool = False,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[datetime, int]] = None
+) -> List[Tuple[int, datetime, float, float]]:
+    """
+    查詢用戶軌跡，只讀取需要的欄位，回傳 (id, timestamp, latitude, longitude) 列表
+
+    after 為上一頁最後一筆的 (timestamp, id)，依排序方向取其後的資料（keyset 分頁）
+    """
+    query = db.query(
+        GPSLocation.id, GPSLocation.timestamp, GPSLocation.latitude, GPSLocation.longitude
+    ).filter(GPSLocation.user_id == user_id)
+
+    if start is not None:
+        query = query.filter(GPSLocation.timestamp >= start)
+    if end is not None:
+        query = query.filter(GPSLocation.timestamp <= end)
+
+    if after is not None:
+        after_ts, after_id = after
+        # 多加一個單欄範圍條件，讓 (user_id, timestamp) 索引可以直接做範圍掃描
+        if descending:
+            query = query.filter(
+                GPSLocation.timestamp <= after_ts,
+                or_(GPSLocation.timestamp < after_ts, and_(GPSLocation.timestamp == after_ts, GPSLocation.id < after_id))
+            )
+        else:
+            query = query.filter(
+                GPSLocation.timestamp >= after_ts,
+                or_(GPSLocation.timestamp > after_ts, and_(GPSLocation.timestamp == after_ts, GPSLocation.id > after_id))
+            )
+
+    if descending:
+        query = query.order_by(GPSLocation.timestamp.desc(), GPSLocation.id.desc())
+    else:
+        query = query.order_by(GPSLocation.timestamp, GPSLocation.id)
+
+    if limit is not None:
+        query = query.limit(limit)
+    rows = [tuple(row) for row in query.all()]
+
+    # 範圍落在熱資料窗口以外時合併歸檔資料
+    if gps_archive.has_data(user_id, start, end):
+        archived = gps_archive.read(user_id, start, end, descending, limit, after)
+        rows = _merge_rows(rows, archived, descending)
+        if limit is not None:
+            rows = rows[:limit]
+    return rows
+
+
+def _merge_rows(db_rows, archived_rows, descending: bool = False):
+    """合併兩個已排序的資料列序列，歸檔後尚未刪除的重複 ID 只保留一筆"""
+    if not archived_rows:
+        return db_rows
+    db_ids = {row[0] for row in db_rows}
+    archived_rows = (row for row in archived_rows if row[0] not in db_ids)
+    return list(heapq.merge(db_rows, archived_rows, key=lambda row: (row[1], row[0]), reverse=descending))
+
+
+def query_area(
+    db: Session,
+    min_lat: float,
+    min_lng: float,
+    max_lat: float,
+    max_lng: float,
+    start: datetime,
+    end: datetime,
+    limit: int = 1000,
+    max_cells: int = 64
+) -> Tuple[int, int, List[Tuple[int, int, datetime, float, float]]]:
+    """
+    查詢範圍框與時間窗內的所有用戶定位，回傳 (geohash 精度, 區間數, [(id, user_id, timestamp, latitude, longitude)])
+
+    範圍框先轉為少量 geohash 前綴區間，以 (geohash, timestamp) 索引篩選，再精確比對經緯度
+    """
+    precision, ranges = geohash_ranges(min_lat, min_lng, max_lat, max_lng, max_cells)
+    cell_conditions = [
+        and_(GPSLocation.geohash >= low, GPSLocation.geohash < high) if high is not None else GPSLocation.geohash >= low
+        for low, high in ranges
+    ]
+    rows = db.query(
+        GPSLocation.id, GPSLocation.user_id, GPSLocation.timestamp, GPSLocation.latitude, GPSLocation.longitude
+    ).filter(
+        or_(*cell_conditions),
+        GPSLocation.timestamp >= start,
+        GPSLocation.timestamp <= end,
+        GPSLocation.latitude.between(min_lat, max_lat),
+        GPSLocation.longitude.between(min_lng, max_lng)
+    ).order_by(GPSLocation.timestamp, GPSLocation.id).limit(limit).all()
+    return precision, len(ranges), [tuple(row) for row in rows]
+
+
+def stream_track(
+    user_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    chunk_size: int = 5000
+) -> Iterator[List[Tuple[int, datetime, float, float]]]:
+    """
+    以伺服器端游標分批讀取軌跡（依時間正序），每次產出一批資料列
+
+    使用獨立連線，記憶體用量只與 chunk_size 有關，與總筆數無關；範圍內有歸檔資料時逐月合併
+    """
+    chunks = _stream_db_track(user_id, start, end, chunk_size)
+    if not gps_archive.has_data(user_id, start, end):
+        yield from chunks
+        return
+
+    rows = heapq.merge(
+        itertools.chain.from_iterable(gps_archive.iter_months(user_id, start, end)),
+        itertools.chain.from_iterable(chunks),
+        key=lambda row: (row[1], row[0])
+    )
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def _stream_db_track(
+    user_id: int,
+    start: Optional[datetime],
+    end: Optional[datetime],
+    chunk_size: int
+) -> Iterator[List[Tuple[int, datetime, float, float]]]:
+    stmt = select(
+        GPSLocation.id, GPSLocation.timestamp, GPSLocation.latitude, GPSLocation.longitude
+    ).where(GPSLocation.user_id == user_id)
+    if start is not None:
+        stmt = stmt.where(GPSLocation.timestamp >= start)
+    if end is not None:
+        stmt = stmt.where(GPSLocation.timestamp <= end)
+    stmt = stmt.order_by(GPSLocation.timestamp, GPSLocation.id)
+
+    with engine.connect() as conn:
+        if engine.dialect.name == "postgresql":
+            # 伺服器端游標（named cursor）必須在交易中使用，不能用 AUTOCOMMIT
+            conn.execution_options(isolation_level="READ COMMITTED")
+        with conn.begin():
+            result = conn.execution_options(yield_per=chunk_size).execute(stmt)
+            for partition in result.partitions():
+                yield [tuple(row) for row in partition]
+
+
+def simplify_indices(lat: np.ndarray, lng: np.ndarray, tolerance_m: float) -> np.ndarray:
+    """
+    Douglas-Peucker 軌跡簡化，回傳保留點的索引（已排序）
+
+    以等距圓柱投影換算為公尺後計算，每一段的點到線距離以向量化方式一次算完
+    """
+    n = len(lat)
+    if n <= 2 or tolerance_m <= 0:
+        return np.arange(n)
+
+    lat0 = np.radians(np.mean(lat))
+    x = np.radians(lng) * EARTH_RADIUS_M * np.cos(lat0)
+    y = np.radians(lat) * EARTH_RADIUS_M
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        xs = x[first + 1:last]
+        ys = y[first + 1:last]
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        seg_len_sq = dx * dx + dy * dy
+
+        if seg_len_sq == 0:
+            dist = np.hypot(xs - x[first], ys - y[first])
+        else:
+            # 點到線段距離（投影參數限制在 0~1）
+            t = np.clip(((xs - x[first]) * dx + (ys - y[first]) * dy) / seg_len_sq, 0.0, 1.0)
+            dist = np.hypot(xs - (x[first] + t * dx), ys - (y[first] + t * dy))
+
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance_m:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    return np.flatnonzero(keep)
+
+
+def simplify_track(rows: List[Tuple[int, datetime, float, float]], tolerance_m: float) -> List[Tuple[int, datetime, float, float]]:
+    """簡化依時間排序的軌跡資料列"""
+    if len(rows) <= 2:
+        return rows
+    lat = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+    lng = np.fromiter((row[3] for row in rows), dtype=np.float64, count=len(rows))
+    return [rows[i] for i in simplify_indices(lat, lng, tolerance_m)]
+
+
+class SimplifiedTrackCache:
+    """過去日期的簡化軌跡快取（LRU）"""
+
+    def __init__(self):
+        self.max_entries = int(os.getenv('GPS_SIMPLIFY_CACHE_SIZE', '1024'))
+        self._cache: "OrderedDict[Tuple[int, date, float], Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, day: date, tolerance_m: float):
+        key = (user_id, day, tolerance_m)
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, user_id: int, day: date, tolerance_m: float, value):
+        # 當天的軌跡還會變動，不快取
+        if day >= date.today():
+            return
+        with self._lock:
+            self._cache[(user_id, day, tolerance_m)] = value
+            self._cache.move_to_end((user_id, day, tolerance_m))
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, user_id: int, day: Optional[date] = None):
+        """清除用戶的快取（未指定日期時清除全部日期）"""
+        with self._lock:
+            for key in [k for k in self._cache if k[0] == user_id and (day is None or k[1] == day)]:
+                del self._cache[key]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+# 創建全局簡化軌跡快取實例
+simplified_track_cache = SimplifiedTrackCache()
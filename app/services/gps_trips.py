@@ -0,0 +1,375 @@
+"""
+行程分段 - 由定位點偵測停留點（在半徑範圍內停留超過一定時間）與停留點之間的行程
+
+寫入定位點時記錄待處理的用戶，背景工作只重新分段上次確定的分段邊界之後的定位點；
+尚未離開的停留點與尚未抵達的行程留到下次處理。晚到的舊定位點會回退到其之前最後一個邊界後重新分段。
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.models.gps_trip import StayPoint, Trip, TripSegmentationState
+from app.services.geo_utils import haversine_m_np
+from app.services.gps_encoding import to_epoch_seconds
+from app.services.gps_latest import latest_location_cache
+from app.services.gps_track_service import query_track
+
+logger = logging.getLogger(__name__)
+
+# 行程的出發停留點為分段狀態中記錄的停留點
+STATE_ORIGIN = -1
+
+
+def _naive_utc(timestamp: datetime) -> datetime:
+    if timestamp.tzinfo is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+class TripSegmentationService:
+    """停留點與行程的增量分段"""
+
+    def __init__(self):
+        self.enabled = os.getenv('GPS_TRIP_ENABLED', 'true').lower() == 'true'
+        self.stay_radius_m = float(os.getenv('GPS_STAY_RADIUS_M', '200'))              # 停留範圍半徑
+        self.stay_min_duration_s = float(os.getenv('GPS_STAY_MIN_DURATION_S', '600'))  # 停留超過此秒數才算停留點
+        self.max_gap_s = float(os.getenv('GPS_TRIP_MAX_GAP_S', '1800'))                # 行程中間隔超過此秒數視為訊號中斷，切成兩段
+        self.interval_s = float(os.getenv('GPS_TRIP_INTERVAL_S', '60'))
+        self.chunk_size = int(os.getenv('GPS_TRIP_CHUNK_SIZE', '5000'))                # 每次讀取的定位點數
+        self._pending: Dict[int, datetime] = {}  # {user_id: 新定位點中最早的時間}
+        self._pending_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        # 統計資料
+        self.processed_users = 0
+        self.stays_created = 0
+        self.trips_created = 0
+        self.rewinds = 0
+        self.failed_users = 0
+        self.last_run_ms = 0.0
+
+    def on_insert(self, rows: List[Dict[str, Any]]):
+        """寫入定位點後記錄待分段的用戶"""
+        if not self.enabled:
+            return
+        with self._pending_lock:
+            for row in rows:
+                timestamp = _naive_utc(row["timestamp"])
+                current = self._pending.get(row["user_id"])
+                if current is None or timestamp < current:
+                    self._pending[row["user_id"]] = timestamp
+
+    def mark_pending(self, user_id: int):
+        """將用戶加入待分段（沒有晚到的舊定位點）"""
+        with self._pending_lock:
+            self._pending.setdefault(user_id, datetime.max)
+
+    def is_pending(self, user_id: int) -> bool:
+        return user_id in self._pending
+
+    def _first_beyond(self, lat: np.ndarray, lng: np.ndarray, anchor: int) -> int:
+        """anchor 之後第一個超出停留半徑的定位點索引（沒有則回傳長度），以倍增的區塊向量化計算距離"""
+        n = len(lat)
+        start = anchor + 1
+        window = 64
+        while start < n:
+            end = min(start + window, n)
+            beyond = np.flatnonzero(
+                haversine_m_np(lat[anchor], lng[anchor], lat[start:end], lng[start:end]) > self.stay_radius_m
+            )
+            if len(beyond):
+                return start + int(beyond[0])
+            start = end
+            window *= 2
+        return n
+
+    def detect_stays(
+        self,
+        epoch: np.ndarray,
+        lat: np.ndarray,
+        lng: np.ndarray,
+        first: int = 0
+    ) -> Tuple[List[Tuple[int, int]], int]:
+        """
+        偵測停留點，回傳 ([(第一個索引, 最後一個索引)], 尚未能判斷的第一個索引)
+
+        由每個定位點往後找第一個超出半徑的點，期間超過最短停留時間即為停留點；
+        範圍一直延伸到資料結尾時，還無法判斷是否停留或何時離開。
+        """
+        n = len(epoch)
+        stays: List[Tuple[int, int]] = []
+        i = first
+        while i < n:
+            j = self._first_beyond(lat, lng, i)
+            if j == n:
+                break
+            if epoch[j - 1] - epoch[i] >= self.stay_min_duration_s:
+                stays.append((i, j - 1))
+                i = j
+            else:
+                i += 1
+        return stays, min(i, n)
+
+    def _split_gaps(self, epoch: np.ndarray, first: int, last: int) -> List[Tuple[int, int]]:
+        """將 [first, last] 在訊號中斷處切成多段"""
+        gaps = (np.flatnonzero(np.diff(epoch[first:last + 1]) > self.max_gap_s) + first).tolist()
+        return list(zip([first] + [gap + 1 for gap in gaps], gaps + [last]))
+
+    def plan(self, epoch: np.ndarray, lat: np.ndarray, lng: np.ndarray, first: int = 0):
+        """
+        由依時間排序的定位點規劃分段，回傳 (停留點, 行程, 新的邊界)
+
+        first 為 1 時第 0 個定位點是上次的分段邊界（行程由此出發，不參與停留偵測）。
+        行程為 (第一個索引, 最後一個索引, 出發停留點, 抵達停留點)，停留點以在回傳列表中的位置表示；
+        邊界為 (索引, 出發停留點)，沒有可以確定的分段時為 None。
+        """
+        stays, open_index = self.detect_stays(epoch, lat, lng, first)
+        trips: List[Tuple[int, int, Optional[int], Optional[int]]] = []
+        boundary: Optional[Tuple[int, Optional[int]]] = None
+        origin: Optional[int] = STATE_ORIGIN if first else None
+        start = 0
+
+        for k, (arrival, departure) in enumerate(stays):
+            pieces = self._split_gaps(epoch, start, arrival)
+            for p, (piece_first, piece_last) in enumerate(pieces):
+                if piece_last > piece_first:
+                    trips.append((
+                        piece_first, piece_last,
+                        origin if p == 0 else None,
+                        k if p == len(pieces) - 1 else None
+                    ))
+            origin = k
+            start = departure
+            boundary = (departure, k)
+
+        # 尚未抵達停留點的行程：訊號中斷之前的部分已可確定
+        if open_index < len(epoch):
+            pieces = self._split_gaps(epoch, start, open_index)
+            for p, (piece_first, piece_last) in enumerate(pieces[:-1]):
+                if piece_last > piece_first:
+                    trips.append((piece_first, piece_last, origin if p == 0 else None, None))
+                boundary = (piece_last, None)
+        return stays, trips, boundary
+
+    def _apply(self, db: Session, user_id: int, state: TripSegmentationState, rows, first: int) -> bool:
+        """將一批定位點的分段寫入資料庫，回傳分段邊界是否前進"""
+        timestamps = [_naive_utc(row[1]) for row in rows]
+        epoch = to_epoch_seconds(timestamps).astype(np.float64)
+        lat = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+        lng = np.fromiter((row[3] for row in rows), dtype=np.float64, count=len(rows))
+
+        stays, trips, boundary = self.plan(epoch, lat, lng, first)
+        if boundary is None or (state.processed_until is not None and timestamps[boundary[0]] <= state.processed_until):
+            return False
+
+        stay_points = [
+            StayPoint(
+                user_id=user_id,
+                arrival_time=timestamps[arrival],
+                departure_time=timestamps[departure],
+                latitude=float(lat[arrival:departure + 1].mean()),
+                longitude=float(lng[arrival:departure + 1].mean()),
+                point_count=departure - arrival + 1
+            )
+            for arrival, departure in stays
+        ]
+        db.add_all(stay_points)
+        db.flush()
+
+        def stay_id(index: Optional[int]) -> Optional[int]:
+            if index is None:
+                return None
+            if index == STATE_ORIGIN:
+                return state.origin_stay_id
+            return stay_points[index].id
+
+        segment_distance = haversine_m_np(lat[:-1], lng[:-1], lat[1:], lng[1:])
+        db.add_all(
+            Trip(
+                user_id=user_id,
+                origin_stay_id=stay_id(origin),
+                destination_stay_id=stay_id(destination),
+                start_time=timestamps[trip_first],
+                end_time=timestamps[trip_last],
+                start_latitude=float(lat[trip_first]),
+                start_longitude=float(lng[trip_first]),
+                end_latitude=float(lat[trip_last]),
+                end_longitude=float(lng[trip_last]),
+                distance_m=float(segment_distance[trip_first:trip_last].sum()),
+                point_count=trip_last - trip_first + 1
+            )
+            for trip_first, trip_last, origin, destination in trips
+        )
+
+        state.processed_until = timestamps[boundary[0]]
+        state.origin_stay_id = stay_id(boundary[1])
+        self.stays_created += len(stay_points)
+        self.trips_created += len(trips)
+        return True
+
+    def _rewind(self, db: Session, user_id: int, state: TripSegmentationState, since: Optional[datetime]):
+        """刪除 since 之後的分段，回退到其之前最後一個分段邊界（停留點的離開時間或因訊號中斷結束的行程）"""
+        boundary: Optional[datetime] = None
+        origin: Optional[int] = None
+        if since is not None:
+            stay = db.query(StayPoint).filter(
+                StayPoint.user_id == user_id, StayPoint.departure_time < since
+            ).order_by(StayPoint.departure_time.desc()).first()
+            trip_query = db.query(Trip).filter(
+                Trip.user_id == user_id, Trip.destination_stay_id.is_(None), Trip.end_time < since
+            )
+            if stay is not None:
+                trip_query = trip_query.filter(Trip.end_time > stay.departure_time)
+            trip = trip_query.order_by(Trip.end_time.desc()).first()
+            if trip is not None:
+                boundary = trip.end_time
+            elif stay is not None:
+                boundary, origin = stay.departure_time, stay.id
+
+        state.processed_until = boundary
+        state.origin_stay_id = origin
+        db.flush()
+
+        trip_delete = delete(Trip).where(Trip.user_id == user_id)
+        stay_delete = delete(StayPoint).where(StayPoint.user_id == user_id)
+        if boundary is not None:
+            trip_delete = trip_delete.where(Trip.end_time > boundary)
+            stay_delete = stay_delete.where(StayPoint.departure_time > boundary)
+        db.execute(trip_delete)
+        db.execute(stay_delete)
+        self.rewinds += 1
+
+    def process_user(self, user_id: int) -> int:
+        """分段用戶上次邊界之後的定位點，回傳新增的行程數"""
+        with self._pending_lock:
+            since = self._pending.pop(user_id, None)
+        trips_before = self.trips_created
+
+        with self._lock:
+            db = SessionLocal()
+            try:
+                state = db.get(TripSegmentationState, user_id)
+                if state is None:
+                    state = TripSegmentationState(user_id=user_id)
+                    db.add(state)
+                elif since is not None and state.processed_until is not None and since < state.processed_until:
+                    self._rewind(db, user_id, state, since)
+
+                limit = self.chunk_size
+                while True:
+                    first = 0 if state.processed_until is None else 1
+                    rows = query_track(db, user_id, start=state.processed_until, limit=limit)
+                    advanced = len(rows) > first and self._apply(db, user_id, state, rows, first)
+                    db.commit()
+                    if len(rows) < limit:
+                        break
+                    # 整批都還無法確定分段時（例如很長的停留），加大批次重新讀取
+                    limit = self.chunk_size if advanced else limit * 2
+                self.processed_users += 1
+            except Exception:
+                db.rollback()
+                if since is not None:
+                    with self._pending_lock:
+                        self._pending[user_id] = min(since, self._pending.get(user_id, since))
+                raise
+            finally:
+                db.close()
+        return self.trips_created - trips_before
+
+    def rewind(self, user_id: int, since: Optional[datetime] = None):
+        """刪除定位點後回退分段（未指定時間時刪除用戶全部分段），並重新加入待分段"""
+        if not self.enabled:
+            return
+        with self._lock:
+            db = SessionLocal()
+            try:
+                state = db.get(TripSegmentationState, user_id)
+                if state is None:
+                    state = TripSegmentationState(user_id=user_id)
+                    db.add(state)
+                self._rewind(db, user_id, state, since)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+        self.mark_pending(user_id)
+
+    def process_pending(self):
+        """分段所有待處理的用戶"""
+        started = time.perf_counter()
+        with self._pending_lock:
+            user_ids = list(self._pending)
+        for user_id in user_ids:
+            try:
+                self.process_user(user_id)
+            except Exception as e:
+                self.failed_users += 1
+                logger.error(f"Trip segmentation failed for user {user_id}: {e}")
+        self.last_run_ms = (time.perf_counter() - started) * 1000
+
+    def _catch_up(self):
+        """服務未執行期間寫入的定位點：最新定位晚於分段邊界的用戶加入待分段"""
+        db = SessionLocal()
+        try:
+            processed = dict(db.execute(
+                select(TripSegmentationState.user_id, TripSegmentationState.processed_until)
+            ).all())
+        finally:
+            db.close()
+        for user_id, location in latest_location_cache.snapshot().items():
+            processed_until = processed.get(user_id)
+            if processed_until is None or location[1] > processed_until:
+                self.mark_pending(user_id)
+
+    async def start(self):
+        """啟動定期分段工作"""
+        if not self.enabled or self._task is not None:
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self._catch_up)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Trip segmentation started with {len(self._pending)} pending users")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.process_pending)
+            except Exception as e:
+                logger.error(f"Trip segmentation run failed: {e}")
+            await asyncio.sleep(self.interval_s)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "pending_users": len(self._pending),
+            "processed_users": self.processed_users,
+            "stays_created": self.stays_created,
+            "trips_created": self.trips_created,
+            "rewinds": self.rewinds,
+            "failed_users": self.failed_users,
+            "last_run_ms": round(self.last_run_ms, 3)
+        }
+
+
+# 創建全局行程分段服務實例
+trip_segmentation_service = TripSegmentationService()
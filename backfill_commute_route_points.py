@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+將舊版 JSON 格式（gps_points）的通勤路線轉為二進位封裝（packed_points）並補上 point_count
+
+通勤配對、相似度、走廊與相似用戶索引只讀取 point_count 至少 2 的路線，舊資料需補齊後才會被索引。
+以主鍵分批更新，每批一個短交易，可隨時中斷後重新執行；保留原本的 gps_points，不重算距離與通勤時間。
+
+使用方式：
+    python backfill_commute_route_points.py [--chunk-size 500]
+"""
+
+import argparse
+
+
+def backfill_route_points(chunk_size: int) -> int:
+    from sqlalchemy.orm import undefer
+    from app.database import SessionLocal
+    from app.models.commute_route import CommuteRoute
+    from app.services.commute_route_service import decode_route_points, encode_route_points
+
+    total = 0
+    last_id = 0
+    db = SessionLocal()
+    try:
+        while True:
+            routes = db.query(CommuteRoute).options(undefer(CommuteRoute.gps_points)).filter(
+                CommuteRoute.packed_points.is_(None),
+                CommuteRoute.gps_points.isnot(None),
+                CommuteRoute.id > last_id
+            ).order_by(CommuteRoute.id).limit(chunk_size).all()
+            if not routes:
+                break
+
+            for route in routes:
+                try:
+                    lat, lng, epoch = decode_route_points(route)
+                except (ValueError, TypeError, KeyError, AttributeError) as e:
+                    print(f"  略過路線 {route.id}：定位點格式無效（{e}）")
+                    continue
+                route.packed_points = encode_route_points(lat, lng, epoch)
+                route.point_count = len(lat)
+                total += 1
+            db.commit()
+
+            last_id = routes[-1].id
+            print(f"  已轉換 {total} 條路線")
+    finally:
+        db.close()
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="轉換舊版 JSON 格式的通勤路線定位點")
+    parser.add_argument("--chunk-size", type=int, default=500, help="每批更新的路線數")
+    args = parser.parse_args()
+    try:
+        from app.database import create_tables
+        create_tables()
+        print("正在轉換通勤路線定位點...")
+        total = backfill_route_points(args.chunk_size)
+        print(f"通勤路線定位點轉換完成！共 {total} 條")
+    except Exception as e:
+        print(f"轉換失敗: {e}")
+        import traceback
+        traceback.print_exc()
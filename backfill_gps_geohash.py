@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+補齊既有 GPS 定位資料的 geohash 欄位
+
+以主鍵分批更新 geohash 為空的資料列，每批一個短交易，可隨時中斷後重新執行。
+
+使用方式：
+    python backfill_gps_geohash.py [--chunk-size 5000]
+"""
+
+import argparse
+
+
+def backfill_geohash(chunk_size: int) -> int:
+    import numpy as np
+    from sqlalchemy import bindparam, select, update
+    from app.database import SessionLocal
+    from app.models.gps_route import GPSLocation
+    from app.services.geo_utils import geohash_encode_np
+
+    table = GPSLocation.__table__
+    stmt = update(table).where(table.c.id == bindparam('b_id')).values(geohash=bindparam('b_geohash'))
+
+    total = 0
+    last_id = 0
+    db = SessionLocal()
+    try:
+        while True:
+            rows = db.execute(
+                select(table.c.id, table.c.latitude, table.c.longitude)
+                .where(table.c.geohash.is_(None), table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+
+            ids, lats, lngs = zip(*rows)
+            geohashes = geohash_encode_np(np.array(lats, dtype=np.float64), np.array(lngs, dtype=np.float64))
+            db.execute(stmt, [{"b_id": i, "b_geohash": g} for i, g in zip(ids, geohashes)])
+            db.commit()
+
+            total += len(rows)
+            last_id = ids[-1]
+            print(f"  已更新 {total} 筆")
+    finally:
+        db.close()
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="補齊 GPS 定位資料的 geohash 欄位")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="每批更新筆數")
+    args = parser.parse_args()
+    try:
+        from app.database import create_tables
+        create_tables()
+        print("正在補齊 GPS 定位資料的 geohash...")
+        total = backfill_geohash(args.chunk_size)
+        print(f"geohash 補齊完成！共 {total} 筆")
+    except Exception as e:
+        print(f"補齊失敗: {e}")
+        import traceback
+        traceback.print_exc()
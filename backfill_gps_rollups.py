@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+以既有的 GPS 定位資料重建每小時、每天的彙總表
+
+使用方式：
+    python backfill_gps_rollups.py                      # 所有用戶、全部日期
+    python backfill_gps_rollups.py --user-id 1
+    python backfill_gps_rollups.py --start-date 2025-01-01 --end-date 2025-06-30
+"""
+
+import argparse
+from datetime import datetime
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="重建 GPS 彙總表")
+    parser.add_argument("--user-id", type=int, help="只處理指定用戶")
+    parser.add_argument("--start-date", help="起始日期（YYYY-MM-DD）")
+    parser.add_argument("--end-date", help="結束日期（YYYY-MM-DD）")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        from app.database import SessionLocal, create_tables
+        from app.models.user import User
+        from app.services.gps_rollup import gps_rollup_service
+
+        start_day = datetime.strptime(args.start_date, '%Y-%m-%d').date() if args.start_date else None
+        end_day = datetime.strptime(args.end_date, '%Y-%m-%d').date() if args.end_date else None
+
+        create_tables()
+        if args.user_id is not None:
+            user_ids = [args.user_id]
+        else:
+            db = SessionLocal()
+            try:
+                user_ids = [row[0] for row in db.query(User.id).order_by(User.id).all()]
+            finally:
+                db.close()
+
+        print(f"正在重建 {len(user_ids)} 位用戶的 GPS 彙總表...")
+        total_days = 0
+        for user_id in user_ids:
+            days = gps_rollup_service.backfill(user_id, start_day, end_day)
+            total_days += days
+            if days:
+                print(f"  用戶 {user_id}: {days} 天")
+        print(f"GPS 彙總表重建完成！共 {total_days} 天")
+    except Exception as e:
+        print(f"重建失敗: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+以既有的 GPS 定位資料分段停留點與行程
+
+使用方式：
+    python backfill_trips.py                  # 所有用戶，接續上次的分段邊界
+    python backfill_trips.py --user-id 1
+    python backfill_trips.py --rebuild        # 刪除既有分段後全部重新分段（調整停留半徑或時間門檻後使用）
+"""
+
+import argparse
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="分段停留點與行程")
+    parser.add_argument("--user-id", type=int, help="只處理指定用戶")
+    parser.add_argument("--rebuild", action="store_true", help="刪除既有分段後重新分段")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        from app.database import SessionLocal, create_tables
+        from app.models.user import User
+        from app.services.gps_trips import trip_segmentation_service
+
+        create_tables()
+        if args.user_id is not None:
+            user_ids = [args.user_id]
+        else:
+            db = SessionLocal()
+            try:
+                user_ids = [row[0] for row in db.query(User.id).order_by(User.id).all()]
+            finally:
+                db.close()
+
+        print(f"正在分段 {len(user_ids)} 位用戶的停留點與行程...")
+        total_trips = 0
+        for user_id in user_ids:
+            if args.rebuild:
+                trip_segmentation_service.rewind(user_id)
+            trips = trip_segmentation_service.process_user(user_id)
+            total_trips += trips
+            if trips:
+                print(f"  用戶 {user_id}: {trips} 個行程")
+        print(f"行程分段完成！共新增 {total_trips} 個行程")
+    except Exception as e:
+        print(f"分段失敗: {e}")
+        import traceback
+        traceback.print_exc()
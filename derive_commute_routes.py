@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+由用戶近期的行程偵測通勤路線並寫入 commute_routes（適合以排程每晚執行）
+
+使用方式：
+    python derive_commute_routes.py                  # 所有近期有行程的用戶
+    python derive_commute_routes.py --user-id 1
+    python derive_commute_routes.py --workers 8      # 指定子程序數（0 表示不使用子程序）
+"""
+
+import argparse
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="偵測通勤路線")
+    parser.add_argument("--user-id", type=int, help="只處理指定用戶")
+    parser.add_argument("--workers", type=int, help="子程序數（預設 GPS_COMMUTE_WORKERS）")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        from app.database import create_tables
+        from app.services.commute_derivation import commute_derivation_service
+
+        create_tables()
+        if args.workers is not None:
+            commute_derivation_service.workers = args.workers
+
+        print("正在偵測通勤路線...")
+        result = commute_derivation_service.run([args.user_id] if args.user_id is not None else None)
+        print(
+            f"通勤路線偵測完成！{result['users']} 位用戶，新增 {result['created']} 條、更新 {result['updated']} 條、"
+            f"停用 {result['deactivated']} 條（失敗 {result['failed']} 位，耗時 {result['elapsed_s']} 秒）"
+        )
+    except Exception as e:
+        print(f"偵測失敗: {e}")
+        import traceback
+        traceback.print_exc()
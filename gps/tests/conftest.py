@@ -0,0 +1,47 @@
+"""
+GPS 測試共用設定
+
+導入 app 之前將資料庫改為暫存的 SQLite 檔案，API 測試以 TestClient 直接呼叫路由，不需啟動服務器。
+不執行啟動事件，背景工作不會啟動；需要時由測試直接呼叫各服務的處理函數。
+"""
+
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+# 將父目錄加入 Python 路徑以便導入模組
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+TEST_DIR = tempfile.mkdtemp(prefix="gps_tests_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TEST_DIR, 'gps_test.db')}"
+os.environ["GPS_JOURNAL_DIR"] = os.path.join(TEST_DIR, "journal")
+os.environ["GPS_ARCHIVE_DIR"] = os.path.join(TEST_DIR, "archive")
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from app.database import create_tables
+    from app.main import app
+
+    create_tables()
+    return TestClient(app)
+
+
+@pytest.fixture
+def user_id(client):
+    """每個測試使用新的用戶，避免測試之間的資料互相影響"""
+    from app.database import SessionLocal
+    from app.models.user import User
+
+    db = SessionLocal()
+    try:
+        db_user = User(email=f"gps-{uuid.uuid4().hex}@example.com", password="test")
+        db.add(db_user)
+        db.commit()
+        return db_user.id
+    finally:
+        db.close()
@@ -0,0 +1,1189 @@
+"""
+GPS API 測試
+
+以 TestClient 在暫存的 SQLite 資料庫上呼叫路由（設定見 conftest.py），不需啟動服務器。
+
+使用方式：
+    pytest test_gps_endpoints.py -v
+"""
+
+import asyncio
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+from sqlalchemy import inspect, text
+
+from app.database import SessionLocal, engine, ensure_gps_indexes
+from app.models.gps_route import GPSLocation
+from app.models.user import User
+from app.routes import gps_routes
+from app.services.commute_derivation import commute_derivation_service
+from app.services.gps_archive import gps_archive
+from app.services.gps_encoding import decode_polyline, decode_varints, encode_polyline, unpack_points
+from app.services.gps_filter import GPSIngestFilter, gps_ingest_filter
+from app.services.gps_ingest_buffer import GPSIngestBuffer
+from app.services.gps_journal import GPSJournal
+from app.services.gps_nearby import nearby_user_index
+from app.services.gps_retention import gps_retention_service
+from app.services.gps_rollup import gps_rollup_service
+from app.services.gps_similar_users import similar_user_index
+from app.services.gps_trips import trip_segmentation_service
+
+MISSING_USER_ID = 999999999
+
+
+def stored_locations(user_id):
+    """資料庫中用戶的定位點 (id, timestamp, latitude, longitude)，依時間排序"""
+    db = SessionLocal()
+    try:
+        return [
+            tuple(row) for row in db.query(
+                GPSLocation.id, GPSLocation.timestamp, GPSLocation.latitude, GPSLocation.longitude
+            ).filter(GPSLocation.user_id == user_id).order_by(GPSLocation.timestamp, GPSLocation.id)
+        ]
+    finally:
+        db.close()
+
+
+def track_points(start, count, step_s=60, lat=25.0330, lng=121.5654, step_deg=0.001):
+    """由 start 開始每 step_s 秒一個定位點、往北移動的批次上傳資料"""
+    return [
+        {"lat": lat + i * step_deg, "lng": lng, "ts": (start + timedelta(seconds=i * step_s)).isoformat()}
+        for i in range(count)
+    ]
+
+
+def upload(client, user_id, points):
+    response = client.post("/gps/locations/batch", params={"user_id": user_id}, json={"points": points})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+class TestBatchUpload:
+    """POST /gps/locations/batch"""
+
+    def test_valid_and_invalid_points(self, client, user_id):
+        now = datetime.utcnow().replace(microsecond=0)
+        points = track_points(now - timedelta(minutes=10), 2) + [
+            {"lat": 91.0, "lng": 121.5, "ts": now.isoformat()},
+            {"lat": 25.0, "lng": 121.5, "ts": "not-a-timestamp"},
+            {"lat": 25.0, "ts": now.isoformat()},
+        ]
+        data = upload(client, user_id, points)
+
+        assert data["total"] == 5
+        assert data["accepted"] == 2
+        assert data["rejected"] == 3
+        assert [error["index"] for error in data["errors"]] == [2, 3, 4]
+        assert data["errors"][0]["error"] == '緯度必須在 -90 到 90 之間'
+        assert data["errors"][2]["error"] == '缺少欄位 lng'
+
+        stored = stored_locations(user_id)
+        assert [row[0] for row in stored] == data["ids"]
+        assert [row[2] for row in stored] == [points[0]["lat"], points[1]["lat"]]
+
+    def test_ids_follow_input_order(self, client, user_id):
+        now = datetime.utcnow().replace(microsecond=0)
+        # 上傳順序與時間順序相反，ID 仍依上傳順序回傳
+        points = track_points(now - timedelta(minutes=10), 3)[::-1]
+        data = upload(client, user_id, points)
+
+        stored = {row[0]: row[2] for row in stored_locations(user_id)}
+        assert [stored[location_id] for location_id in data["ids"]] == [point["lat"] for point in points]
+
+    def test_empty_batch(self, client, user_id):
+        data = upload(client, user_id, [])
+        assert data["accepted"] == 0 and data["ids"] == []
+
+    def test_unknown_user(self, client):
+        response = client.post(
+            "/gps/locations/batch", params={"user_id": MISSING_USER_ID}, json={"points": track_points(datetime.utcnow(), 1)}
+        )
+        assert response.status_code == 404
+
+    def test_too_many_points(self, client, user_id, monkeypatch):
+        monkeypatch.setattr(gps_routes, "GPS_BATCH_MAX_POINTS", 2)
+        response = client.post(
+            "/gps/locations/batch", params={"user_id": user_id}, json={"points": track_points(datetime.utcnow(), 3)}
+        )
+        assert response.status_code == 413
+        assert stored_locations(user_id) == []
+
+
+class TestIngestBuffer:
+    """POST /gps/location 與寫入緩衝區的批次提交"""
+
+    def test_record_location(self, client, user_id):
+        timestamp = datetime.utcnow().replace(microsecond=0) - timedelta(minutes=1)
+        response = client.post(
+            "/gps/location", params={"user_id": user_id},
+            json={"lat": 25.0330, "lng": 121.5654, "ts": timestamp.isoformat()}
+        )
+        assert response.status_code == 200, response.text
+        data = response.json()
+
+        # 測試中緩衝區未啟動，直接寫入並回傳 ID
+        assert data["id"] is not None
+        assert stored_locations(user_id) == [(data["id"], timestamp, 25.0330, 121.5654)]
+
+    def test_record_location_errors(self, client, user_id):
+        timestamp = datetime.utcnow().isoformat()
+        response = client.post("/gps/location", params={"user_id": MISSING_USER_ID}, json={"lat": 25.0, "lng": 121.5, "ts": timestamp})
+        assert response.status_code == 404
+        response = client.post("/gps/location", params={"user_id": user_id}, json={"lat": 95.0, "lng": 121.5, "ts": timestamp})
+        assert response.status_code == 422
+        assert stored_locations(user_id) == []
+
+    def test_concurrent_submits_share_one_flush(self, client, user_id):
+        buffer = GPSIngestBuffer(journal=GPSJournal())
+        start = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+        rows = [
+            {"user_id": user_id, "latitude": 25.0 + i * 0.001, "longitude": 121.5, "timestamp": start + timedelta(seconds=i)}
+            for i in range(20)
+        ]
+
+        async def run():
+            await buffer.start()
+            try:
+                return await asyncio.gather(*(buffer.submit(row) for row in rows))
+            finally:
+                await buffer.stop()
+
+        ids = asyncio.run(run())
+
+        assert buffer.flush_count == 1
+        assert buffer.flushed_rows == 20
+        stored = {row[0]: row[2] for row in stored_locations(user_id)}
+        assert [stored[location_id] for location_id in ids] == [row["latitude"] for row in rows]
+
+    def test_ingest_stats(self, client):
+        response = client.get("/gps/ingest/stats")
+        assert response.status_code == 200
+        data = response.json()
+        assert {"queue_depth", "flush_count", "journal", "rollup", "trips"} <= data.keys()
+
+
+def journal_at(directory):
+    journal = GPSJournal()
+    journal.enabled = True
+    journal.directory = str(directory)
+    return journal
+
+
+def journal_rows(user_id, count, start):
+    return [
+        {"user_id": user_id, "latitude": 25.0 + i * 0.001, "longitude": 121.5, "timestamp": start + timedelta(seconds=i)}
+        for i in range(count)
+    ]
+
+
+class TestIngestJournal:
+    """寫入日誌：每個程序獨立目錄、重播與寫入失敗重試"""
+
+    def test_processes_use_separate_directories(self, tmp_path):
+        first, second = journal_at(tmp_path), journal_at(tmp_path)
+        assert first.claim() == 0
+        assert second.claim() == 1
+        assert journal_at(tmp_path).claim(0) is None
+
+        first.release_slot()
+        third = journal_at(tmp_path)
+        assert third.claim() == 0
+        second.release_slot()
+        third.release_slot()
+
+    def test_replay_skips_committed_offsets(self, client, user_id, tmp_path):
+        rows = journal_rows(user_id, 3, datetime.utcnow().replace(microsecond=0) - timedelta(hours=1))
+        journal = journal_at(tmp_path)
+        journal.open()
+        _, first = journal.append(rows)
+        journal._file.flush()
+        # 第一筆已寫入資料庫，尚未刪除分段前程序即結束
+        GPSIngestBuffer._write(rows[:1], [first], journal.journal_id, journal.watermark)
+        journal.release_slot()
+
+        buffer = GPSIngestBuffer(journal=journal_at(tmp_path))
+
+        async def run():
+            await buffer.start()
+            await buffer.stop()
+
+        asyncio.run(run())
+
+        assert [row[2] for row in stored_locations(user_id)] == [row["latitude"] for row in rows]
+        assert not any(name.startswith("segment-") for name in os.listdir(tmp_path / "worker-0"))
+
+    def test_orphan_directory_adopted(self, client, user_id, tmp_path):
+        rows = journal_rows(user_id, 2, datetime.utcnow().replace(microsecond=0) - timedelta(hours=1))
+        live, stopped = journal_at(tmp_path), journal_at(tmp_path)
+        live.open()
+        stopped.open()
+        assert stopped.journal_id == 1
+        stopped.append(rows)
+        stopped._file.flush()
+        stopped.release_slot()
+        live.release_slot()
+
+        buffer = GPSIngestBuffer(journal=journal_at(tmp_path))
+
+        async def run():
+            await buffer.start()
+            await buffer.stop()
+
+        asyncio.run(run())
+
+        assert buffer.journal.journal_id == 0
+        assert len(stored_locations(user_id)) == 2
+        assert not any(name.startswith("segment-") for name in os.listdir(tmp_path / "worker-1"))
+
+    def test_failed_flush_retried_while_running(self, client, user_id, tmp_path, monkeypatch):
+        rows = journal_rows(user_id, 3, datetime.utcnow().replace(microsecond=0) - timedelta(hours=1))
+        buffer = GPSIngestBuffer(journal=journal_at(tmp_path))
+        buffer.max_age = 0.01
+        buffer.retry_s = 0.05
+
+        write = GPSIngestBuffer._write
+        failures = []
+
+        def flaky_write(*args):
+            if not failures:
+                failures.append(args)
+                raise RuntimeError("database unavailable")
+            return write(*args)
+
+        monkeypatch.setattr(buffer, "_write", flaky_write)
+
+        async def run():
+            await buffer.start()
+            try:
+                assert await buffer.submit_many(rows) == [None, None, None]
+                for _ in range(100):
+                    if buffer.retried_rows:
+                        break
+                    await asyncio.sleep(0.02)
+                return len(stored_locations(user_id))
+            finally:
+                await buffer.stop()
+
+        # 仍在執行中即已重試寫入，不必等到下次啟動
+        assert asyncio.run(run()) == 3
+        assert buffer.failed_flushes == 1
+        assert buffer.retried_rows == 3
+        assert buffer.get_stats()["retry_pending_rows"] == 0
+
+
+class TestWebSocketStream:
+    """透過 /ws 連線串流上傳定位點"""
+
+    def test_stream_points(self, client, user_id):
+        now = datetime.utcnow().replace(microsecond=0)
+        points = track_points(now - timedelta(minutes=10), 3) + [{"lat": 91.0, "lng": 121.5, "ts": now.isoformat()}]
+        with client.websocket_connect("/ws") as websocket:
+            websocket.send_json({"type": "register_user", "userId": user_id})
+            assert websocket.receive_json()["type"] == "user_registered"
+
+            websocket.send_json({"type": "gps", "batchId": "b1", "points": points})
+            ack = websocket.receive_json()
+
+        assert ack["type"] == "gps_ack"
+        assert ack["batchId"] == "b1"
+        assert ack["accepted"] == 3
+        assert [error["index"] for error in ack["errors"]] == [3]
+        assert len(stored_locations(user_id)) == 3
+
+    def test_register_required(self, client):
+        with client.websocket_connect("/ws") as websocket:
+            websocket.send_json({"type": "gps", "points": []})
+            assert websocket.receive_json()["type"] == "error"
+
+    def test_too_many_points(self, client, user_id, monkeypatch):
+        monkeypatch.setattr("app.routes.chat_routes.GPS_BATCH_MAX_POINTS", 2)
+        now = datetime.utcnow().replace(microsecond=0)
+        with client.websocket_connect("/ws") as websocket:
+            websocket.send_json({"type": "register_user", "userId": user_id})
+            websocket.receive_json()
+            websocket.send_json({"type": "gps", "batchId": "b2", "points": track_points(now - timedelta(minutes=10), 3)})
+            response = websocket.receive_json()
+
+        assert response["type"] == "error"
+        assert response["batchId"] == "b2"
+        assert stored_locations(user_id) == []
+
+
+class TestColumnarUpload:
+    """POST /gps/locations/batch/columnar 與定位時間範圍"""
+
+    def post(self, client, user_id, lat, lng, ts):
+        return client.post(
+            "/gps/locations/batch/columnar", params={"user_id": user_id}, json={"lat": lat, "lng": lng, "ts": ts}
+        )
+
+    def test_valid_and_invalid_points(self, client, user_id):
+        now = time.time()
+        response = self.post(
+            client, user_id,
+            [25.0, 25.001, 91.0, 25.002, 25.003],
+            [121.5] * 5,
+            [now - 300, now - 240, now - 200, 0.0, now + 3600]
+        )
+        assert response.status_code == 200, response.text
+        data = response.json()
+        assert (data["total"], data["accepted"], data["rejected"]) == (5, 2, 3)
+        assert [error["index"] for error in data["errors"]] == [2, 3, 4]
+        assert data["errors"][1]["error"].startswith("時間戳記不可早於")
+
+        stored = stored_locations(user_id)
+        assert [row[0] for row in stored] == data["ids"]
+        assert abs((stored[0][1] - datetime.utcfromtimestamp(now - 300)).total_seconds()) < 0.001
+
+    def test_length_mismatch(self, client, user_id):
+        response = self.post(client, user_id, [25.0, 25.1], [121.5], [time.time()])
+        assert response.status_code == 400
+
+    def test_unknown_user_and_too_many(self, client, user_id, monkeypatch):
+        now = time.time()
+        assert self.post(client, MISSING_USER_ID, [25.0], [121.5], [now]).status_code == 404
+        monkeypatch.setattr(gps_routes, "GPS_BATCH_MAX_POINTS", 1)
+        assert self.post(client, user_id, [25.0, 25.1], [121.5] * 2, [now - 1, now]).status_code == 413
+
+    def test_minimum_timestamp_on_json_paths(self, client, user_id):
+        response = client.post(
+            "/gps/location", params={"user_id": user_id}, json={"lat": 25.0, "lng": 121.5, "ts": "1970-01-01T00:00:00Z"}
+        )
+        assert response.status_code == 422
+        response = client.post(
+            "/gps/location", params={"user_id": user_id}, json={"lat": 25.0, "lng": 121.5, "ts": "not-a-timestamp"}
+        )
+        assert response.status_code == 422
+
+        data = upload(client, user_id, [{"lat": 25.0, "lng": 121.5, "ts": "1999-12-31T23:59:59Z"}])
+        assert data["accepted"] == 0
+        assert data["errors"][0]["error"].startswith("時間戳記不可早於")
+        assert stored_locations(user_id) == []
+
+
+class TestIngestFilter:
+    """寫入過濾器與 PUT /gps/filter/{user_id}"""
+
+    def test_stationary_points_dropped(self, client, user_id, monkeypatch):
+        monkeypatch.setattr(gps_ingest_filter, "enabled", True)
+        start = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+        # 第二點未移動且未達保留間隔，略過；第三點移動約 111 公尺
+        points = track_points(start, 3, step_s=30, step_deg=0.001)
+        points[1]["lat"] = points[0]["lat"]
+        data = upload(client, user_id, points)
+        assert (data["accepted"], data["dropped"], data["flagged"]) == (2, 1, 0)
+
+    def test_failed_write_does_not_advance_state(self, client, user_id, monkeypatch):
+        monkeypatch.setattr(gps_ingest_filter, "enabled", True)
+        points = track_points(datetime.utcnow().replace(microsecond=0) - timedelta(hours=1), 2, step_s=30)
+
+        def failing_insert(db, rows):
+            raise RuntimeError("database unavailable")
+
+        with monkeypatch.context() as patch:
+            patch.setattr(gps_routes, "insert_gps_rows", failing_insert)
+            response = client.post("/gps/locations/batch", params={"user_id": user_id}, json={"points": points})
+        assert response.status_code == 500
+
+        # 重送相同的定位點不應被視為重複而略過
+        data = upload(client, user_id, points)
+        assert (data["accepted"], data["dropped"]) == (2, 0)
+
+    def test_thresholds_require_admin_token(self, client, user_id, monkeypatch):
+        body = {"min_distance_m": 50}
+        monkeypatch.setattr(gps_routes, "GPS_ADMIN_TOKEN", "")
+        assert client.put(f"/gps/filter/{user_id}", json=body, headers={"X-GPS-Admin-Token": "x"}).status_code == 403
+
+        monkeypatch.setattr(gps_routes, "GPS_ADMIN_TOKEN", "secret")
+        assert client.put(f"/gps/filter/{user_id}", json=body).status_code == 403
+        assert client.put(f"/gps/filter/{user_id}", json=body, headers={"X-GPS-Admin-Token": "wrong"}).status_code == 403
+        response = client.put(
+            f"/gps/filter/{MISSING_USER_ID}", json=body, headers={"X-GPS-Admin-Token": "secret"}
+        )
+        assert response.status_code == 404
+
+    def test_thresholds_persisted(self, client, user_id, monkeypatch):
+        monkeypatch.setattr(gps_routes, "GPS_ADMIN_TOKEN", "secret")
+        headers = {"X-GPS-Admin-Token": "secret"}
+        response = client.put(f"/gps/filter/{user_id}", json={"min_distance_m": 50}, headers=headers)
+        assert response.status_code == 200, response.text
+        assert response.json()["thresholds"]["min_distance_m"] == 50
+
+        # 其他程序由資料庫載入相同設定
+        other = GPSIngestFilter()
+        other.load_settings()
+        assert other.get_thresholds(user_id)["min_distance_m"] == 50
+        assert other.get_thresholds(user_id)["max_speed_mps"] == other.default_thresholds["max_speed_mps"]
+
+        # 全部欄位為空時恢復預設
+        client.put(f"/gps/filter/{user_id}", json={}, headers=headers)
+        other.load_settings()
+        assert user_id not in other.user_thresholds
+
+
+class TestSimplifiedTrack:
+    """定位歷史的 simplify 參數"""
+
+    def test_history_simplified(self, client, user_id):
+        # 11 個點在同一條經線上，簡化後只留下起點與終點（新到舊）
+        data = upload(client, user_id, track_points(datetime(2024, 3, 1, 8), 11))
+        response = client.get(f"/gps/locations/{user_id}", params={"simplify": 5})
+        assert response.status_code == 200
+        body = response.json()
+        assert body["original_locations"] == 11
+        assert body["simplify_tolerance_m"] == 5
+        assert [location["id"] for location in body["locations"]] == [data["ids"][-1], data["ids"][0]]
+
+    def test_date_simplified(self, client, user_id):
+        points = track_points(datetime(2024, 3, 1, 8), 6)
+        # 第 4 點偏離直線約 30 公尺，容許誤差 25 公尺時必須保留（當日查詢為舊到新）
+        points[3]["lng"] += 0.0003
+        data = upload(client, user_id, points)
+        for _ in range(2):  # 第二次由快取取得
+            response = client.get(f"/gps/locations/{user_id}/date/2024-03-01", params={"simplify": 25})
+            assert response.status_code == 200
+            body = response.json()
+            assert body["original_locations"] == 6
+            assert [location["id"] for location in body["locations"]] == [data["ids"][i] for i in (0, 3, 5)]
+
+    def test_invalid_tolerance(self, client, user_id):
+        assert client.get(f"/gps/locations/{user_id}", params={"simplify": 0}).status_code == 400
+        assert client.get(f"/gps/locations/{user_id}/date/2024-03-01", params={"simplify": -1}).status_code == 400
+
+
+class TestCompactFormats:
+    """定位歷史的 polyline 與 binary 格式"""
+
+    def test_polyline(self, client, user_id):
+        points = track_points(datetime(2024, 3, 1, 8), 3, step_s=30)
+        upload(client, user_id, points)
+        response = client.get(f"/gps/locations/{user_id}/date/2024-03-01", params={"format": "polyline"})
+        assert response.status_code == 200
+        body = response.json()
+        assert body["format"] == "polyline"
+        assert body["total_locations"] == 3
+        assert body["start_ts"] == int(datetime(2024, 3, 1, 8, tzinfo=timezone.utc).timestamp())
+        assert decode_polyline(body["polyline"]) == [(round(p["lat"], 5), round(p["lng"], 5)) for p in points]
+        assert decode_varints(body["ts_deltas"]) == [0, 30, 30]
+
+    def test_binary(self, client, user_id):
+        points = track_points(datetime(2024, 3, 1, 8), 4)
+        upload(client, user_id, points)
+        # 歷史查詢為新到舊；取滿一頁時由標頭帶出下一頁游標
+        response = client.get(f"/gps/locations/{user_id}", params={"format": "binary", "limit": 4})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/octet-stream"
+        assert response.headers["x-total-locations"] == "4"
+        assert response.headers["x-next-cursor"]
+
+        lat, lng, epoch = unpack_points(response.content)
+        np.testing.assert_allclose(lat, [p["lat"] for p in reversed(points)], atol=1e-6)
+        np.testing.assert_allclose(lng, [p["lng"] for p in points], atol=1e-6)
+        start = int(datetime(2024, 3, 1, 8, tzinfo=timezone.utc).timestamp())
+        assert epoch.tolist() == [start + 180, start + 120, start + 60, start]
+
+    def test_unknown_format(self, client, user_id):
+        assert client.get(f"/gps/locations/{user_id}", params={"format": "xml"}).status_code == 400
+
+
+class TestExport:
+    """GET /gps/locations/{user_id}/export"""
+
+    def test_ndjson(self, client, user_id, monkeypatch):
+        # 小批次讀取，確認跨批次輸出完整
+        monkeypatch.setattr(gps_routes, "GPS_EXPORT_CHUNK_SIZE", 2)
+        data = upload(client, user_id, track_points(datetime(2024, 3, 1, 8), 5))
+        response = client.get(f"/gps/locations/{user_id}/export")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        assert f"gps_locations_{user_id}.ndjson" in response.headers["content-disposition"]
+
+        records = [json.loads(line) for line in response.text.splitlines()]
+        assert [record["id"] for record in records] == data["ids"]
+        assert records[0]["timestamp"] == "2024-03-01T08:00:00"
+
+    def test_csv_date_range(self, client, user_id):
+        upload(client, user_id, track_points(datetime(2024, 3, 1, 23, 58), 4))
+        response = client.get(
+            f"/gps/locations/{user_id}/export",
+            params={"format": "csv", "start_date": "2024-03-02", "end_date": "2024-03-02"}
+        )
+        assert response.status_code == 200
+        lines = response.text.splitlines()
+        assert lines[0] == "id,timestamp,latitude,longitude"
+        assert [line.split(",")[1] for line in lines[1:]] == ["2024-03-02T00:00:00", "2024-03-02T00:01:00"]
+
+    def test_errors(self, client, user_id):
+        assert client.get(f"/gps/locations/{user_id}/export", params={"format": "xml"}).status_code == 400
+        assert client.get(f"/gps/locations/{user_id}/export", params={"start_date": "03/01/2024"}).status_code == 400
+        assert client.get(f"/gps/locations/{MISSING_USER_ID}/export").status_code == 404
+
+
+class TestCursorPagination:
+    """定位歷史的 keyset 分頁"""
+
+    def test_pages_cover_history(self, client, user_id):
+        start = datetime(2024, 3, 1, 8)
+        points = track_points(start, 5)
+        # 兩點同一時間，分頁仍不可重複或遺漏
+        points[3]["ts"] = points[2]["ts"]
+        data = upload(client, user_id, points)
+
+        seen = []
+        cursor = None
+        pages = 0
+        while True:
+            params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+            response = client.get(f"/gps/locations/{user_id}", params=params)
+            assert response.status_code == 200
+            body = response.json()
+            seen.extend(location["id"] for location in body["locations"])
+            pages += 1
+            cursor = body["next_cursor"]
+            if cursor is None:
+                break
+
+        assert pages == 3
+        assert sorted(seen) == sorted(data["ids"])
+        assert len(seen) == len(set(seen))
+        assert seen[0] == data["ids"][4]  # 新到舊
+
+    def test_invalid_cursor_and_limit(self, client, user_id):
+        assert client.get(f"/gps/locations/{user_id}", params={"cursor": "not-a-cursor"}).status_code == 400
+        assert client.get(f"/gps/locations/{user_id}", params={"limit": 0}).status_code == 400
+
+
+class TestIndexes:
+    """gps_locations 的複合索引"""
+
+    def test_missing_indexes_recreated(self, client):
+        with engine.connect() as conn:
+            conn.execute(text("DROP INDEX ix_gps_locations_user_timestamp"))
+        assert "ix_gps_locations_user_timestamp" not in {index["name"] for index in inspect(engine).get_indexes("gps_locations")}
+
+        # 啟動時對既有資料表補建索引
+        ensure_gps_indexes()
+        indexes = {index["name"]: index["column_names"] for index in inspect(engine).get_indexes("gps_locations")}
+        assert indexes["ix_gps_locations_user_timestamp"] == ["user_id", "timestamp"]
+        assert indexes["ix_gps_locations_geohash_timestamp"] == ["geohash", "timestamp"]
+
+
+class TestDeleteJobs:
+    """DELETE /gps/locations/{user_id} 與 GET /gps/delete-jobs/{job_id}"""
+
+    def test_delete_range(self, client, user_id):
+        upload(client, user_id, track_points(datetime(2024, 3, 1, 23, 58), 4))
+        response = client.delete(f"/gps/locations/{user_id}", params={"start_date": "2024-03-02", "end_date": "2024-03-02"})
+        assert response.status_code == 202
+        job = response.json()
+        assert job["status"] == "pending"
+
+        # 背景工作未啟動，直接執行待處理的工作
+        gps_retention_service.run_pending_jobs()
+
+        data = client.get(f"/gps/delete-jobs/{job['job_id']}").json()
+        assert data["status"] == "completed"
+        assert data["deleted_count"] == 2
+        assert data["finished_at"] is not None
+        assert [row[1] for row in stored_locations(user_id)] == [datetime(2024, 3, 1, 23, 58), datetime(2024, 3, 1, 23, 59)]
+
+    def test_interrupted_job_resumed(self, client, user_id):
+        upload(client, user_id, track_points(datetime(2024, 3, 1, 8), 3))
+        job = gps_retention_service.submit_delete(user_id)
+
+        # 模擬執行中的程序已刪除 5 筆後停止：心跳仍新時不會被接手
+        gps_retention_service._update_job(job["job_id"], status="running", deleted_count=5, heartbeat_at=datetime.utcnow())
+        gps_retention_service.run_pending_jobs()
+        assert gps_retention_service.get_job(job["job_id"])["status"] == "running"
+
+        stale = datetime.utcnow() - timedelta(seconds=gps_retention_service.job_stale_s + 1)
+        gps_retention_service._update_job(job["job_id"], heartbeat_at=stale)
+        gps_retention_service.run_pending_jobs()
+        data = gps_retention_service.get_job(job["job_id"])
+        assert data["status"] == "completed"
+        assert data["deleted_count"] == 8
+        assert stored_locations(user_id) == []
+
+    def test_errors(self, client, user_id):
+        assert client.get("/gps/delete-jobs/missing").status_code == 404
+        assert client.delete(f"/gps/locations/{MISSING_USER_ID}").status_code == 404
+        assert client.delete(f"/gps/locations/{user_id}", params={"start_date": "2024/03/01"}).status_code == 400
+
+
+class TestArchive:
+    """歸檔資料與資料庫資料的合併查詢"""
+
+    def archive(self, user_id, monkeypatch, tmp_path):
+        monkeypatch.setattr(gps_archive, "enabled", True)
+        monkeypatch.setattr(gps_archive, "directory", str(tmp_path))
+        # 只歸檔此測試的用戶，其他測試的資料留在資料庫
+        return gps_archive._archive_user(user_id, gps_archive.hot_boundary())
+
+    def test_history_merges_archive(self, client, user_id, monkeypatch, tmp_path):
+        old = upload(client, user_id, track_points(datetime(2024, 3, 1, 8), 3))
+        recent = upload(client, user_id, track_points(datetime.utcnow().replace(microsecond=0) - timedelta(hours=1), 2))
+        assert self.archive(user_id, monkeypatch, tmp_path) == 3
+        assert len(stored_locations(user_id)) == 2
+
+        # 新到舊分頁跨越資料庫與歸檔
+        first = client.get(f"/gps/locations/{user_id}", params={"limit": 3}).json()
+        second = client.get(f"/gps/locations/{user_id}", params={"limit": 3, "cursor": first["next_cursor"]}).json()
+        ids = [location["id"] for location in first["locations"] + second["locations"]]
+        assert ids == (old["ids"] + recent["ids"])[::-1]
+
+        response = client.get(f"/gps/locations/{user_id}/date/2024-03-01")
+        assert [location["id"] for location in response.json()["locations"]] == old["ids"]
+
+        lines = client.get(f"/gps/locations/{user_id}/export", params={"format": "csv"}).text.splitlines()[1:]
+        assert [int(line.split(",")[0]) for line in lines] == old["ids"] + recent["ids"]
+
+    def test_delete_includes_archive(self, client, user_id, monkeypatch, tmp_path):
+        upload(client, user_id, track_points(datetime(2024, 3, 1, 8), 3))
+        upload(client, user_id, track_points(datetime.utcnow().replace(microsecond=0) - timedelta(hours=1), 2))
+        self.archive(user_id, monkeypatch, tmp_path)
+
+        job = client.delete(f"/gps/locations/{user_id}").json()
+        gps_retention_service.run_pending_jobs()
+        assert gps_retention_service.get_job(job["job_id"])["deleted_count"] == 5
+        assert client.get(f"/gps/locations/{user_id}").json()["locations"] == []
+
+
+class TestRollupSummary:
+    """GET /gps/locations/{user_id}/summary"""
+
+    def summary(self, client, user_id, **params):
+        response = client.get(
+            f"/gps/locations/{user_id}/summary", params={"start_date": "2024-03-01", "end_date": "2024-03-02", **params}
+        )
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    def test_daily_and_hourly(self, client, user_id):
+        upload(client, user_id, track_points(datetime(2024, 3, 1, 8, 59), 3))
+        upload(client, user_id, track_points(datetime(2024, 3, 2, 10), 2))
+        # 背景工作未啟動，直接處理待更新的彙總
+        gps_rollup_service.process_pending()
+
+        daily = self.summary(client, user_id)
+        assert [(b["day"], b["point_count"]) for b in daily["buckets"]] == [("2024-03-01", 3), ("2024-03-02", 2)]
+        assert daily["totals"]["point_count"] == 5
+        assert daily["totals"]["active_days"] == 2
+        assert daily["buckets"][0]["distance_m"] == pytest.approx(222.6, abs=1)
+
+        hourly = self.summary(client, user_id, granularity="hour")
+        assert [(b["hour"], b["point_count"]) for b in hourly["buckets"]] == [
+            ("2024-03-01T08:00:00", 1), ("2024-03-01T09:00:00", 2), ("2024-03-02T10:00:00", 2)
+        ]
+        # 跨小時的距離算入後一個小時，加總與日彙總相同
+        assert sum(b["distance_m"] for b in hourly["buckets"]) == pytest.approx(daily["totals"]["distance_m"], abs=0.5)
+
+    def test_rebuilt_after_delete(self, client, user_id):
+        upload(client, user_id, track_points(datetime(2024, 3, 1, 8), 3))
+        upload(client, user_id, track_points(datetime(2024, 3, 2, 8), 3))
+        gps_rollup_service.process_pending()
+
+        client.delete(f"/gps/locations/{user_id}", params={"start_date": "2024-03-02", "end_date": "2024-03-02"})
+        gps_retention_service.run_pending_jobs()
+        assert [b["day"] for b in self.summary(client, user_id)["buckets"]] == ["2024-03-01"]
+
+    def test_errors(self, client, user_id):
+        params = {"start_date": "2024-03-02", "end_date": "2024-03-01"}
+        assert client.get(f"/gps/locations/{user_id}/summary", params=params).status_code == 400
+        params = {"granularity": "hour", "start_date": "2024-01-01", "end_date": "2024-03-01"}
+        assert client.get(f"/gps/locations/{user_id}/summary", params=params).status_code == 400
+        assert client.get(f"/gps/locations/{user_id}/summary", params={"granularity": "week"}).status_code == 400
+
+
+class TestLatestLocation:
+    """GET /gps/latest/{user_id} 與 POST /gps/latest"""
+
+    def test_latest_follows_writes(self, client, user_id):
+        assert client.get(f"/gps/latest/{user_id}").status_code == 404
+
+        data = upload(client, user_id, track_points(datetime(2024, 3, 1, 8), 3))
+        latest = client.get(f"/gps/latest/{user_id}").json()
+        assert latest["id"] == data["ids"][-1]
+        assert latest["timestamp"] == "2024-03-01T08:02:00"
+
+        # 晚到的舊定位點不取代最新定位
+        upload(client, user_id, track_points(datetime(2024, 2, 1, 8), 1))
+        assert client.get(f"/gps/latest/{user_id}").json()["id"] == data["ids"][-1]
+
+        # 刪除最新的定位後改由資料庫重新載入
+        client.delete(f"/gps/locations/{user_id}", params={"start_date": "2024-03-01", "end_date": "2024-03-01"})
+        gps_retention_service.run_pending_jobs()
+        assert client.get(f"/gps/latest/{user_id}").json()["timestamp"] == "2024-02-01T08:00:00"
+
+    def test_batch_lookup(self, client, user_id, monkeypatch):
+        data = upload(client, user_id, track_points(datetime(2024, 3, 1, 8), 2))
+        response = client.post("/gps/latest", json={"user_ids": [user_id, MISSING_USER_ID]})
+        assert response.status_code == 200
+        body = response.json()
+        assert body["found"] == 1
+        assert body["locations"][str(user_id)]["id"] == data["ids"][-1]
+        assert body["locations"][str(MISSING_USER_ID)] is None
+
+        monkeypatch.setattr(gps_routes, "GPS_LATEST_MAX_IDS", 1)
+        assert client.post("/gps/latest", json={"user_ids": [1, 2]}).status_code == 413
+
+
+def make_user():
+    db = SessionLocal()
+    try:
+        db_user = User(email=f"gps-{uuid.uuid4().hex}@example.com", password="test")
+        db.add(db_user)
+        db.commit()
+        return db_user.id
+    finally:
+        db.close()
+
+
+class TestNearby:
+    """GET /gps/nearby"""
+
+    def place_online(self, client, user_id, lat, lng, request):
+        now = datetime.utcnow().replace(microsecond=0)
+        upload(client, user_id, [{"lat": lat, "lng": lng, "ts": (now - timedelta(minutes=1)).isoformat()}])
+        nearby_user_index.set_online(user_id, True)
+        request.addfinalizer(lambda: nearby_user_index.set_online(user_id, False))
+
+    def test_sorted_by_distance(self, client, user_id, request):
+        other = make_user()
+        self.place_online(client, user_id, 25.0330, 121.5654, request)
+        self.place_online(client, other, 25.0350, 121.5654, request)
+
+        response = client.get("/gps/nearby", params={"lat": 25.0340, "lng": 121.5654, "radius": 500})
+        assert response.status_code == 200
+        users = [u for u in response.json()["users"] if u["user_id"] in (user_id, other)]
+        assert [u["user_id"] for u in users] == [user_id, other]
+        assert users[0]["distance_m"] == pytest.approx(111.3, abs=1)
+
+        # 排除查詢者本人
+        params = {"lat": 25.0340, "lng": 121.5654, "radius": 500, "user_id": user_id}
+        assert user_id not in [u["user_id"] for u in client.get("/gps/nearby", params=params).json()["users"]]
+
+    @pytest.mark.parametrize("max_scan_cells", [1024, 0])
+    def test_across_antimeridian(self, client, user_id, request, monkeypatch, max_scan_cells):
+        # 0 格時改用向量化全表篩選
+        monkeypatch.setattr("app.services.gps_nearby.MAX_GRID_SCAN_CELLS", max_scan_cells)
+        self.place_online(client, user_id, -17.0, 179.999, request)
+
+        response = client.get("/gps/nearby", params={"lat": -17.0, "lng": -179.999, "radius": 1000})
+        users = [u for u in response.json()["users"] if u["user_id"] == user_id]
+        assert len(users) == 1
+        assert users[0]["distance_m"] == pytest.approx(212.9, abs=1)
+
+    def test_invalid_parameters(self, client):
+        assert client.get("/gps/nearby", params={"lat": 95, "lng": 0}).status_code == 400
+        assert client.get("/gps/nearby", params={"lat": 0, "lng": 0, "radius": 0}).status_code == 400
+        assert client.get("/gps/nearby", params={"lat": 0, "lng": 0, "limit": 0}).status_code == 400
+
+
+class TestAreaQuery:
+    """GET /gps/area"""
+
+    def test_box_and_time_window(self, client, user_id):
+        other = make_user()
+        start = datetime(2023, 5, 10, 12)
+        # 巴黎附近，避開其他測試的資料
+        inside = upload(client, user_id, track_points(start, 3, lat=48.8500, lng=2.3500))
+        upload(client, other, track_points(start, 2, lat=48.9500, lng=2.3500))  # 範圍框以北
+        upload(client, other, track_points(start - timedelta(hours=2), 1, lat=48.8500, lng=2.3500))  # 時間窗以前
+
+        params = {
+            "min_lat": 48.84, "min_lng": 2.34, "max_lat": 48.86, "max_lng": 2.36,
+            "start": start.isoformat(), "end": (start + timedelta(hours=1)).isoformat()
+        }
+        response = client.get("/gps/area", params=params)
+        assert response.status_code == 200, response.text
+        body = response.json()
+        assert sorted(location["id"] for location in body["locations"]) == inside["ids"]
+        assert body["truncated"] is False
+        assert body["cell_ranges"] <= gps_routes.GPS_AREA_MAX_CELLS
+
+        response = client.get("/gps/area", params={**params, "limit": 2})
+        assert response.json()["count"] == 2
+        assert response.json()["truncated"] is True
+
+    def test_invalid_parameters(self, client):
+        params = {"min_lat": 48.84, "min_lng": 2.34, "max_lat": 48.86, "max_lng": 2.36,
+                  "start": "2023-05-10T12:00:00", "end": "2023-05-10T13:00:00"}
+        assert client.get("/gps/area", params={**params, "min_lat": 49}).status_code == 400
+        assert client.get("/gps/area", params={**params, "min_lng": 170, "max_lng": -170}).status_code == 400
+        assert client.get("/gps/area", params={**params, "start": "yesterday"}).status_code == 400
+        assert client.get("/gps/area", params={**params, "end": "2023-05-10T11:00:00"}).status_code == 400
+        assert client.get("/gps/area", params={**params, "end": "2024-05-10T11:00:00"}).status_code == 400
+
+
+class TestTripStats:
+    """GET /gps/locations/{user_id}/date/{date}/stats"""
+
+    def test_stats_and_cache(self, client, user_id):
+        start = datetime(2024, 3, 1, 8)
+        # 3 段各約 111 公尺、60 秒的移動，停留 60 秒，再中斷 20 分鐘
+        points = track_points(start, 4)
+        points.append({**points[-1], "ts": (start + timedelta(minutes=4)).isoformat()})
+        points.append({**points[-1], "ts": (start + timedelta(minutes=24)).isoformat()})
+        upload(client, user_id, points)
+
+        url = f"/gps/locations/{user_id}/date/2024-03-01/stats"
+        stats = client.get(url).json()
+        assert stats["cached"] is False
+        assert stats["point_count"] == 6
+        assert stats["duration_s"] == 1440
+        assert stats["distance_m"] == pytest.approx(333.9, abs=1)
+        assert (stats["moving_time_s"], stats["stopped_time_s"], stats["gap_time_s"]) == (180, 60, 1200)
+        assert stats["max_speed_mps"] == pytest.approx(1.85, abs=0.01)
+
+        # 過去日期的結果會快取，寫入當日的定位點後失效
+        assert client.get(url).json()["cached"] is True
+        upload(client, user_id, track_points(start + timedelta(hours=1), 1))
+        stats = client.get(url).json()
+        assert (stats["cached"], stats["point_count"]) == (False, 7)
+
+    def test_empty_day_and_errors(self, client, user_id):
+        stats = client.get(f"/gps/locations/{user_id}/date/2024-03-01/stats").json()
+        assert stats["point_count"] == 0
+        assert client.get(f"/gps/locations/{user_id}/date/2024-3-1x/stats").status_code == 400
+        assert client.get(f"/gps/locations/{MISSING_USER_ID}/date/2024-03-01/stats").status_code == 404
+
+
+def staged_track(start, *parts):
+    """依序串接 (分鐘數, 起點緯度, 終點緯度)，每分鐘一個定位點的批次上傳資料"""
+    lat = np.concatenate([np.linspace(first, last, minutes) for minutes, first, last in parts])
+    return [
+        {"lat": float(value), "lng": 121.5, "ts": (start + timedelta(minutes=i)).isoformat()}
+        for i, value in enumerate(lat)
+    ]
+
+
+class TestTripsAndStays:
+    """GET /gps/locations/{user_id}/trips 與 /stays"""
+
+    params = {"start_date": "2024-03-01", "end_date": "2024-03-01"}
+
+    def test_served_from_background_segmentation(self, client, user_id):
+        start = datetime(2024, 3, 1, 8)
+        upload(client, user_id, staged_track(start, (20, 25.0, 25.0), (10, 25.005, 25.045), (20, 25.05, 25.05), (5, 25.06, 25.1)))
+
+        # 請求中不分段：背景工作處理前只回傳已分段的結果
+        body = client.get(f"/gps/locations/{user_id}/trips", params=self.params).json()
+        assert (body["count"], body["segmentation_pending"]) == (0, True)
+
+        trip_segmentation_service.process_user(user_id)
+
+        body = client.get(f"/gps/locations/{user_id}/trips", params=self.params).json()
+        assert body["segmentation_pending"] is False
+        assert len(body["trips"]) == 1
+        trip = body["trips"][0]
+        assert (trip["start_time"], trip["end_time"]) == ("2024-03-01T08:19:00", "2024-03-01T08:30:00")
+
+        stays = client.get(f"/gps/locations/{user_id}/stays", params=self.params).json()["stays"]
+        # 新到舊
+        assert [(s["arrival_time"], s["departure_time"]) for s in stays] == [
+            ("2024-03-01T08:30:00", "2024-03-01T08:49:00"), ("2024-03-01T08:00:00", "2024-03-01T08:19:00")
+        ]
+        assert {trip["origin_stay_id"], trip["destination_stay_id"]} == {s["id"] for s in stays}
+
+    def test_errors(self, client, user_id):
+        assert client.get(f"/gps/locations/{user_id}/trips", params={"limit": 0}).status_code == 400
+        assert client.get(f"/gps/locations/{user_id}/stays", params={"start_date": "03/01"}).status_code == 400
+        assert client.get(f"/gps/locations/{MISSING_USER_ID}/trips").status_code == 404
+
+
+def commute_days(client, user_id, departures):
+    """每個出發時間上傳一天的通勤軌跡（停留 20 分鐘後移動到另一個地點），並完成行程分段"""
+    for departure in departures:
+        # 停留點的最後一個定位點即行程出發時間
+        upload(client, user_id, staged_track(departure - timedelta(minutes=19), (20, 25.0, 25.0), (10, 25.005, 25.045), (20, 25.05, 25.05), (5, 25.06, 25.1)))
+    trip_segmentation_service.process_user(user_id)
+
+
+class TestCommuteDerivation:
+    """由行程偵測通勤路線，GET /commute-routes 查詢結果"""
+
+    def test_departure_across_midnight(self, client, user_id):
+        midnight = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=10)
+        commute_days(client, user_id, [
+            midnight - timedelta(minutes=4), midnight + timedelta(days=2, minutes=-2), midnight + timedelta(days=4, minutes=4)
+        ])
+
+        assert commute_derivation_service.derive_user(user_id)[0] == 1
+
+        routes = client.get("/commute-routes", params={"user_id": user_id}).json()["routes"]
+        assert len(routes) == 1
+        route = routes[0]
+        assert (route["source"], route["trip_count"], route["is_active"]) == ("derived", 3, "active")
+        # 23:56、23:58 與 00:04 的典型出發時間是 23:59，而不是中位數的 23:56 或算術平均的 15:59
+        assert route["departure_minute"] == 1439
+        assert route["start_latitude"] == pytest.approx(25.0, abs=1e-3)
+        assert route["end_latitude"] == pytest.approx(25.05, abs=1e-3)
+
+    def test_too_few_days(self, client, user_id):
+        midnight = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=10)
+        commute_days(client, user_id, [midnight + timedelta(hours=8), midnight + timedelta(days=1, hours=8)])
+
+        assert commute_derivation_service.derive_user(user_id) == (0, 0, 0, [])
+        assert client.get("/commute-routes", params={"user_id": user_id}).json()["count"] == 0
+
+
+def route_points(start, count, lat=24.98, lng=121.3, step_deg=0.002):
+    """通勤路線定位點，每分鐘一個點往東北移動"""
+    return [
+        {"lat": lat + i * step_deg, "lng": lng + i * step_deg, "ts": (start + timedelta(minutes=i)).isoformat()}
+        for i in range(count)
+    ]
+
+
+def create_route(client, user_id, **body):
+    response = client.post("/commute-routes", params={"user_id": user_id}, json=body)
+    assert response.status_code == 200, response.text
+    return response.json()["route"]
+
+
+class TestCommuteRouteCRUD:
+    """POST/GET/PUT/DELETE /commute-routes"""
+
+    def test_create_from_points(self, client, user_id):
+        route = create_route(client, user_id, route_name="上班", points=route_points(datetime(2024, 4, 1, 8), 11))
+        assert (route["start_latitude"], route["start_longitude"]) == pytest.approx((24.98, 121.3))
+        assert (route["end_latitude"], route["end_longitude"]) == pytest.approx((25.0, 121.32))
+        assert (route["point_count"], route["travel_time"], route["source"]) == (11, 10, "manual")
+        assert route["distance"] == pytest.approx(2.99, abs=0.05)
+
+    def test_explicit_endpoints_kept(self, client, user_id):
+        route = create_route(client, user_id, start_latitude=24.9, start_longitude=121.2, points=route_points(datetime(2024, 4, 1, 8), 3))
+        assert (route["start_latitude"], route["start_longitude"]) == (24.9, 121.2)
+        assert route["end_latitude"] == pytest.approx(24.984)
+
+    def test_create_errors(self, client, user_id):
+        assert client.post("/commute-routes", params={"user_id": user_id}, json={"points": []}).status_code == 400
+        assert client.post("/commute-routes", params={"user_id": user_id}, json={"start_latitude": 25.0}).status_code == 400
+        points = route_points(datetime(2024, 4, 1, 8), 3)
+        points[1]["ts"] = None
+        assert client.post("/commute-routes", params={"user_id": user_id}, json={"points": points}).status_code == 400
+        assert client.post("/commute-routes", params={"user_id": MISSING_USER_ID}, json={"points": route_points(datetime(2024, 4, 1, 8), 3)}).status_code == 404
+
+    def test_point_formats(self, client, user_id):
+        points = route_points(datetime(2024, 4, 1, 8), 5)
+        route_id = create_route(client, user_id, points=points)["id"]
+
+        body = client.get(f"/commute-routes/{route_id}").json()
+        expected = [(p["lat"], p["lng"]) for p in points]
+        np.testing.assert_allclose([(p["latitude"], p["longitude"]) for p in body["points"]], expected, atol=1e-6)
+        assert body["points"][-1]["timestamp"] == "2024-04-01T08:04:00"
+
+        body = client.get(f"/commute-routes/{route_id}", params={"format": "polyline"}).json()
+        np.testing.assert_allclose(decode_polyline(body["polyline"]), expected, atol=1e-5)
+        assert decode_varints(body["ts_deltas"]) == [0, 60, 60, 60, 60]
+
+        response = client.get(f"/commute-routes/{route_id}", params={"format": "binary"})
+        assert response.headers["X-Total-Locations"] == "5"
+        lat, _, epoch = unpack_points(response.content)
+        np.testing.assert_allclose(lat, [p["lat"] for p in points], atol=1e-6)
+        assert epoch[0] == body["start_ts"]
+
+        assert client.get(f"/commute-routes/{route_id}", params={"format": "xml"}).status_code == 400
+
+    def test_update_recomputes_endpoints(self, client, user_id):
+        route_id = create_route(client, user_id, points=route_points(datetime(2024, 4, 1, 8), 5))["id"]
+
+        response = client.put(f"/commute-routes/{route_id}", json={"points": route_points(datetime(2024, 4, 2, 8), 3, lat=25.1, lng=121.5)})
+        route = response.json()["route"]
+        assert (route["start_latitude"], route["end_latitude"]) == pytest.approx((25.1, 25.104))
+        assert (route["point_count"], route["travel_time"]) == (3, 2)
+
+        # 只更新有提供的欄位
+        route = client.put(f"/commute-routes/{route_id}", json={"route_name": "回家", "is_active": "inactive"}).json()["route"]
+        assert (route["route_name"], route["start_latitude"], route["point_count"]) == ("回家", pytest.approx(25.1), 3)
+        assert client.get("/commute-routes", params={"user_id": user_id}).json()["count"] == 0
+        assert client.get("/commute-routes", params={"user_id": user_id, "include_inactive": True}).json()["count"] == 1
+
+        assert client.put(f"/commute-routes/{route_id}", json={"departure_minute": 1440}).status_code == 422
+
+    def test_delete(self, client, user_id):
+        route_id = create_route(client, user_id, points=route_points(datetime(2024, 4, 1, 8), 3))["id"]
+        assert client.delete(f"/commute-routes/{route_id}").json()["id"] == route_id
+        assert client.get(f"/commute-routes/{route_id}").status_code == 404
+        assert client.delete(f"/commute-routes/{route_id}").status_code == 404
+
+
+class TestCommuteMatches:
+    """GET /commute-routes/{route_id}/matches（大阪，避免與其他測試的路線重疊）"""
+
+    @staticmethod
+    def endpoints(client, start, end, departure_minute):
+        return create_route(
+            client, make_user(), start_latitude=start[0], start_longitude=start[1],
+            end_latitude=end[0], end_longitude=end[1], departure_minute=departure_minute
+        )
+
+    def test_matches(self, client, user_id):
+        home, office = (34.6900, 135.5000), (34.7300, 135.5000)
+        route = create_route(
+            client, user_id, start_latitude=home[0], start_longitude=home[1],
+            end_latitude=office[0], end_longitude=office[1], departure_minute=480
+        )
+        # 自己的其他路線不列入
+        create_route(client, user_id, start_latitude=home[0], start_longitude=home[1], end_latitude=office[0], end_longitude=office[1], departure_minute=480)
+        near = self.endpoints(client, (34.6918, 135.5000), office, 490)
+        nearer = self.endpoints(client, home, (34.7309, 135.5000), 482)
+        self.endpoints(client, home, office, 600)                # 出發時間差超過 window_min
+        self.endpoints(client, home, (34.8000, 135.5000), 480)   # 終點超出半徑
+
+        body = client.get(f"/commute-routes/{route['id']}/matches", params={"window_min": 20}).json()
+        assert [m["route_id"] for m in body["matches"]] == [nearer["id"], near["id"]]
+        assert body["matches"][1]["start_distance_m"] == pytest.approx(200, abs=1)
+        assert body["matches"][1]["departure_diff_min"] == 10
+
+        body = client.get(f"/commute-routes/{route['id']}/matches", params={"window_min": 20, "limit": 1}).json()
+        assert [m["route_id"] for m in body["matches"]] == [nearer["id"]]
+
+    def test_departure_window_wraps_midnight(self, client):
+        route = self.endpoints(client, (34.6000, 135.4000), (34.6400, 135.4000), 1435)
+        late = self.endpoints(client, (34.6000, 135.4000), (34.6400, 135.4000), 5)
+        body = client.get(f"/commute-routes/{route['id']}/matches", params={"window_min": 15}).json()
+        assert [(m["route_id"], m["departure_diff_min"]) for m in body["matches"]] == [(late["id"], 10)]
+
+    def test_errors(self, client, user_id):
+        route = create_route(client, user_id, points=route_points(datetime(2024, 4, 1, 8), 3, lat=34.5, lng=135.3))
+        assert client.get(f"/commute-routes/{route['id']}/matches", params={"start_radius_m": 0}).status_code == 400
+        assert client.get(f"/commute-routes/{route['id']}/matches", params={"window_min": 100000}).status_code == 400
+        assert client.get(f"/commute-routes/{route['id']}/matches", params={"limit": 0}).status_code == 400
+        assert client.get(f"/commute-routes/{MISSING_USER_ID}/matches").status_code == 404
+
+
+def line_points(start, end, count, east_m=0.0):
+    """兩點之間等距的路線定位點（不含時間），east_m 為整條路線往東平移的公尺數"""
+    shift = east_m / (111320.0 * np.cos(np.radians(start[0])))
+    return [
+        {"lat": float(lat), "lng": float(lng) + shift}
+        for lat, lng in zip(np.linspace(start[0], end[0], count), np.linspace(start[1], end[1], count))
+    ]
+
+
+class TestSimilarCommuteRoutes:
+    """GET /commute-routes/similar（雪梨，避免與其他測試的路線重疊）"""
+
+    start, end = (-33.9000, 151.2000), (-33.8600, 151.2000)
+
+    def test_similar(self, client, user_id):
+        create_route(client, user_id, points=line_points(self.start, self.end, 21))
+        # 自己的路線之間不列入；候選路線只保留與用戶最相近的一條路線的距離
+        own = create_route(client, user_id, points=line_points(self.start, self.end, 21, east_m=10))
+        shifted = create_route(client, make_user(), points=line_points(self.start, self.end, 35, east_m=100))
+        create_route(client, make_user(), points=line_points(self.end, self.start, 21))            # 反方向
+        create_route(client, make_user(), points=line_points(self.start, self.end, 21, east_m=1000))
+
+        body = client.get("/commute-routes/similar", params={"user_id": user_id}).json()
+        assert [m["route_id"] for m in body["routes"]] == [shifted["id"]]
+        match = body["routes"][0]
+        assert match["frechet_m"] == pytest.approx(90, abs=2)
+        assert match["matched_route_id"] == own["id"]
+
+        # 門檻小於平移距離時不列入
+        assert client.get("/commute-routes/similar", params={"user_id": user_id, "max_distance_m": 50}).json()["count"] == 0
+
+    def test_errors(self, client, user_id):
+        assert client.get("/commute-routes/similar", params={"user_id": user_id, "max_distance_m": 0}).status_code == 400
+        assert client.get("/commute-routes/similar", params={"user_id": user_id, "limit": 0}).status_code == 400
+        assert client.get("/commute-routes/similar", params={"user_id": MISSING_USER_ID}).status_code == 404
+
+
+class TestCommuteCorridor:
+    """GET /commute-routes/near 與 /near-path（開普敦，避免與其他測試的路線重疊）"""
+
+    @staticmethod
+    def create_routes(client, user_id, lng):
+        """沿經度 lng 南北向的路線，以及往東 300、3000 公尺的其他用戶路線（各測試使用不同經度）"""
+        start, end = (-33.9500, lng), (-33.9000, lng)
+        # 只有起訖兩點的長路線，索引時切成較短的線段
+        own = create_route(client, user_id, points=line_points(start, end, 2))
+        east = create_route(client, make_user(), points=line_points(start, end, 2, east_m=300))
+        create_route(client, make_user(), points=line_points(start, end, 2, east_m=3000))
+        return own, east
+
+    def test_near_point(self, client, user_id):
+        own, east = self.create_routes(client, user_id, 18.42)
+        lng = 18.42 + 100 / (111320.0 * np.cos(np.radians(33.925)))
+        params = {"lat": -33.925, "lng": lng, "radius_m": 250}
+
+        body = client.get("/commute-routes/near", params=params).json()
+        assert [(r["route_id"], r["user_id"]) for r in body["routes"]] == [(own["id"], user_id), (east["id"], east["user_id"])]
+        assert [r["distance_m"] for r in body["routes"]] == pytest.approx([100, 200], abs=1)
+
+        assert [r["route_id"] for r in client.get("/commute-routes/near", params={**params, "radius_m": 150}).json()["routes"]] == [own["id"]]
+        assert [r["route_id"] for r in client.get("/commute-routes/near", params={**params, "exclude_user_id": user_id}).json()["routes"]] == [east["id"]]
+        assert [r["route_id"] for r in client.get("/commute-routes/near", params={**params, "limit": 1}).json()["routes"]] == [own["id"]]
+
+        # 停用的路線移出索引
+        client.put(f"/commute-routes/{own['id']}", json={"is_active": "inactive"})
+        assert [r["route_id"] for r in client.get("/commute-routes/near", params=params).json()["routes"]] == [east["id"]]
+
+    def test_near_path(self, client, user_id):
+        own, east = self.create_routes(client, user_id, 18.52)
+        west = line_points((-33.9300, 18.52), (-33.9200, 18.52), 3, east_m=-50)
+        polyline = encode_polyline(np.array([p["lat"] for p in west]), np.array([p["lng"] for p in west]))
+
+        body = client.get("/commute-routes/near-path", params={"polyline": polyline, "radius_m": 400}).json()
+        assert [r["route_id"] for r in body["routes"]] == [own["id"], east["id"]]
+        assert [r["distance_m"] for r in body["routes"]] == pytest.approx([50, 350], abs=1)
+        assert client.get("/commute-routes/near-path", params={"polyline": polyline, "radius_m": 100}).json()["count"] == 1
+
+    def test_errors(self, client):
+        assert client.get("/commute-routes/near", params={"lat": 91, "lng": 0}).status_code == 400
+        assert client.get("/commute-routes/near", params={"lat": 0, "lng": 0, "radius_m": 0}).status_code == 400
+        assert client.get("/commute-routes/near", params={"lat": 0, "lng": 0, "limit": 0}).status_code == 400
+        single = encode_polyline(np.array([-33.93]), np.array([18.42]))
+        assert client.get("/commute-routes/near-path", params={"polyline": single}).status_code == 400
+        assert client.get("/commute-routes/near-path", params={"polyline": "_p~iF~ps|U_ulL"}).status_code == 400
+
+
+class TestSimilarUsers:
+    """GET /gps/similar-users（布宜諾斯艾利斯，避免與其他測試的用戶重疊）"""
+
+    start, end = (-34.6500, -58.4500), (-34.5500, -58.4500)
+
+    @staticmethod
+    def similar(client, user_id, **params):
+        response = client.get("/gps/similar-users", params={"user_id": user_id, **params})
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    def test_indexed_in_background(self, client, user_id):
+        create_route(client, user_id, points=line_points(self.start, self.end, 2))
+        same = make_user()
+        create_route(client, same, points=line_points(self.start, self.end, 2))
+        other = make_user()
+        create_route(client, other, points=line_points((-34.6500, -58.3000), (-34.5500, -58.3000), 2))
+
+        # 請求中不計算簽章：加入待計算後回傳空列表
+        body = self.similar(client, user_id)
+        assert (body["status"], body["indexed"], body["users"]) == ("indexing", False, [])
+        for uid in (same, other):
+            assert self.similar(client, uid)["status"] == "indexing"
+        assert similar_user_index.get_stats()["pending_users"] >= 3
+
+        similar_user_index.process_pending()
+
+        body = self.similar(client, user_id)
+        assert (body["status"], body["indexed"]) == ("ready", True)
+        assert [(u["user_id"], u["similarity"]) for u in body["users"]] == [(same, 1.0)]
+        assert body["users"][0]["cell_count"] > 3
+
+    def test_insufficient_data(self, client, user_id):
+        assert self.similar(client, user_id)["status"] == "indexing"
+        similar_user_index.process_pending()
+        body = self.similar(client, user_id)
+        assert (body["status"], body["count"]) == ("insufficient_data", 0)
+
+    def test_errors(self, client, user_id):
+        assert client.get("/gps/similar-users", params={"user_id": user_id, "limit": 0}).status_code == 400
+        assert client.get("/gps/similar-users", params={"user_id": user_id, "min_similarity": 2}).status_code == 400
+        assert client.get("/gps/similar-users", params={"user_id": MISSING_USER_ID}).status_code == 404
@@ -0,0 +1,308 @@
+"""
+GPS 演算法單元測試
+
+不需啟動服務器，直接測試各 GPS 服務中的純函數（軌跡簡化、編碼、驗證、空間索引與分段演算法）。
+
+使用方式：
+    pytest test_gps_units.py -v
+"""
+
+import sys
+import os
+import time
+
+import numpy as np
+import pytest
+
+# 將父目錄加入 Python 路徑以便導入模組
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from app.services.commute_corridor import _segment_distance, split_segments
+from app.services.commute_derivation import circular_mean_minute
+from app.services.commute_similarity import discrete_frechet_batch
+from app.services.geo_utils import geohash_encode_np, geohash_ranges, haversine_m_np
+from app.services.gps_encoding import (
+    BINARY_HEADER,
+    decode_polyline,
+    decode_varints,
+    encode_polyline,
+    encode_varints,
+    pack_points,
+    unpack_points,
+)
+from app.services.gps_service import validate_gps_columns
+from app.services.gps_similar_users import minhash_signature
+from app.services.gps_track_service import simplify_indices
+from app.services.gps_trips import TripSegmentationService
+
+METERS_PER_DEGREE = 111320.0
+
+
+class TestSimplify:
+    """Douglas-Peucker 軌跡簡化"""
+
+    def test_short_track_kept(self):
+        lat = np.array([25.0, 25.001])
+        lng = np.array([121.0, 121.001])
+        assert simplify_indices(lat, lng, 10).tolist() == [0, 1]
+
+    def test_collinear_points_removed(self):
+        lat = np.linspace(25.0, 25.01, 11)
+        lng = np.full(11, 121.5)
+        assert simplify_indices(lat, lng, 1).tolist() == [0, 10]
+
+    def test_corner_kept(self):
+        # 先往北再往東，轉角必須保留
+        lat = np.concatenate([np.linspace(25.0, 25.01, 6), np.full(5, 25.01)])
+        lng = np.concatenate([np.full(6, 121.5), np.linspace(121.502, 121.51, 5)])
+        assert simplify_indices(lat, lng, 5).tolist() == [0, 5, 10]
+
+    def test_zero_tolerance_keeps_all(self):
+        lat = np.linspace(25.0, 25.01, 5)
+        lng = np.full(5, 121.5)
+        assert simplify_indices(lat, lng, 0).tolist() == [0, 1, 2, 3, 4]
+
+
+class TestValidateColumns:
+    """欄式批次驗證"""
+
+    def test_valid_batch(self):
+        now = time.time()
+        rows, errors = validate_gps_columns(1, [25.0, 25.1], [121.0, 121.1], [now - 10, now - 5])
+        assert errors == []
+        assert [row["latitude"] for row in rows] == [25.0, 25.1]
+        assert all(row["user_id"] == 1 for row in rows)
+        assert rows[0]["timestamp"].tzinfo is None
+
+    def test_first_error_reported_per_point(self):
+        now = time.time()
+        rows, errors = validate_gps_columns(
+            1,
+            [25.0, 91.0, float('nan'), 25.0, 25.0],
+            [121.0, 121.0, 121.0, 181.0, 121.0],
+            [now - 10, now - 9, now - 8, now - 7, now + 3600]
+        )
+        assert len(rows) == 1
+        assert [error["index"] for error in errors] == [1, 2, 3, 4]
+        assert errors[0]["error"] == '緯度必須在 -90 到 90 之間'
+        assert errors[1]["error"] == '數值無效'
+        assert errors[2]["error"] == '經度必須在 -180 到 180 之間'
+        assert errors[3]["error"] == '時間戳記不可晚於目前時間'
+
+    def test_out_of_order_against_valid_points(self):
+        now = time.time()
+        # 索引 1 無效，不影響之後的遞增判斷；索引 3 早於索引 2
+        rows, errors = validate_gps_columns(
+            1, [25.0, 95.0, 25.0, 25.0], [121.0] * 4, [now - 100, now - 10, now - 50, now - 60]
+        )
+        assert [error["index"] for error in errors] == [1, 3]
+        assert errors[1]["error"] == '時間戳記必須遞增'
+        assert len(rows) == 2
+
+    def test_timestamp_before_minimum(self):
+        # 遠早於允許範圍的時間（含超出 datetime64 範圍的值）逐點回報，不影響其他點
+        now = time.time()
+        rows, errors = validate_gps_columns(1, [25.0] * 3, [121.0] * 3, [-1e300, 0.0, now - 10])
+        assert [error["index"] for error in errors] == [0, 1]
+        assert errors[0]["error"].startswith('時間戳記不可早於')
+        assert len(rows) == 1
+
+    def test_length_mismatch(self):
+        with pytest.raises(ValueError):
+            validate_gps_columns(1, [25.0], [121.0, 121.1], [0.0])
+
+
+class TestEncoding:
+    """polyline、varint 與 GPSB 二進位格式"""
+
+    def test_polyline_reference_value(self):
+        # Google 官方文件的範例
+        lat = np.array([38.5, 40.7, 43.252])
+        lng = np.array([-120.2, -120.95, -126.453])
+        encoded = encode_polyline(lat, lng)
+        assert encoded == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+        assert decode_polyline(encoded) == [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+
+    def test_varint_round_trip(self):
+        values = np.array([0, 1, -1, 31, -32, 1 << 20, -(1 << 40), 123456789])
+        assert decode_varints(encode_varints(values)) == values.tolist()
+
+    def test_varint_empty(self):
+        assert encode_varints(np.array([], dtype=np.int64)) == ""
+        assert decode_varints("") == []
+
+    def test_pack_round_trip(self):
+        lat = np.array([25.033, 25.034567, -33.865143])
+        lng = np.array([121.5654, 121.566789, 151.2099])
+        epoch = np.array([1700000000, 1700000005, 1700003600], dtype=np.int64)
+        out_lat, out_lng, out_epoch = unpack_points(pack_points(lat, lng, epoch))
+        np.testing.assert_allclose(out_lat, lat, atol=1e-6)
+        np.testing.assert_allclose(out_lng, lng, atol=1e-6)
+        assert out_epoch.tolist() == epoch.tolist()
+
+    def test_pack_without_timestamps(self):
+        lat = np.array([25.0, 25.1])
+        lng = np.array([121.0, 121.1])
+        data = pack_points(lat, lng, None)
+        assert len(data) == BINARY_HEADER.size + 2 * 2 * 4
+        out_lat, out_lng, out_epoch = unpack_points(data)
+        np.testing.assert_allclose(out_lat, lat, atol=1e-6)
+        np.testing.assert_allclose(out_lng, lng, atol=1e-6)
+        assert out_epoch is None
+
+    def test_pack_epoch_zero_is_not_missing(self):
+        # 1970-01-01 的時間仍是有效時間，不能與沒有時間混淆
+        out = unpack_points(pack_points(np.array([0.0, 0.0]), np.array([0.0, 0.0]), np.array([0, 60])))
+        assert out[2].tolist() == [0, 60]
+
+    def test_unpack_rejects_unknown_format(self):
+        data = BINARY_HEADER.pack(b'GPSB', 99, 0, 0)
+        with pytest.raises(ValueError):
+            unpack_points(data)
+
+
+class TestGeohashRanges:
+    """範圍框轉 geohash 區間"""
+
+    @staticmethod
+    def covered(geohash, ranges):
+        return any(start <= geohash and (end is None or geohash < end) for start, end in ranges)
+
+    def test_points_inside_box_are_covered(self):
+        rng = np.random.default_rng(0)
+        box = (25.0, 121.4, 25.1, 121.6)
+        precision, ranges = geohash_ranges(*box)
+        lat = rng.uniform(box[0], box[2], 200)
+        lng = rng.uniform(box[1], box[3], 200)
+        assert all(self.covered(g, ranges) for g in geohash_encode_np(lat, lng, precision))
+
+    def test_cell_limit(self):
+        precision, ranges = geohash_ranges(25.0, 121.4, 25.1, 121.6, max_cells=16)
+        assert len(ranges) <= 16
+        assert all(len(start) == precision for start, _ in ranges)
+
+    def test_box_at_world_edge(self):
+        precision, ranges = geohash_ranges(89.0, 179.0, 90.0, 180.0)
+        assert ranges[-1][1] is None
+        assert self.covered(geohash_encode_np(np.array([89.9]), np.array([179.9]), precision)[0], ranges)
+
+
+class TestTripSegmentation:
+    """停留點與行程分段"""
+
+    @staticmethod
+    def build(*parts):
+        """依序串接 (分鐘數, 起點緯度, 終點緯度)，每分鐘一個定位點"""
+        lat = np.concatenate([np.linspace(start, end, minutes) for minutes, start, end in parts])
+        epoch = np.arange(len(lat), dtype=np.float64) * 60
+        return epoch, lat, np.full(len(lat), 121.5)
+
+    @pytest.fixture
+    def service(self):
+        service = TripSegmentationService()
+        service.stay_radius_m = 200
+        service.stay_min_duration_s = 600
+        service.max_gap_s = 1800
+        return service
+
+    def test_detect_stays(self, service):
+        epoch, lat, lng = self.build((20, 25.0, 25.0), (10, 25.005, 25.045), (20, 25.05, 25.05), (5, 25.06, 25.1))
+        stays, open_index = service.detect_stays(epoch, lat, lng)
+        assert stays == [(0, 19), (30, 49)]
+        # 只有最後一個定位點之後還沒有資料，無法判斷是否停留
+        assert open_index == 54
+
+    def test_short_stop_is_not_stay(self, service):
+        epoch, lat, lng = self.build((5, 25.0, 25.0), (10, 25.005, 25.05))
+        stays, _ = service.detect_stays(epoch, lat, lng)
+        assert stays == []
+
+    def test_plan(self, service):
+        epoch, lat, lng = self.build((20, 25.0, 25.0), (10, 25.005, 25.045), (20, 25.05, 25.05), (5, 25.06, 25.1))
+        stays, trips, boundary = service.plan(epoch, lat, lng)
+        assert stays == [(0, 19), (30, 49)]
+        assert trips == [(19, 30, 0, 1)]
+        assert boundary == (49, 1)
+
+    def test_plan_splits_signal_gap(self, service):
+        epoch, lat, lng = self.build((20, 25.0, 25.0), (10, 25.005, 25.045), (20, 25.05, 25.05), (5, 25.06, 25.1))
+        # 行程中間斷訊超過 max_gap_s
+        epoch[25:] += 3600
+        stays, trips, boundary = service.plan(epoch, lat, lng)
+        assert stays == [(0, 19), (30, 49)]
+        assert trips == [(19, 24, 0, None), (25, 30, None, 1)]
+        assert boundary == (49, 1)
+
+    def test_plan_without_stays(self, service):
+        epoch, lat, lng = self.build((10, 25.0, 25.05))
+        stays, trips, boundary = service.plan(epoch, lat, lng)
+        assert stays == [] and trips == [] and boundary is None
+
+
+class TestCircularMeanMinute:
+    """出發時間的環狀平均"""
+
+    def test_same_day(self):
+        assert circular_mean_minute(np.array([480, 490, 500])) == 490
+
+    def test_across_midnight(self):
+        assert circular_mean_minute(np.array([1430, 10])) == 0
+        assert circular_mean_minute(np.array([1420, 1430, 20])) == 1437
+
+
+class TestFrechet:
+    """離散 Fréchet 距離"""
+
+    def test_identical_and_shifted(self):
+        query = np.column_stack([np.linspace(0, 1000, 10), np.zeros(10)])
+        candidates = np.stack([query, query + [0, 50], query[::-1]])
+        distance = discrete_frechet_batch(query, candidates)
+        assert distance[0] == 0
+        assert distance[1] == pytest.approx(50)
+        # 反方向的路線距離為整條路線長度
+        assert distance[2] == pytest.approx(1000)
+
+    def test_different_lengths(self):
+        query = np.array([[0.0, 0.0], [10.0, 0.0]])
+        candidates = np.array([[[0.0, 0.0], [5.0, 0.0], [10.0, 0.0]]])
+        assert discrete_frechet_batch(query, candidates)[0] == pytest.approx(5)
+
+
+class TestCorridor:
+    """走廊索引的線段切分與線段距離"""
+
+    def test_split_segments(self):
+        lat = np.array([25.0, 25.0 + 1200 / METERS_PER_DEGREE, 25.0 + 1300 / METERS_PER_DEGREE])
+        lng = np.full(3, 121.5)
+        segments = split_segments(lat, lng, 500)
+        assert len(segments) == 4
+        # 首尾相接且涵蓋整條折線
+        assert segments[0, 0] == lat[0] and segments[-1, 2] == lat[-1]
+        np.testing.assert_allclose(segments[1:, :2], segments[:-1, 2:])
+        lengths = haversine_m_np(segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3])
+        assert lengths.max() <= 500
+
+    def test_segment_distance(self):
+        a1 = np.array([[0.0, 0.0], [0.0, 0.0], [0.0, 0.0]])
+        a2 = np.array([[10.0, 0.0], [10.0, 0.0], [10.0, 0.0]])
+        b1 = np.array([[5.0, -5.0], [0.0, 3.0], [13.0, 4.0]])
+        b2 = np.array([[5.0, 5.0], [10.0, 3.0], [20.0, 4.0]])
+        np.testing.assert_allclose(_segment_distance(a1, a2, b1, b2), [0.0, 3.0, 5.0])
+
+
+class TestMinHash:
+    """MinHash 簽章"""
+
+    seeds = np.arange(1, 129, dtype=np.uint64) * np.uint64(0x9e3779b97f4a7c15)
+
+    def test_order_and_duplicates_ignored(self):
+        cells = np.array([5, 17, 3, 99], dtype=np.int64)
+        signature = minhash_signature(cells, self.seeds)
+        assert signature.dtype == np.uint32 and len(signature) == len(self.seeds)
+        assert np.array_equal(signature, minhash_signature(np.concatenate([cells[::-1], cells]), self.seeds))
+
+    def test_estimates_jaccard(self):
+        a = np.arange(0, 1000)
+        b = np.arange(500, 1500)  # Jaccard = 500 / 1500
+        agreement = np.mean(minhash_signature(a, self.seeds) == minhash_signature(b, self.seeds))
+        assert agreement == pytest.approx(1 / 3, abs=0.12)
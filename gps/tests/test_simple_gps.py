@@ -17,6 +17,7 @@ GPS 定位系統測試檔
 
 import requests
 import json
+import time
 from datetime import datetime, timedelta
 import sys
 import os
@@ -201,6 +202,459 @@ class TestGPSSystem:
         print(f"  成功記錄 {successful_records}/{len(locations)} 個位置")
         return successful_records == len(locations)
 
+    @staticmethod
+    def test_batch_upload_endpoint():
+        """測試批次上傳端點（單點錯誤不影響整批）"""
+        url = f"{BASE_URL}/gps/locations/batch"
+        
+        now = datetime.now()
+        batch_data = {
+            "points": [
+                {"lat": 25.0478, "lng": 121.5170, "ts": now.isoformat()},
+                {"lat": 25.0485, "lng": 121.5180, "ts": (now + timedelta(seconds=5)).isoformat()},
+                {"lat": 91.0, "lng": 121.5190, "ts": (now + timedelta(seconds=10)).isoformat()},  # 無效緯度
+                {"lat": 25.0495, "lng": 121.5190, "ts": "not-a-timestamp"}  # 無效時間
+            ]
+        }
+        
+        params = {"user_id": TEST_USER_ID}
+        
+        try:
+            response = requests.post(url, json=batch_data, params=params)
+            
+            print(f"✓ 批次上傳 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            data = response.json()
+            assert data["total"] == 4, f"總數不符"
+            assert data["accepted"] == 2, f"成功數量不符，期望 2，實際 {data['accepted']}"
+            assert [e["index"] for e in data["errors"]] == [2, 3], f"錯誤索引不符"
+            
+            print(f"  成功 {data['accepted']} 筆，失敗 {data['rejected']} 筆")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 批次上傳失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_columnar_batch_upload():
+        """測試欄式批次上傳（平行陣列、向量化驗證）"""
+        url = f"{BASE_URL}/gps/locations/batch/columnar"
+        
+        base_ts = datetime.now().timestamp() - 60
+        columnar_data = {
+            "lat": [25.0478, 25.0485, 95.0, 25.0495],
+            "lng": [121.5170, 121.5180, 121.5185, 121.5190],
+            "ts": [base_ts, base_ts + 5, base_ts + 10, base_ts + 2]  # 第 3 點緯度無效、第 4 點時間倒退
+        }
+        
+        params = {"user_id": TEST_USER_ID}
+        
+        try:
+            response = requests.post(url, json=columnar_data, params=params)
+            
+            print(f"✓ 欄式批次上傳 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            data = response.json()
+            assert data["accepted"] == 2, f"成功數量不符，期望 2，實際 {data['accepted']}"
+            assert [e["index"] for e in data["errors"]] == [2, 3], f"錯誤索引不符"
+            
+            print(f"  成功 {data['accepted']} 筆，失敗 {data['rejected']} 筆")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 欄式批次上傳失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_paginate_locations():
+        """測試定位歷史 keyset 分頁（next_cursor）"""
+        url = f"{BASE_URL}/gps/locations/{TEST_USER_ID}"
+        
+        try:
+            full = requests.get(url).json()
+            
+            seen_ids = []
+            cursor = None
+            while True:
+                params = {"limit": 2}
+                if cursor:
+                    params["cursor"] = cursor
+                response = requests.get(url, params=params)
+                assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+                
+                data = response.json()
+                seen_ids.extend(location["id"] for location in data["locations"])
+                cursor = data["next_cursor"]
+                if not cursor:
+                    break
+            
+            print(f"✓ 分頁查詢 - 共 {len(seen_ids)} 筆")
+            
+            assert len(seen_ids) == len(set(seen_ids)), "分頁結果有重複"
+            assert seen_ids == [location["id"] for location in full["locations"]], "分頁結果與一次查詢不符"
+            return True
+            
+        except Exception as e:
+            print(f"❌ 分頁查詢失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_export_locations():
+        """測試串流匯出定位歷史（NDJSON 與 CSV）"""
+        url = f"{BASE_URL}/gps/locations/{TEST_USER_ID}/export"
+        
+        try:
+            response = requests.get(url, params={"format": "ndjson"}, stream=True)
+            
+            print(f"✓ NDJSON 匯出 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            rows = [json.loads(line) for line in response.iter_lines() if line]
+            assert all("latitude" in row and "timestamp" in row for row in rows), "NDJSON 欄位不符"
+            
+            response = requests.get(url, params={"format": "csv"})
+            
+            print(f"✓ CSV 匯出 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            lines = response.text.splitlines()
+            assert lines[0] == "id,timestamp,latitude,longitude", "CSV 標題不符"
+            assert len(lines) - 1 == len(rows), "CSV 與 NDJSON 筆數不符"
+            
+            print(f"  共匯出 {len(rows)} 個定位記錄")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 匯出定位歷史失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_latest_locations():
+        """測試最新定位查詢（單一與批次）"""
+        TestGPSSystem.test_record_gps_location()
+        
+        try:
+            response = requests.get(f"{BASE_URL}/gps/latest/{TEST_USER_ID}")
+            
+            print(f"✓ 最新定位 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            latest = response.json()
+            assert "latitude" in latest and "timestamp" in latest, "回應中缺少定位欄位"
+            
+            response = requests.post(f"{BASE_URL}/gps/latest", json={"user_ids": [TEST_USER_ID, 999999]})
+            
+            print(f"✓ 批次最新定位 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            data = response.json()
+            assert data["locations"][str(TEST_USER_ID)] == latest, "批次查詢結果與單一查詢不符"
+            assert data["locations"]["999999"] is None, "不存在的用戶應為 null"
+            
+            print(f"  最新定位: ({latest['latitude']}, {latest['longitude']}) @ {latest['timestamp']}")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 最新定位查詢失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_nearby_users():
+        """測試附近線上用戶查詢"""
+        url = f"{BASE_URL}/gps/nearby"
+        
+        try:
+            response = requests.get(url, params={"lat": 25.0330, "lng": 121.5654, "radius": 2000, "limit": 10})
+            
+            print(f"✓ 附近用戶 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            data = response.json()
+            distances = [u["distance_m"] for u in data["users"]]
+            assert distances == sorted(distances), "結果未依距離排序"
+            assert all(d <= 2000 for d in distances), "結果超出搜尋半徑"
+            
+            response = requests.get(url, params={"lat": 25.0330, "lng": 121.5654, "radius": -1})
+            assert response.status_code == 400, f"無效半徑應回傳 400，實際 {response.status_code}"
+            
+            print(f"  附近共 {data['count']} 位線上用戶")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 附近用戶查詢失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_location_summary():
+        """測試由彙總表查詢活動摘要"""
+        url = f"{BASE_URL}/gps/locations/{TEST_USER_ID}/summary"
+        
+        try:
+            response = requests.get(url)
+            
+            print(f"✓ 每日活動摘要 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            data = response.json()
+            assert "totals" in data and "buckets" in data, "回應中缺少 totals 或 buckets 欄位"
+            assert data["totals"]["point_count"] == sum(b["point_count"] for b in data["buckets"]), "總點數與每日點數加總不符"
+            
+            today = datetime.now().strftime('%Y-%m-%d')
+            response = requests.get(url, params={"granularity": "hour", "start_date": today, "end_date": today})
+            
+            print(f"✓ 每小時活動摘要 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            print(f"  近 30 天共 {data['totals']['point_count']} 個定位點，移動 {data['totals']['distance_m']} 公尺")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 活動摘要查詢失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_trip_stats():
+        """測試單日行程統計"""
+        today = datetime.now().strftime('%Y-%m-%d')
+        url = f"{BASE_URL}/gps/locations/{TEST_USER_ID}/date/{today}/stats"
+        
+        try:
+            response = requests.get(url)
+            
+            print(f"✓ 行程統計 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            data = response.json()
+            for field in ["distance_m", "moving_time_s", "stopped_time_s", "max_speed_mps", "speed_histogram_kmh"]:
+                assert field in data, f"回應中缺少 {field} 欄位"
+            assert abs(data["moving_time_s"] + data["stopped_time_s"] + data["gap_time_s"] - data["duration_s"]) < 1, "時間加總與總時長不符"
+            
+            print(f"  今天共 {data['point_count']} 個定位點，移動 {data['distance_m']} 公尺，最高速度 {data['max_speed_mps']} 公尺/秒")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 行程統計失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_trips_and_stays():
+        """測試行程與停留點列表"""
+        try:
+            for kind in ["trips", "stays"]:
+                response = requests.get(f"{BASE_URL}/gps/locations/{TEST_USER_ID}/{kind}", params={"limit": 10})
+                
+                print(f"✓ {kind} 列表 - 狀態碼: {response.status_code}")
+                
+                assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+                
+                data = response.json()
+                assert kind in data, f"回應中缺少 {kind} 欄位"
+                assert data["count"] == len(data[kind]) <= 10, "筆數與 limit 不符"
+                print(f"  近 30 天共 {data['count']} 筆")
+            
+            response = requests.get(f"{BASE_URL}/gps/locations/{TEST_USER_ID}/trips", params={"limit": 0})
+            assert response.status_code == 400, f"limit 無效時期望狀態碼 400，實際 {response.status_code}"
+            return True
+            
+        except Exception as e:
+            print(f"❌ 行程與停留點查詢失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_commute_routes():
+        """測試通勤路線新增、查詢與刪除"""
+        points = [
+            {"lat": 25.0330 + i * 0.001, "lng": 121.5654, "ts": f"2024-01-01T08:{i:02d}:00"}
+            for i in range(31)
+        ]
+        
+        try:
+            response = requests.post(
+                f"{BASE_URL}/commute-routes",
+                params={"user_id": TEST_USER_ID},
+                json={"route_name": "測試路線", "points": points}
+            )
+            
+            print(f"✓ 建立通勤路線 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            route = response.json()["route"]
+            assert route["point_count"] == 31, f"期望 31 個定位點，實際 {route['point_count']}"
+            assert route["travel_time"] == 30, f"期望通勤時間 30 分鐘，實際 {route['travel_time']}"
+            
+            response = requests.get(f"{BASE_URL}/commute-routes", params={"user_id": TEST_USER_ID})
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            assert "gps_points" not in response.json()["routes"][0], "列表不應包含定位點"
+            
+            response = requests.get(f"{BASE_URL}/commute-routes/{route['id']}")
+            assert len(response.json()["points"]) == 31, "定位點數量不符"
+            
+            response = requests.get(f"{BASE_URL}/commute-routes/{route['id']}", params={"format": "binary"})
+            assert response.content[:4] == b'GPSB', "二進位格式標頭不符"
+            
+            response = requests.delete(f"{BASE_URL}/commute-routes/{route['id']}")
+            
+            print(f"✓ 刪除通勤路線 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            print(f"  路線距離 {route['distance']} 公里")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 通勤路線測試失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_commute_matches():
+        """測試通勤配對查詢"""
+        route_data = {
+            "route_name": "配對測試路線",
+            "start_latitude": 25.0330, "start_longitude": 121.5654,
+            "end_latitude": 25.0478, "end_longitude": 121.5170,
+            "departure_minute": 480
+        }
+        
+        try:
+            response = requests.post(f"{BASE_URL}/commute-routes", params={"user_id": TEST_USER_ID}, json=route_data)
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            route_id = response.json()["route"]["id"]
+            
+            response = requests.get(
+                f"{BASE_URL}/commute-routes/{route_id}/matches",
+                params={"start_radius_m": 1000, "end_radius_m": 1000, "window_min": 20}
+            )
+            
+            print(f"✓ 通勤配對查詢 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            data = response.json()
+            assert all(m["user_id"] != TEST_USER_ID for m in data["matches"]), "配對結果不應包含自己的路線"
+            assert all(m["departure_diff_min"] <= 20 for m in data["matches"]), "出發時間差超出範圍"
+            
+            response = requests.get(f"{BASE_URL}/commute-routes/{route_id}/matches", params={"limit": 0})
+            assert response.status_code == 400, f"limit=0 期望狀態碼 400，實際 {response.status_code}"
+            
+            requests.delete(f"{BASE_URL}/commute-routes/{route_id}")
+            print(f"  找到 {data['count']} 條相近路線")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 通勤配對測試失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_similar_commute_routes():
+        """測試相似通勤路線查詢"""
+        points = [{"lat": 25.0330 + i * 0.001, "lng": 121.5654 - i * 0.001} for i in range(20)]
+        
+        try:
+            response = requests.post(f"{BASE_URL}/commute-routes", params={"user_id": TEST_USER_ID}, json={"points": points})
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            route_id = response.json()["route"]["id"]
+            
+            response = requests.get(
+                f"{BASE_URL}/commute-routes/similar",
+                params={"user_id": TEST_USER_ID, "max_distance_m": 500}
+            )
+            
+            print(f"✓ 相似路線查詢 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            data = response.json()
+            assert all(r["user_id"] != TEST_USER_ID for r in data["routes"]), "結果不應包含自己的路線"
+            assert all(r["frechet_m"] <= 500 for r in data["routes"]), "Fréchet 距離超出門檻"
+            
+            requests.delete(f"{BASE_URL}/commute-routes/{route_id}")
+            print(f"  找到 {data['count']} 條相似路線")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 相似路線測試失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_commute_corridor():
+        """測試路徑經過附近的通勤路線查詢"""
+        points = [{"lat": 25.0330 + i * 0.002, "lng": 121.5654} for i in range(10)]
+        
+        try:
+            response = requests.post(f"{BASE_URL}/commute-routes", params={"user_id": TEST_USER_ID}, json={"points": points})
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            route_id = response.json()["route"]["id"]
+            
+            # 查詢位置在路線中段東側約 100 公尺
+            response = requests.get(
+                f"{BASE_URL}/commute-routes/near",
+                params={"lat": 25.0410, "lng": 121.5664, "radius_m": 200}
+            )
+            
+            print(f"✓ 路線走廊查詢 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            routes = {r["route_id"]: r for r in response.json()["routes"]}
+            assert route_id in routes, "查詢結果缺少經過附近的路線"
+            assert routes[route_id]["distance_m"] <= 200, "距離超出查詢半徑"
+            
+            # 橫越路線的路徑（polyline 編碼）
+            response = requests.get(
+                f"{BASE_URL}/commute-routes/near-path",
+                params={"polyline": "_sywC_e}dV?o}@", "radius_m": 50}
+            )
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            assert route_id in [r["route_id"] for r in response.json()["routes"]], "路徑查詢結果缺少相交的路線"
+            
+            requests.delete(f"{BASE_URL}/commute-routes/{route_id}")
+            print(f"  路線距離查詢位置 {routes[route_id]['distance_m']} 公尺")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 路線走廊測試失敗: {e}")
+            return False
+
+    @staticmethod
+    def test_similar_users():
+        """測試相似用戶查詢"""
+        try:
+            response = requests.get(
+                f"{BASE_URL}/gps/similar-users",
+                params={"user_id": TEST_USER_ID, "limit": 10, "min_similarity": 0.1}
+            )
+            
+            print(f"✓ 相似用戶查詢 - 狀態碼: {response.status_code}")
+            
+            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            
+            data = response.json()
+            assert all(u["user_id"] != TEST_USER_ID for u in data["users"]), "結果不應包含自己"
+            assert all(0.1 <= u["similarity"] <= 1 for u in data["users"]), "相似度超出範圍"
+            
+            response = requests.get(f"{BASE_URL}/gps/similar-users", params={"user_id": TEST_USER_ID, "min_similarity": 2})
+            assert response.status_code == 400, f"min_similarity=2 期望狀態碼 400，實際 {response.status_code}"
+            
+            print(f"  找到 {data['count']} 位相似用戶")
+            return True
+            
+        except Exception as e:
+            print(f"❌ 相似用戶測試失敗: {e}")
+            return False
+
     @staticmethod 
     def test_delete_user_locations():
         """測試刪除用戶定位記錄"""
@@ -216,9 +670,20 @@ class TestGPSSystem:
             
             print(f"✓ 刪除定位記錄 - 狀態碼: {response.status_code}")
             
-            assert response.status_code == 200, f"期望狀態碼 200，實際 {response.status_code}"
+            assert response.status_code == 202, f"期望狀態碼 202，實際 {response.status_code}"
             
-            data = response.json()
+            job = response.json()
+            assert "job_id" in job, "回應中缺少 job_id 欄位"
+            
+            # 刪除在背景分批執行，輪詢工作狀態直到完成
+            job_url = f"{BASE_URL}/gps/delete-jobs/{job['job_id']}"
+            for _ in range(50):
+                data = requests.get(job_url).json()
+                if data["status"] in ("completed", "failed"):
+                    break
+                time.sleep(0.1)
+            
+            assert data["status"] == "completed", f"刪除工作未完成，狀態 {data['status']}"
             assert "deleted_count" in data, "回應中缺少 deleted_count 欄位"
             assert data["deleted_count"] >= 2, f"刪除數量不符，期望至少 2，實際 {data['deleted_count']}"
             
@@ -251,6 +716,20 @@ def run_all_tests():
         ("資料驗證", TestGPSSystem.test_gps_location_validation),
         ("按日期查詢", TestGPSSystem.test_get_locations_by_date),
         ("批量記錄", TestGPSSystem.test_batch_location_recording),
+        ("批次上傳端點", TestGPSSystem.test_batch_upload_endpoint),
+        ("欄式批次上傳", TestGPSSystem.test_columnar_batch_upload),
+        ("分頁查詢", TestGPSSystem.test_paginate_locations),
+        ("串流匯出", TestGPSSystem.test_export_locations),
+        ("最新定位", TestGPSSystem.test_latest_locations),
+        ("附近用戶", TestGPSSystem.test_nearby_users),
+        ("活動摘要", TestGPSSystem.test_location_summary),
+        ("行程統計", TestGPSSystem.test_trip_stats),
+        ("行程與停留點", TestGPSSystem.test_trips_and_stays),
+        ("通勤路線", TestGPSSystem.test_commute_routes),
+        ("通勤配對", TestGPSSystem.test_commute_matches),
+        ("相似路線", TestGPSSystem.test_similar_commute_routes),
+        ("路線走廊", TestGPSSystem.test_commute_corridor),
+        ("相似用戶", TestGPSSystem.test_similar_users),
         ("刪除記錄", TestGPSSystem.test_delete_user_locations)
     ]
     